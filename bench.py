@@ -0,0 +1,483 @@
+"""
+Benchmark dos caminhos quentes do painel (login, painel do revendedor, compra,
+download e painel admin).
+
+Semeia um banco próprio (nunca o reseller_panel.db do repositório) com volumes
+configuráveis, mede cada cenário pelo test client do Flask e/ou por um gunicorn
+local de verdade e imprime vazão + latência p50/p95/p99 em JSON. Com --baseline,
+compara com uma execução salva e sai com código 1 se algum cenário regrediu.
+
+    python bench.py --mode both --output bench.json
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json --tolerance 0.2
+
+O servidor do modo gunicorn importa este arquivo ("bench:app"): o site.py não
+pode ser importado pelo nome, porque 'site' é um módulo da biblioteca padrão.
+"""
+import argparse
+import contextlib
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_PASSWORD = 'bench123'
+ADMIN_LOGIN = ('trader', 'traderbr')
+SCENARIOS = ('login', 'reseller_panel', 'purchase_product', 'get_download_link', 'admin_panel')
+
+# Balde enorme com recarga moderada: o rate limit nunca responde 429 durante a medição.
+BENCH_ENV = {
+    'LOGIN_IP_RATE_LIMIT': '1000000000/1000000',
+    'LOGIN_USER_RATE_LIMIT': '1000000000/1000000',
+    'PURCHASE_IP_RATE_LIMIT': '1000000000/1000000',
+    'PURCHASE_USER_RATE_LIMIT': '1000000000/1000000',
+}
+
+_panel = None
+
+def load_panel():
+    """Carrega o site.py como módulo 'panel' (uma vez por processo)"""
+    global _panel
+    if _panel is None:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('panel', os.path.join(ROOT, 'site.py'))
+        module = importlib.util.module_from_spec(spec)
+        # Registrado antes de executar: o Flask acha a pasta static pelo sys.modules
+        sys.modules['panel'] = module
+        with contextlib.redirect_stdout(sys.stderr):
+            spec.loader.exec_module(module)
+        _panel = module
+    return _panel
+
+def __getattr__(name):
+    # "gunicorn bench:app" carrega o painel só dentro do worker
+    if name == 'app':
+        return load_panel().app
+    raise AttributeError(name)
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+# --- Dados de teste (determinísticos a partir de --seed) ---
+
+def seed_database(panel, args):
+    """Cria o schema (init_db) e insere revendedores, produtos, planos e compras em lote"""
+    with contextlib.redirect_stdout(sys.stderr):
+        panel.init_db()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    conn = panel.db_pool.acquire()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # Um único hash para todos: o custo do scrypt fica no cenário de login, não na semeadura
+        password = panel.generate_password_hash(BENCH_PASSWORD, panel.PASSWORD_HASH_METHOD)
+        opening_cents = 100_000_000  # R$ 1.000.000,00: as compras da medição nunca falham por saldo
+        conn.executemany(
+            "INSERT INTO users (username, password, role, balance, balance_cents) VALUES (?, ?, 'reseller', ?, ?)",
+            [(f'bench_r{i:06d}', password, opening_cents / 100.0, opening_cents) for i in range(args.resellers)]
+        )
+        reseller_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM users WHERE username LIKE 'bench\\_r%' ESCAPE '\\' ORDER BY id")]
+        conn.executemany(panel.LEDGER_INSERT_SQL,
+                         [(user_id, opening_cents, 'opening', None) for user_id in reseller_ids])
+
+        conn.executemany("INSERT INTO products (name) VALUES (?)",
+                         [(f'Bench Produto {i:04d}',) for i in range(args.products)])
+        product_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM products WHERE name LIKE 'Bench Produto %' ORDER BY id")]
+        conn.executemany(
+            "INSERT INTO plans (product_id, name, cost, duration_days, download_link) VALUES (?, ?, ?, ?, ?)",
+            [(product_id, f'Plano {j + 1}', float(rng.choice((5, 15, 30, 60, 90))), 30,
+              f'https://exemplo.com/bench/{product_id}/{j + 1}.zip')
+             for product_id in product_ids for j in range(args.plans)]
+        )
+        plans = conn.execute(
+            "SELECT id, cost FROM plans WHERE product_id IN (SELECT value FROM json_each(?))",
+            (json.dumps(product_ids),)
+        ).fetchall()
+
+        # Histórico espalhado pelos últimos 90 dias (histórico, relatórios e exportações têm volume real)
+        now = datetime.now(timezone.utc)
+        rows = []
+        for _ in range(args.purchases if plans and reseller_ids else 0):
+            plan = rng.choice(plans)
+            created = now - timedelta(seconds=rng.randrange(90 * 86400))
+            rows.append((rng.choice(reseller_ids), plan['id'], plan['cost'], f'ID-{uuid.UUID(int=rng.getrandbits(128)).hex[:16].upper()}',
+                         created.strftime('%Y-%m-%d %H:%M:%S')))
+            if len(rows) >= 10_000:
+                conn.executemany("INSERT INTO purchases (reseller_id, plan_id, cost_paid, purchase_id_ref, created_at) "
+                                 "VALUES (?, ?, ?, ?, ?)", rows)
+                rows = []
+        conn.executemany("INSERT INTO purchases (reseller_id, plan_id, cost_paid, purchase_id_ref, created_at) "
+                         "VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+    finally:
+        panel.db_pool.release(conn)
+    with contextlib.redirect_stdout(sys.stderr):
+        panel.backfill_sales_rollups()
+    log(f"🌱 Banco semeado em {time.perf_counter() - started:.1f} s: {args.resellers} revendedores, "
+        f"{args.products} produtos × {args.plans} planos, {args.purchases} compras.")
+
+def bench_fixtures(database, concurrency):
+    """Revendedores usados pelas threads e um plano ativo para as compras"""
+    conn = sqlite3.connect(database)
+    try:
+        users = [row[0] for row in conn.execute(
+            "SELECT username FROM users WHERE username LIKE 'bench\\_r%' ESCAPE '\\' AND deleted_at IS NULL "
+            "ORDER BY id LIMIT ?", (concurrency,))]
+        plan = conn.execute(
+            "SELECT pl.id FROM plans pl JOIN products p ON p.id = pl.product_id "
+            "WHERE pl.deleted_at IS NULL AND p.deleted_at IS NULL AND p.is_active = 1 ORDER BY pl.id LIMIT 1"
+        ).fetchone()
+    finally:
+        conn.close()
+    if not users or plan is None:
+        raise SystemExit("Banco sem revendedores/planos de benchmark: rode com --resellers/--products > 0.")
+    return users, plan[0]
+
+def purchase_ids_by_user(database, usernames):
+    conn = sqlite3.connect(database)
+    try:
+        rows = conn.execute(
+            "SELECT u.username, MAX(p.id) FROM purchases p JOIN users u ON u.id = p.reseller_id "
+            "WHERE u.username IN (SELECT value FROM json_each(?)) GROUP BY u.username",
+            (json.dumps(usernames),)
+        ).fetchall()
+    finally:
+        conn.close()
+    return dict(rows)
+
+def count_purchases(database):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM purchases").fetchone()[0]
+    finally:
+        conn.close()
+
+# --- Clientes (mesma interface para test client e HTTP) ---
+
+class TestClient:
+    """Test client do Flask, sem seguir redirecionamentos"""
+
+    def __init__(self, app):
+        self.app = app
+        self.client = app.test_client()
+
+    def reset(self):
+        self.client = self.app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+class HttpClient:
+    """Cliente HTTP mínimo (http.client) com cookies, sem seguir redirecionamentos"""
+
+    def __init__(self, port):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        self.cookies = {}
+
+    def reset(self):
+        self.cookies = {}
+
+    def request(self, method, path, data=None):
+        headers = {}
+        body = None
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+        if data is not None:
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = header.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        if response.getheader('Connection', '').lower() == 'close':
+            # Worker sync do gunicorn fecha a conexão; o http.client reabre na próxima
+            self.conn.close()
+        return response.status
+
+# --- Cenários ---
+
+def _login(client, username, password):
+    return client.request('POST', '/', {'username': username, 'password': password})
+
+def scenario_request(name, client, user, ctx):
+    """Executa uma requisição do cenário; devolve (status obtido, status esperado)"""
+    if name == 'login':
+        client.reset()
+        return _login(client, user, BENCH_PASSWORD), 302
+    if name == 'reseller_panel':
+        return client.request('GET', '/reseller'), 200
+    if name == 'purchase_product':
+        return client.request('POST', '/reseller/purchase',
+                              {'plan_id': ctx['plan_id'], 'idempotency_key': uuid.uuid4().hex}), 302
+    if name == 'get_download_link':
+        return client.request('GET', f"/reseller/download/{ctx['purchase_ids'][user]}"), 302
+    if name == 'admin_panel':
+        return client.request('GET', '/admin'), 200
+    raise ValueError(name)
+
+def percentile(sorted_values, p):
+    """Percentil por posição mais próxima (nearest-rank)"""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def run_scenario(name, make_client, users, ctx, requests, warmup):
+    """Divide 'requests' entre uma thread por usuário; latências em ms"""
+    latencies = []
+    errors = {}
+    lock = threading.Lock()
+    per_thread = [requests // len(users) + (1 if i < requests % len(users) else 0) for i in range(len(users))]
+    barrier = threading.Barrier(len(users) + 1)
+
+    def worker(user, count):
+        client = make_client()
+        if name != 'login':
+            login_user, password = ADMIN_LOGIN if name == 'admin_panel' else (user, BENCH_PASSWORD)
+            _login(client, login_user, password)
+        for _ in range(warmup):
+            scenario_request(name, client, user, ctx)
+        barrier.wait()
+        local, local_errors = [], {}
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                status, expected = scenario_request(name, client, user, ctx)
+            except (OSError, http.client.HTTPException) as e:
+                status, expected = type(e).__name__, None
+            local.append((time.perf_counter() - start) * 1000)
+            if status != expected:
+                local_errors[str(status)] = local_errors.get(str(status), 0) + 1
+        with lock:
+            latencies.extend(local)
+            for status, n in local_errors.items():
+                errors[status] = errors.get(status, 0) + n
+
+    threads = [threading.Thread(target=worker, args=(user, count), daemon=True)
+               for user, count in zip(users, per_thread)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors.values()),
+        'error_statuses': errors,
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        'p50_ms': round(percentile(latencies, 50), 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 2) if latencies else None,
+        'max_ms': round(latencies[-1], 2) if latencies else None,
+    }
+
+def run_suite(mode, make_client, database, args):
+    users, plan_id = bench_fixtures(database, args.concurrency)
+    ctx = {'plan_id': plan_id}
+    results = {}
+    for name in args.scenarios:
+        if name == 'get_download_link':
+            ctx['purchase_ids'] = purchase_ids_by_user(database, users)
+            missing = [u for u in users if u not in ctx['purchase_ids']]
+            if missing:
+                log(f"⚠️ [{mode}] get_download_link pulado: {len(missing)} revendedores sem compras "
+                    "(inclua purchase_product ou aumente --purchases).")
+                continue
+        before = count_purchases(database)
+        result = run_scenario(name, make_client, users, ctx, args.requests, args.warmup)
+        if name == 'purchase_product':
+            # Compra recusada também responde 302 (com flash): confere o que foi gravado
+            result['committed'] = count_purchases(database) - before - args.warmup * len(users)
+            result['errors'] += max(0, result['requests'] - result['committed'])
+        results[name] = result
+        log(f"⏱️ [{mode}] {name:<18} {result['rps']:>8} req/s  p50 {result['p50_ms']} ms  "
+            f"p95 {result['p95_ms']} ms  p99 {result['p99_ms']} ms  erros {result['errors']}")
+    return results
+
+# --- Gunicorn local ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@contextlib.contextmanager
+def gunicorn_server(env, args, workdir):
+    port = free_port()
+    log_path = os.path.join(workdir, 'gunicorn.log')
+    command = [sys.executable, '-m', 'gunicorn', '--chdir', ROOT, '--bind', f'127.0.0.1:{port}',
+               '--workers', str(args.workers), '--threads', str(args.threads),
+               '--log-level', 'warning', 'bench:app']
+    with open(log_path, 'wb') as log_file:
+        process = subprocess.Popen(command, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        try:
+            deadline = time.monotonic() + 30
+            while True:
+                if process.poll() is not None:
+                    with open(log_path, 'r', errors='replace') as f:
+                        raise SystemExit(f"gunicorn saiu com código {process.returncode}:\n{f.read()[-2000:]}")
+                try:
+                    with socket.create_connection(('127.0.0.1', port), timeout=1):
+                        break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise SystemExit("gunicorn não abriu a porta em 30 s.")
+                    time.sleep(0.1)
+            log(f"🦄 gunicorn em 127.0.0.1:{port} ({args.workers} workers × {args.threads} threads)")
+            yield port
+        finally:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+# --- Comparação com a baseline ---
+
+def compare(current, baseline, tolerance):
+    """Regressões: p95 acima de (1 + tolerância) × baseline ou vazão abaixo de (1 - tolerância) × baseline"""
+    regressions = []
+    for mode, scenarios in current['results'].items():
+        for name, result in scenarios.items():
+            base = baseline.get('results', {}).get(mode, {}).get(name)
+            if not base or not base.get('p95_ms') or not base.get('rps'):
+                continue
+            if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{mode}/{name}: p95 {base['p95_ms']} -> {result['p95_ms']} ms")
+            if result['rps'] < base['rps'] * (1 - tolerance):
+                regressions.append(f"{mode}/{name}: vazão {base['rps']} -> {result['rps']} req/s")
+            if result['errors'] and not base.get('errors'):
+                regressions.append(f"{mode}/{name}: {result['errors']} erros (baseline sem erros)")
+    if baseline.get('meta', {}).get('volumes') != current['meta']['volumes']:
+        log("⚠️ Volumes diferentes da baseline: a comparação não é direta.")
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dos caminhos quentes do painel.")
+    parser.add_argument('--mode', choices=('testclient', 'gunicorn', 'both'), default='testclient')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"lista separada por vírgulas (padrão: todos: {','.join(SCENARIOS)})")
+    parser.add_argument('--db', help="banco a usar (padrão: um temporário, semeado a cada execução)")
+    parser.add_argument('--reseed', action='store_true', help="apaga e semeia de novo o banco de --db")
+    parser.add_argument('--resellers', type=int, default=200)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--plans', type=int, default=3, help="planos por produto")
+    parser.add_argument('--purchases', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--requests', type=int, default=200, help="requisições medidas por cenário")
+    parser.add_argument('--warmup', type=int, default=3, help="requisições de aquecimento por thread")
+    parser.add_argument('--concurrency', type=int, default=4, help="threads cliente (um revendedor cada)")
+    parser.add_argument('--workers', type=int, default=2, help="workers do gunicorn")
+    parser.add_argument('--threads', type=int, default=1, help="threads por worker do gunicorn")
+    parser.add_argument('--output', help="grava o JSON neste arquivo (além do stdout)")
+    parser.add_argument('--baseline', help="compara com este JSON e sai com 1 se houver regressão")
+    parser.add_argument('--save-baseline', help="grava o resultado como nova baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="folga da comparação (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"cenários desconhecidos: {', '.join(sorted(unknown))}")
+    return args
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='panel-bench-')
+    try:
+        database = os.path.abspath(args.db) if args.db else os.path.join(workdir, 'reseller_panel.db')
+        if args.reseed and os.path.exists(database):
+            for suffix in ('', '-wal', '-shm'):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(database + suffix)
+        needs_seed = not os.path.exists(database)
+
+        env = {**os.environ, **BENCH_ENV, 'DATABASE': database}
+        env.setdefault('SLOW_QUERY_LOG', os.path.join(workdir, 'slow_queries.log'))
+        os.environ.update(env)
+        panel = load_panel()
+        if needs_seed:
+            seed_database(panel, args)
+        else:
+            with contextlib.redirect_stdout(sys.stderr):
+                panel.init_db()
+            log(f"📂 Usando o banco existente {database} (--reseed para semear de novo).")
+
+        report = {
+            'meta': {
+                'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'git': git_revision(),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'cpus': os.cpu_count(),
+                'password_hash_method': panel.PASSWORD_HASH_METHOD,
+                'volumes': {'resellers': args.resellers, 'products': args.products, 'plans': args.plans,
+                            'purchases': args.purchases, 'seed': args.seed},
+                'load': {'requests': args.requests, 'concurrency': args.concurrency, 'warmup': args.warmup,
+                         'workers': args.workers, 'threads': args.threads},
+            },
+            'results': {},
+        }
+
+        if args.mode in ('testclient', 'both'):
+            report['results']['testclient'] = run_suite('testclient', lambda: TestClient(panel.app), database, args)
+        if args.mode in ('gunicorn', 'both'):
+            # O processo do benchmark fica só como cliente: libera o banco para os workers
+            panel.db_pool.close_all()
+            with gunicorn_server(env, args, workdir) as port:
+                report['results']['gunicorn'] = run_suite('gunicorn', lambda: HttpClient(port), database, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    print(output)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(output + '\n')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            log("❌ Regressões em relação à baseline:")
+            for line in regressions:
+                log(f"   {line}")
+            return 1
+        log("✅ Sem regressões em relação à baseline.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,1174 @@
 import sqlite3
 import uuid
 import os
-from flask import Flask, render_template_string, request, jsonify, session, redirect, url_for, flash
+import base64
+import cProfile
+import csv
+import io
+import gzip
+import hashlib
+import hmac
+import math
+import multiprocessing
+import queue
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import json
+import logging
+import zlib
+from collections import OrderedDict
+from logging.handlers import RotatingFileHandler
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor
+from functools import lru_cache, wraps
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, flash, g
+from flask import send_from_directory
+from flask import before_render_template, template_rendered, has_request_context
+from flask.sessions import TaggedJSONSerializer
+from flask_session.sessions import ServerSideSession, ServerSideSessionInterface
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from jinja2 import DictLoader, FileSystemBytecodeCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from urllib.parse import quote
 
 app = Flask(__name__)
 app.secret_key = 'reseller_panel_secret_key_12345'
-DATABASE = 'reseller_panel.db'
+DATABASE = os.environ.get('DATABASE', 'reseller_panel.db')
+
+# Sessões no servidor: 'sqlite' (padrão, compartilhada entre workers),
+# 'memory' (LRU por processo, só para dev) ou 'cookie' (sessão assinada do Flask)
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'sqlite')
+SESSION_LIFETIME_HOURS = float(os.environ.get('SESSION_LIFETIME_HOURS', 12))
+SESSION_MEMORY_MAX_ENTRIES = int(os.environ.get('SESSION_MEMORY_MAX_ENTRIES', 10000))
+SESSION_CLEANUP_INTERVAL = int(os.environ.get('SESSION_CLEANUP_INTERVAL', 300))
+
+# Chaves de idempotência (compras/créditos): validade e tamanho máximo da tabela
+IDEMPOTENCY_TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+IDEMPOTENCY_MAX_ROWS = int(os.environ.get('IDEMPOTENCY_MAX_ROWS', 100000))
+IDEMPOTENCY_COMPACT_INTERVAL = int(os.environ.get('IDEMPOTENCY_COMPACT_INTERVAL', 600))
+
+# Exportações em streaming: linhas lidas do cursor por vez (memória constante)
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 1000))
+
+# Limpeza em segundo plano das exclusões (linhas por lote, pausa entre lotes, intervalo do job)
+PURGE_BATCH_ROWS = int(os.environ.get('PURGE_BATCH_ROWS', 500))
+PURGE_PAUSE_MS = int(os.environ.get('PURGE_PAUSE_MS', 20))
+PURGE_INTERVAL = int(os.environ.get('PURGE_INTERVAL', 5))
+# Um job de exclusão pertence a um worker só; sem progresso por este tempo, outro worker assume
+PURGE_CLAIM_TIMEOUT = int(os.environ.get('PURGE_CLAIM_TIMEOUT', 60))
+
+# Reconciliação do razão de saldos (segundos entre verificações incrementais)
+LEDGER_RECONCILE_INTERVAL = int(os.environ.get('LEDGER_RECONCILE_INTERVAL', 300))
+
+# Operações em lote (créditos / criação de revendedores): máximo de linhas por envio
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 5000))
+# Criação de revendedores paga um scrypt por senha (~5-6 linhas/s por CPU com o custo padrão):
+# o lote precisa caber com folga no timeout de 30 s do gunicorn
+BULK_RESELLERS_MAX_ROWS = int(os.environ.get('BULK_RESELLERS_MAX_ROWS', 100))
+
+# Hash de senhas: método/custo (formato do werkzeug) e pool de processos dedicado.
+# HASH_POOL_WORKERS=0 calcula na própria thread (útil em dev).
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+HASH_POOL_WORKERS = int(os.environ.get('HASH_POOL_WORKERS', min(4, os.cpu_count() or 1)))
+HASH_QUEUE_MAX = int(os.environ.get('HASH_QUEUE_MAX', max(HASH_POOL_WORKERS, 1) * 4))
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', 10))
+
+# Rate limit (token bucket): "capacidade/segundos", ex. "5/60" = rajada de 5, recarga de 5 por minuto.
+# 'sqlite' compartilha os baldes entre workers; 'memory' é por processo (testes/dev).
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'sqlite')
+LOGIN_IP_RATE_LIMIT = os.environ.get('LOGIN_IP_RATE_LIMIT', '20/60')
+LOGIN_USER_RATE_LIMIT = os.environ.get('LOGIN_USER_RATE_LIMIT', '5/60')
+PURCHASE_IP_RATE_LIMIT = os.environ.get('PURCHASE_IP_RATE_LIMIT', '60/60')
+PURCHASE_USER_RATE_LIMIT = os.environ.get('PURCHASE_USER_RATE_LIMIT', '30/60')
+RATE_LIMIT_CLEANUP_INTERVAL = int(os.environ.get('RATE_LIMIT_CLEANUP_INTERVAL', 300))
+
+# Proxies confiáveis na frente do app: o IP do cliente sai do X-Forwarded-For, senão todo
+# mundo cai no balde do IP do proxy. Padrão 0 (acesso direto: o cabeçalho é ignorado, senão
+# qualquer cliente forjaria um balde novo a cada tentativa). O Procfile liga 1 para o roteador do Heroku.
+PROXY_FIX_HOPS = int(os.environ.get('PROXY_FIX_HOPS', 0))
+if PROXY_FIX_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_HOPS, x_proto=PROXY_FIX_HOPS)
+
+# Cache de bytecode dos templates Jinja (compartilhado entre workers)
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+
+# Configuração do pool de conexões (por worker do gunicorn)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 8192))
+
+# Leituras roteadas (painéis, histórico, relatórios, exportações): 'off' (tudo na primária),
+# 'ro' (conexões mode=ro no mesmo arquivo, snapshot WAL por requisição) ou 'snapshot'
+# (cópia feita pela API de backup a cada DB_READ_SNAPSHOT_INTERVAL segundos). Escritas
+# ficam sempre na primária; depois de um POST, a sessão lê da primária até o snapshot alcançá-la.
+DB_READ_ROUTING = os.environ.get('DB_READ_ROUTING', 'off')
+DB_READ_POOL_SIZE = int(os.environ.get('DB_READ_POOL_SIZE', DB_POOL_SIZE))
+DB_READ_SNAPSHOT_PATH = os.environ.get('DB_READ_SNAPSHOT_PATH', DATABASE + '.read-snapshot')
+DB_READ_SNAPSHOT_INTERVAL = int(os.environ.get('DB_READ_SNAPSHOT_INTERVAL', 5))
+
+# Métricas Prometheus em /metrics: cada worker soma seus contadores na tabela
+# 'metrics' a cada METRICS_FLUSH_INTERVAL segundos. O scrape precisa de
+# "Authorization: Bearer <METRICS_TOKEN>"; sem METRICS_TOKEN definido, /metrics responde 404.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Log de consultas lentas: instruções acima de SLOW_QUERY_MS (0 desliga) vão para um
+# arquivo rotativo; a primeira ocorrência de cada uma também grava o EXPLAIN QUERY PLAN.
+# Os agregados vão para a tabela 'slow_queries' (página /admin/slow-queries).
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_LOG = os.environ.get('SLOW_QUERY_LOG', 'slow_queries.log')
+SLOW_QUERY_LOG_MAX_BYTES = int(os.environ.get('SLOW_QUERY_LOG_MAX_BYTES', 5 * 1024 * 1024))
+SLOW_QUERY_LOG_BACKUPS = int(os.environ.get('SLOW_QUERY_LOG_BACKUPS', 3))
+
+# Profiling sob demanda (só admin, desligado por padrão). Com PROFILING_ENABLED=1:
+# "X-Profile: 1" ou "?_profile=1" grava o cProfile da requisição em PROFILE_DIR, e o
+# painel /admin/profiling liga a amostragem de pilhas em todos os workers por N segundos.
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', '0') == '1'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_INTERVAL_MS = int(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 10))
+PROFILE_MAX_SECONDS = int(os.environ.get('PROFILE_MAX_SECONDS', 300))
+PROFILE_POLL_INTERVAL = int(os.environ.get('PROFILE_POLL_INTERVAL', 2))
+
+# Tentativas extras (com backoff) quando o SQLite responde "database is locked"
+PURCHASE_MAX_RETRIES = int(os.environ.get('PURCHASE_MAX_RETRIES', 5))
+PURCHASE_RETRY_BASE_DELAY = 0.01
+
+# Group commit das compras: uma thread escritora por worker grava numa única transação
+# todas as compras que chegaram enquanto o commit anterior rodava (até MAX_BATCH por vez).
+# WINDOW_MS > 0 ainda espera esse tempo por mais compras antes de gravar cada lote.
+# Só há o que juntar com requisições simultâneas no mesmo worker (gunicorn --threads).
+PURCHASE_GROUP_COMMIT = os.environ.get('PURCHASE_GROUP_COMMIT', '0') == '1'
+PURCHASE_GROUP_COMMIT_WINDOW_MS = float(os.environ.get('PURCHASE_GROUP_COMMIT_WINDOW_MS', 0))
+PURCHASE_GROUP_COMMIT_MAX_BATCH = int(os.environ.get('PURCHASE_GROUP_COMMIT_MAX_BATCH', 64))
+PURCHASE_GROUP_COMMIT_TIMEOUT = float(os.environ.get('PURCHASE_GROUP_COMMIT_TIMEOUT', 30))
+
+# Intervalo máximo (s) para um worker perceber sessões revogadas em outro worker
+SESSION_VERSION_CHECK_INTERVAL = float(os.environ.get('SESSION_VERSION_CHECK_INTERVAL', 1.0))
+
+# Paginação do histórico de compras (keyset em created_at, id)
+PURCHASE_PAGE_SIZE = int(os.environ.get('PURCHASE_PAGE_SIZE', 50))
+PURCHASE_PAGE_SIZE_MAX = 200
+
+# Paginação e busca do painel admin
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+AUTOCOMPLETE_LIMIT = 10
+
+# --- Métricas (formato Prometheus, somadas entre workers) ---
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+METRICS_HELP = {
+    'http_requests_total': ('counter', 'Requisições por rota, método e status.'),
+    'http_request_duration_seconds': ('histogram', 'Duração das requisições por rota (até a resposta ser montada).'),
+    'http_request_errors_total': ('counter', 'Respostas 5xx por rota.'),
+    'template_render_duration_seconds': ('histogram', 'Tempo de renderização por template.'),
+    'sqlite_statement_duration_seconds': ('histogram', 'Duração de execute/executemany/commit por instrução normalizada.'),
+    'sqlite_rows_total': ('counter', 'Linhas afetadas (escrita) ou lidas com fetch* (leitura) por instrução.'),
+    'sqlite_errors_total': ('counter', 'Erros do SQLite por instrução (COMMIT incluído).'),
+    'db_connect_duration_seconds': ('histogram', 'Tempo para abrir e configurar uma conexão nova do pool.'),
+    'db_pool_acquire_total': ('counter', 'Conexões pedidas ao pool (hit = reaproveitada, miss = nova).'),
+    'purchase_batch_size': ('histogram', 'Compras gravadas por transação no modo group commit.'),
+    'db_read_route_total': ('counter', 'Requisições de leitura por destino (replica ou primary).'),
+    'rate_limit_requests_total': ('counter', 'Consultas ao rate limiter por escopo (allowed ou throttled).'),
+}
+
+_SQL_SPACES = re.compile(r"\s+")
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_PARAM_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+
+@lru_cache(maxsize=2048)
+def normalize_sql(sql):
+    """Forma canônica da instrução: espaços colapsados, literais viram ? e listas '?, ?, ?' viram '?...'"""
+    sql = _SQL_SPACES.sub(' ', sql).strip()
+    sql = _SQL_LITERALS.sub('?', sql)
+    return _SQL_PARAM_LISTS.sub('?...', sql)
+
+def metric_labels(**labels):
+    """Rótulos no formato de exposição do Prometheus, em ordem fixa (a="x",b="y")"""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in sorted(labels.items()))
+
+class Metrics:
+    """
+    Contadores e histogramas acumulados em memória por processo e somados
+    (UPSERT value = value + delta) na tabela 'metrics' pelo flush(). O /metrics
+    lê a tabela, então o resultado é o total de todos os workers do gunicorn.
+    Cada série é guardada como (métrica, rótulos, le): os buckets cumulativos
+    do histograma, mais as pseudo-linhas 'sum' e 'count'; contadores usam le=''.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def inc(self, metric, labels='', value=1):
+        if not self.enabled:
+            return
+        key = (metric, labels, '')
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + value
+
+    def observe(self, metric, labels, seconds, buckets):
+        if not self.enabled:
+            return
+        with self._lock:
+            pending = self._pending
+            for le in buckets:
+                if seconds <= le:
+                    key = (metric, labels, repr(float(le)))
+                    pending[key] = pending.get(key, 0) + 1
+            for le, value in (('+Inf', 1), ('count', 1), ('sum', seconds)):
+                key = (metric, labels, le)
+                pending[key] = pending.get(key, 0) + value
+
+    def flush(self):
+        """Soma os deltas deste processo na tabela compartilhada"""
+        with self._lock:
+            deltas, self._pending = self._pending, {}
+        if not deltas:
+            return
+        conn = db_pool.acquire()
+        try:
+            # Métodos da classe base: o flush não deve gerar métricas de si mesmo
+            sqlite3.Connection.executemany(
+                conn,
+                "INSERT INTO metrics (metric, labels, le, value) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (metric, labels, le) DO UPDATE SET value = value + excluded.value",
+                [(metric, labels, le, value) for (metric, labels, le), value in deltas.items()]
+            )
+            sqlite3.Connection.commit(conn)
+        except Exception:
+            # Devolve os deltas para a próxima tentativa
+            with self._lock:
+                for key, value in deltas.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+            raise
+        finally:
+            db_pool.release(conn)
+
+    @staticmethod
+    def render(conn):
+        """Texto no formato de exposição do Prometheus (versão 0.0.4)"""
+        series = {}
+        for row in conn.execute("SELECT metric, labels, le, value FROM metrics ORDER BY metric, labels"):
+            series.setdefault(row['metric'], {}).setdefault(row['labels'], {})[row['le']] = row['value']
+
+        def fmt(value):
+            return str(int(value)) if float(value).is_integer() else repr(value)
+
+        def braces(*parts):
+            joined = ','.join(part for part in parts if part)
+            return f'{{{joined}}}' if joined else ''
+
+        lines = []
+        for metric, by_labels in series.items():
+            kind, help_text = METRICS_HELP.get(metric, ('untyped', ''))
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for labels, values in by_labels.items():
+                if kind != 'histogram':
+                    lines.append(f"{metric}{braces(labels)} {fmt(values.get('', 0))}")
+                    continue
+                bounds = sorted((le for le in values if le not in ('+Inf', 'sum', 'count')), key=float)
+                for le in bounds + ['+Inf']:
+                    bucket = braces(labels, metric_labels(le=le))
+                    lines.append(f"{metric}_bucket{bucket} {fmt(values.get(le, 0))}")
+                lines.append(f"{metric}_sum{braces(labels)} {fmt(values.get('sum', 0))}")
+                lines.append(f"{metric}_count{braces(labels)} {fmt(values.get('count', 0))}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(METRICS_ENABLED)
+
+class TracedCursor(sqlite3.Cursor):
+    """Cursor que soma as linhas lidas (fetchone/fetchmany/fetchall) na instrução de origem"""
+    statement = ''
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            metrics.inc('sqlite_rows_total', self.statement)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        metrics.inc('sqlite_rows_total', self.statement, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        metrics.inc('sqlite_rows_total', self.statement, len(rows))
+        return rows
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Conexão que mede execute/executemany/commit: histograma de latência, linhas
+    e erros por instrução normalizada. (Iterar o cursor com 'for' não conta linhas.)
+    """
+
+    def _traced(self, method, sql, parameters):
+        statement = normalize_sql(sql)
+        labels = metric_labels(statement=statement)
+        cursor = self.cursor(TracedCursor)
+        cursor.statement = labels
+        start = time.perf_counter()
+        try:
+            method(cursor, sql, parameters)
+        except sqlite3.Error:
+            metrics.inc('sqlite_errors_total', labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe('sqlite_statement_duration_seconds', labels, elapsed, SQL_BUCKETS)
+            if elapsed >= slow_queries.threshold:
+                slow_queries.record(self, sql, statement, parameters, elapsed,
+                                    many=method is sqlite3.Cursor.executemany)
+        if cursor.rowcount > 0:
+            metrics.inc('sqlite_rows_total', labels, cursor.rowcount)
+        return cursor
+
+    def execute(self, sql, parameters=(), /):
+        return self._traced(sqlite3.Cursor.execute, sql, parameters)
+
+    def executemany(self, sql, parameters, /):
+        return self._traced(sqlite3.Cursor.executemany, sql, parameters)
+
+    def commit(self):
+        labels = metric_labels(statement='COMMIT')
+        start = time.perf_counter()
+        try:
+            super().commit()
+        except sqlite3.Error:
+            # SQLITE_BUSY, disco cheio...: conta na mesma série de erros das instruções
+            metrics.inc('sqlite_errors_total', labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe('sqlite_statement_duration_seconds', labels, elapsed, SQL_BUCKETS)
+            if elapsed >= slow_queries.threshold:
+                slow_queries.record(self, 'COMMIT', 'COMMIT', (), elapsed)
+
+def _route_label():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = _route_label()
+        metrics.observe('http_request_duration_seconds', metric_labels(method=request.method, route=route),
+                        time.perf_counter() - started, HTTP_BUCKETS)
+        metrics.inc('http_requests_total', metric_labels(method=request.method, route=route,
+                                                         status=response.status_code))
+        if response.status_code >= 500:
+            metrics.inc('http_request_errors_total', metric_labels(route=route))
+    return response
+
+@before_render_template.connect_via(app)
+def _template_render_started(sender, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _template_render_finished(sender, template, context, **extra):
+    started = g.template_started.pop()
+    metrics.observe('template_render_duration_seconds', metric_labels(template=template.name),
+                    time.perf_counter() - started, HTTP_BUCKETS)
+
+# --- Consultas Lentas (log rotativo + EXPLAIN QUERY PLAN) ---
+
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+def _caller_label():
+    """Rota da requisição atual ou, fora dela, o nome da thread (ex.: a tarefa periódica)"""
+    if has_request_context():
+        return f"{request.method} {_route_label()}"
+    return f"thread:{threading.current_thread().name}"
+
+def _param_count(parameters):
+    """Parâmetros da instrução; no executemany, o número de linhas do lote"""
+    try:
+        return len(parameters)
+    except TypeError:
+        return None  # gerador (executemany): já consumido, tamanho desconhecido
+
+def _format_plan(rows):
+    """Saída do EXPLAIN QUERY PLAN em árvore, como no shell do sqlite3"""
+    depth = {0: -1}
+    lines = []
+    for row in rows:
+        depth[row['id']] = depth.get(row['parent'], -1) + 1
+        lines.append('  ' * depth[row['id']] + row['detail'])
+    return '\n'.join(lines)
+
+class SlowQueryLog:
+    """
+    Instruções que passaram do limite: cada ocorrência vai para o log rotativo
+    (SQL normalizado, nº de parâmetros, duração e rota) e é somada em memória;
+    flush() acumula os totais na tabela 'slow_queries', compartilhada entre workers.
+    A primeira ocorrência de cada instrução no processo também grava o plano.
+    """
+
+    def __init__(self, threshold_ms, path, max_bytes, backups):
+        self.threshold = threshold_ms / 1000 if threshold_ms > 0 else math.inf
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._explained = set()
+        self._logger = None
+
+    def _get_logger(self):
+        # Criado só na primeira consulta lenta: sem lentas, nenhum arquivo é aberto
+        if self._logger is None:
+            logger = logging.getLogger('slow_queries')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            if not logger.handlers:
+                handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                              backupCount=self.backups, encoding='utf-8')
+                handler.setFormatter(logging.Formatter('%(asctime)s pid=%(process)d %(message)s'))
+                logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def _explain(self, conn, sql, parameters, many):
+        if not _EXPLAINABLE.match(sql):
+            return None
+        if many:
+            # Plano igual para todas as linhas do lote: basta a primeira (se ainda existir)
+            if not isinstance(parameters, (list, tuple)) or not parameters:
+                return None
+            parameters = parameters[0]
+        try:
+            # Método da classe base: o EXPLAIN não deve ser medido nem logado
+            rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+        except (sqlite3.Error, ValueError) as e:
+            return f"(EXPLAIN falhou: {e})"
+        return _format_plan(rows)
+
+    def record(self, conn, sql, statement, parameters, seconds, many=False):
+        duration_ms = round(seconds * 1000, 2)
+        caller = _caller_label()
+        params = _param_count(parameters)
+        with self._lock:
+            first = statement not in self._explained
+            self._explained.add(statement)
+        plan = self._explain(conn, sql, parameters, many) if first else None
+
+        logger = self._get_logger()
+        logger.warning("slow %.2fms route=%s params=%s%s sql=%s", duration_ms, caller,
+                       params, ' (lote)' if many else '', statement)
+        if plan is not None:
+            logger.warning("plan sql=%s\n%s", statement, plan)
+
+        now = time.time()
+        with self._lock:
+            entry = self._pending.get(statement)
+            if entry is None:
+                entry = self._pending[statement] = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                                    'plan': None, 'first_seen': now}
+            entry['calls'] += 1
+            entry['total_ms'] += duration_ms
+            entry['max_ms'] = max(entry['max_ms'], duration_ms)
+            entry.update(last_ms=duration_ms, params=params, route=caller, last_seen=now)
+            if plan is not None:
+                entry['plan'] = plan
+
+    def flush(self):
+        """Soma as ocorrências deste processo na tabela compartilhada"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        conn = db_pool.acquire()
+        try:
+            # Métodos da classe base, como em Metrics.flush
+            sqlite3.Connection.executemany(
+                conn,
+                "INSERT INTO slow_queries (statement, calls, total_ms, max_ms, last_ms, params, route, "
+                "plan, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (statement) DO UPDATE SET calls = calls + excluded.calls, "
+                "total_ms = total_ms + excluded.total_ms, max_ms = MAX(max_ms, excluded.max_ms), "
+                "last_ms = excluded.last_ms, params = excluded.params, route = excluded.route, "
+                "plan = COALESCE(excluded.plan, plan), last_seen = excluded.last_seen",
+                [(statement, e['calls'], e['total_ms'], e['max_ms'], e['last_ms'], e['params'], e['route'],
+                  e['plan'], e['first_seen'], e['last_seen']) for statement, e in pending.items()]
+            )
+            sqlite3.Connection.commit(conn)
+        except Exception:
+            # Devolve as ocorrências para o próximo flush
+            with self._lock:
+                for statement, e in pending.items():
+                    current = self._pending.get(statement)
+                    if current is None:
+                        self._pending[statement] = e
+                    else:
+                        current['calls'] += e['calls']
+                        current['total_ms'] += e['total_ms']
+                        current['max_ms'] = max(current['max_ms'], e['max_ms'])
+                        current['plan'] = current['plan'] or e['plan']
+                        current['first_seen'] = e['first_seen']
+            raise
+        finally:
+            db_pool.release(conn)
+
+slow_queries = SlowQueryLog(SLOW_QUERY_MS, SLOW_QUERY_LOG, SLOW_QUERY_LOG_MAX_BYTES, SLOW_QUERY_LOG_BACKUPS)
+
+SLOW_QUERY_ORDERS = {
+    'total': 'total_ms DESC',
+    'max': 'max_ms DESC',
+    'calls': 'calls DESC',
+    'recent': 'last_seen DESC',
+}
+
+def slow_query_report(conn, order='total', limit=50):
+    """Piores instruções (por tempo total, pior caso, ocorrências ou mais recentes)"""
+    rows = conn.execute(
+        f"SELECT * FROM slow_queries ORDER BY {SLOW_QUERY_ORDERS[order]} LIMIT ?", (limit,)
+    ).fetchall()
+    return [{'statement': r['statement'], 'calls': r['calls'],
+             'total_ms': round(r['total_ms'], 1), 'avg_ms': round(r['total_ms'] / r['calls'], 1),
+             'max_ms': round(r['max_ms'], 1), 'last_ms': round(r['last_ms'], 1),
+             'params': r['params'], 'route': r['route'], 'plan': r['plan'],
+             'first_seen': datetime.fromtimestamp(r['first_seen'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+             'last_seen': datetime.fromtimestamp(r['last_seen'], timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}
+            for r in rows]
+
+# --- Profiling (cProfile por requisição + amostragem de pilhas) ---
+
+def _profile_path(kind, label, extension):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    label = re.sub(r'[^A-Za-z0-9_.-]+', '_', label).strip('_') or 'root'
+    return os.path.join(PROFILE_DIR, f"{kind}-{stamp}-{os.getpid()}-{label}.{extension}")
+
+@app.before_request
+def start_request_profile():
+    if not PROFILING_ENABLED:
+        return
+    if request.headers.get('X-Profile') != '1' and request.args.get('_profile') != '1':
+        return
+    user = current_user()
+    if user is None or user['role'] != 'admin':
+        return
+    g.request_profile = cProfile.Profile()
+    g.request_profile.enable()
+
+def _finish_request_profile():
+    """Para o cProfile da requisição (se houver) e grava o .prof; retorna o nome do arquivo"""
+    profile = g.pop('request_profile', None)
+    if profile is None:
+        return None
+    profile.disable()
+    path = _profile_path('request', f"{request.method}_{_route_label()}", 'prof')
+    profile.dump_stats(path)
+    return os.path.basename(path)
+
+@app.after_request
+def stop_request_profile(response):
+    name = _finish_request_profile()
+    if name:
+        response.headers['X-Profile-File'] = name
+    return response
+
+@app.teardown_request
+def discard_request_profile(exception):
+    # Exceção não tratada: o after_request não roda, mas o perfil ainda é útil
+    _finish_request_profile()
+
+@lru_cache(maxsize=8192)
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """
+    Amostragem de pilhas de todas as threads do processo (sys._current_frames) a
+    cada PROFILE_SAMPLE_INTERVAL_MS, por um tempo limitado. O resultado sai no
+    formato "collapsed" (quadro;quadro;... contagem), pronto para flamegraph.pl,
+    speedscope ou inferno. Uma amostragem por vez em cada processo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = False
+        self._handled = set()
+
+    def start(self, run_id, until, interval_ms):
+        with self._lock:
+            if self._active or run_id in self._handled:
+                return False
+            self._active = True
+            self._handled.add(run_id)
+        threading.Thread(target=self._run, args=(run_id, until, interval_ms / 1000),
+                         name='stack-sampler', daemon=True).start()
+        return True
+
+    def _run(self, run_id, until, interval):
+        counts = {}
+        samples = 0
+        me = threading.get_ident()
+        try:
+            while time.time() < until:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_label(frame.f_code))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, f'thread-{ident}'))
+                    key = ';'.join(reversed(stack))
+                    counts[key] = counts.get(key, 0) + 1
+                samples += 1
+                time.sleep(interval)
+            path = _profile_path('sample', f'run{run_id}', 'collapsed')
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(counts.items()):
+                    f.write(f"{stack} {count}\n")
+            print(f"🔬 Amostragem #{run_id}: {samples} amostras gravadas em {path}")
+        finally:
+            with self._lock:
+                self._active = False
+
+stack_sampler = StackSampler()
+
+def watch_profiler_runs():
+    """Tarefa periódica: começa neste worker a amostragem pedida no painel (tabela profiler_runs)"""
+    conn = db_pool.acquire()
+    try:
+        run = conn.execute("SELECT id, until, interval_ms FROM profiler_runs WHERE until > ? "
+                           "ORDER BY id DESC LIMIT 1", (time.time(),)).fetchone()
+    finally:
+        db_pool.release(conn)
+    if run is not None:
+        stack_sampler.start(run['id'], run['until'], run['interval_ms'])
+
+def profile_files(limit=100):
+    """Arquivos de PROFILE_DIR, mais recentes primeiro"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    entries = [e for e in os.scandir(PROFILE_DIR) if e.is_file() and e.name.endswith(('.prof', '.collapsed'))]
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    return [{'name': e.name, 'size_kb': round(e.stat().st_size / 1024, 1),
+             'modified': datetime.fromtimestamp(e.stat().st_mtime, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}
+            for e in entries[:limit]]
+
+def request_sampling(conn, seconds, username):
+    """Registra a amostragem para todos os workers e já começa neste"""
+    now = time.time()
+    cur = conn.execute("INSERT INTO profiler_runs (requested_by, started_at, until, interval_ms) VALUES (?, ?, ?, ?)",
+                       (username, now, now + seconds, PROFILE_SAMPLE_INTERVAL_MS))
+    conn.commit()
+    stack_sampler.start(cur.lastrowid, now + seconds, PROFILE_SAMPLE_INTERVAL_MS)
+    return cur.lastrowid
 
 # --- 1. Inicialização do Banco de Dados (COM SEU NOVO LOGIN) ---
 
+class ConnectionPool:
+    """
+    Pool limitado de conexões SQLite, reutilizadas entre requisições.
+    Cada conexão é configurada (PRAGMAs) uma única vez, ao ser criada.
+    """
+
+    def __init__(self, database, max_size, readonly=False):
+        self.database = database
+        self.max_size = max_size
+        self.readonly = readonly
+        self.hits = 0
+        self.misses = 0
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _connect(self):
+        start = time.perf_counter()
+        factory = TracedConnection if METRICS_ENABLED or SLOW_QUERY_MS > 0 else sqlite3.Connection
+        if self.readonly:
+            # mode=ro: o próprio SQLite recusa qualquer escrita por esta conexão
+            conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.database))}?mode=ro", uri=True,
+                                   timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False, factory=factory)
+        else:
+            conn = sqlite3.connect(self.database, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                                   check_same_thread=False, factory=factory)
+        conn.row_factory = sqlite3.Row
+        if not self.readonly:
+            # Habilitar chaves estrangeiras é essencial para 'ON DELETE CASCADE'
+            conn.execute("PRAGMA foreign_keys = ON")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        metrics.observe('db_connect_duration_seconds', '', time.perf_counter() - start, SQL_BUCKETS)
+        return conn
+
+    def _check_fork(self):
+        # Conexões herdadas de outro processo (fork do gunicorn) não podem ser usadas
+        if self._pid != os.getpid():
+            self._idle = []
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def acquire(self):
+        """Retorna uma conexão ociosa do pool ou abre uma nova"""
+        self._check_fork()
+        with self._lock:
+            if self._idle:
+                self.hits += 1
+                metrics.inc('db_pool_acquire_total', 'result="hit"')
+                return self._idle.pop()
+            self.misses += 1
+        metrics.inc('db_pool_acquire_total', 'result="miss"')
+        return self._connect()
+
+    def release(self, conn):
+        """Devolve a conexão ao pool (ou fecha, se o pool estiver cheio)"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.max_size, 'idle': len(self._idle),
+                    'hits': self.hits, 'misses': self.misses}
+
+db_pool = ConnectionPool(DATABASE, DB_POOL_SIZE)
+
 def get_db():
-    """Conecta ao banco de dados"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Conexão do pool associada ao contexto da aplicação (devolvida no teardown)"""
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+    routed = g.pop('read_db', None)
+    if routed is not None:
+        pool, conn = routed
+        pool.release(conn)
+
+# --- Leituras Roteadas (réplica mode=ro ou snapshot via API de backup) ---
+
+class ReadRouter:
+    """
+    Pools só de leitura para as páginas que não escrevem. Em 'ro', o próprio banco
+    aberto com mode=ro: no WAL, cada transação de leitura vê um snapshot consistente
+    e já enxerga tudo o que foi commitado. Em 'snapshot', uma cópia feita pela API
+    de backup e trocada de forma atômica (os.replace); pode estar até
+    DB_READ_SNAPSHOT_INTERVAL segundos atrasada.
+    """
+
+    def __init__(self, mode, database, snapshot_path, pool_size):
+        if mode not in ('off', 'ro', 'snapshot'):
+            raise ValueError(f"DB_READ_ROUTING inválido: {mode!r} (use off, ro ou snapshot)")
+        self.mode = mode
+        self.snapshot_path = snapshot_path
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        # (identidade do arquivo, pool, instante em que os dados foram copiados)
+        if mode == 'ro':
+            self._current = (None, ConnectionPool(database, pool_size, readonly=True), math.inf)
+        else:
+            self._current = (None, None, 0)
+
+    def _snapshot_pool(self):
+        """Pool do snapshot atual; troca de pool quando outro arquivo é colocado no lugar"""
+        try:
+            st = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None, 0
+        file_id = (st.st_ino, st.st_mtime)
+        if file_id != self._current[0]:
+            with self._lock:
+                if file_id != self._current[0]:
+                    old_pool = self._current[1]
+                    self._current = (file_id, ConnectionPool(self.snapshot_path, self.pool_size, readonly=True),
+                                     st.st_mtime)
+                    if old_pool is not None:
+                        # Conexões ainda em uso no pool antigo são fechadas ao voltar
+                        old_pool.max_size = 0
+                        old_pool.close_all()
+        return self._current[1], self._current[2]
+
+    def acquire(self, wrote_at=0):
+        """(pool, conexão) de leitura, ou None quando a leitura deve ir para a primária"""
+        if self.mode == 'off':
+            return None
+        if self.mode == 'ro':
+            pool, taken_at = self._current[1], self._current[2]
+        else:
+            pool, taken_at = self._snapshot_pool()
+        # Read-your-writes: o snapshot precisa ter sido copiado depois da última escrita da sessão
+        if pool is None or wrote_at >= taken_at:
+            return None
+        return pool, pool.acquire()
+
+    def refresh_snapshot(self):
+        """Copia a primária para um arquivo temporário (API de backup) e troca pelo snapshot"""
+        # Um worker só faz a cópia; se ele parar, a concessão vence e outro assume
+        if not claim_lease('read-snapshot', DB_READ_SNAPSHOT_INTERVAL * 2):
+            return
+        started = time.time()
+        tmp_path = f"{self.snapshot_path}.tmp-{os.getpid()}"
+        source = db_pool.acquire()
+        try:
+            target = sqlite3.connect(tmp_path)
+            try:
+                # Um passo só: a cópia inteira sai do mesmo snapshot da primária
+                source.backup(target)
+                # Sem WAL na cópia: conexões mode=ro não precisam criar -wal/-shm
+                target.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                target.close()
+            # mtime = início da cópia: é a partir dele que a sessão pode voltar ao snapshot
+            os.utime(tmp_path, (started, started))
+            os.replace(tmp_path, self.snapshot_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            db_pool.release(source)
+
+read_router = ReadRouter(DB_READ_ROUTING, DATABASE, DB_READ_SNAPSHOT_PATH, DB_READ_POOL_SIZE)
+
+def get_read_db():
+    """
+    Conexão para as leituras da requisição: a réplica (DB_READ_ROUTING) numa
+    transação de leitura (todas as consultas da página veem o mesmo snapshot), ou
+    a primária se o roteamento está desligado ou a sessão escreveu algo que o
+    snapshot ainda não tem.
+    """
+    if 'read_db' not in g:
+        routed = read_router.acquire(session.get('last_write_at', 0)) if read_router.mode != 'off' else None
+        if routed is not None:
+            routed[1].execute("BEGIN")
+        if read_router.mode != 'off':
+            metrics.inc('db_read_route_total', metric_labels(target='replica' if routed else 'primary'))
+        g.read_db = routed
+    return g.read_db[1] if g.read_db else get_db()
+
+def note_write():
+    """
+    Marca que a sessão da requisição atual acabou de escrever: as leituras dela vão
+    para a primária até o próximo snapshot. Chamada pelas escritas compartilhadas
+    (compras, créditos, lotes) logo depois do commit; fora de requisição não faz nada.
+    """
+    if read_router.mode == 'snapshot' and has_request_context() and session.get('user_id'):
+        session['last_write_at'] = time.time()
+
+@app.after_request
+def remember_last_write(response):
+    # Rede de segurança para os demais POSTs (exclusões, edições do catálogo...)
+    if request.method == 'POST':
+        note_write()
+    return response
+
+# --- Migrações de Schema (versionadas via PRAGMA user_version) ---
+
+# Recalcula os rollups diários de vendas a partir de purchases (migração v11 e comando backfill-rollups)
+SALES_ROLLUP_INSERT_SQL = "INSERT INTO sales_daily (day, product_id, plan_id, reseller_id, purchases, revenue_cents) "
+SALES_ROLLUP_SELECT_SQL = (
+    "SELECT date(p.created_at) AS day, pl.product_id, p.plan_id, p.reseller_id, COUNT(*), "
+    "SUM(CAST(ROUND(p.cost_paid * 100) AS INTEGER)) "
+    "FROM purchases p JOIN plans pl ON pl.id = p.plan_id "
+    "GROUP BY 1, 2, 3, 4"
+)
+SALES_ROLLUP_BACKFILL_SQL = SALES_ROLLUP_INSERT_SQL + SALES_ROLLUP_SELECT_SQL
+
+# Cada item é a lista de comandos de uma versão; a posição na lista (1, 2, ...)
+# é o número gravado em user_version. Só adicione no final, nunca altere as antigas.
+MIGRATIONS = [
+    # v1: índices das consultas quentes (histórico do revendedor, planos, lista de revendedores)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_purchases_reseller_created ON purchases (reseller_id, created_at DESC)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_plans_product_name ON plans (product_id, name)",
+        "CREATE INDEX IF NOT EXISTS idx_users_role_username ON users (role, username)",
+    ],
+    # v2: índice cobre o desempate por id da paginação keyset do histórico
+    [
+        "CREATE INDEX IF NOT EXISTS idx_purchases_reseller_created_id ON purchases (reseller_id, created_at DESC, id DESC)",
+        "DROP INDEX IF EXISTS idx_purchases_reseller_created",
+    ],
+    # v3: busca por prefixo e paginação dos produtos no painel admin
+    [
+        "CREATE INDEX IF NOT EXISTS idx_products_name ON products (name)",
+    ],
+    # v4: contadores de geração dos caches em memória (invalidação entre workers)
+    [
+        "CREATE TABLE IF NOT EXISTS cache_generations ("
+        " name TEXT PRIMARY KEY,"
+        " generation INTEGER NOT NULL DEFAULT 0"
+        ")",
+        "INSERT OR IGNORE INTO cache_generations (name, generation) VALUES ('catalog', 0)",
+    ],
+    # v5: versão de sessão por usuário (revogação sem consultar users a cada request)
+    [
+        "ALTER TABLE users ADD COLUMN session_version INTEGER NOT NULL DEFAULT 0",
+        "INSERT OR IGNORE INTO cache_generations (name, generation) VALUES ('users', 0)",
+    ],
+    # v6: sessões no servidor (o cookie leva só o id da sessão)
+    [
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        " sid TEXT PRIMARY KEY,"
+        " data TEXT NOT NULL,"
+        " expires_at REAL NOT NULL"
+        ") WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)",
+    ],
+    # v7: baldes do rate limiter compartilhados entre workers
+    [
+        "CREATE TABLE IF NOT EXISTS rate_limits ("
+        " key TEXT PRIMARY KEY,"
+        " tokens REAL NOT NULL,"
+        " updated_at REAL NOT NULL"
+        ") WITHOUT ROWID",
+    ],
+    # v8: chaves de idempotência (respostas gravadas para replays seguros)
+    [
+        "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+        " user_id INTEGER NOT NULL,"
+        " key TEXT NOT NULL,"
+        " fingerprint TEXT NOT NULL,"
+        " response TEXT NOT NULL,"
+        " created_at REAL NOT NULL,"
+        " PRIMARY KEY (user_id, key),"
+        " FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE"
+        ") WITHOUT ROWID",
+    ],
+    # v9: compactação das chaves de idempotência por idade
+    [
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at)",
+    ],
+    # v10: razão append-only em centavos; users.balance(_cents) vira valor materializado.
+    # Sem FK para users: o histórico continua lá depois que o revendedor é excluído.
+    [
+        "CREATE TABLE IF NOT EXISTS ledger ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " user_id INTEGER NOT NULL,"
+        " amount_cents INTEGER NOT NULL,"
+        " kind TEXT NOT NULL,"
+        " purchase_id INTEGER,"
+        " created_at TEXT DEFAULT CURRENT_TIMESTAMP"
+        ")",
+        "CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (user_id, id)",
+        "CREATE TRIGGER IF NOT EXISTS ledger_no_update BEFORE UPDATE ON ledger "
+        "BEGIN SELECT RAISE(ABORT, 'ledger é append-only'); END",
+        "CREATE TRIGGER IF NOT EXISTS ledger_no_delete BEFORE DELETE ON ledger "
+        "BEGIN SELECT RAISE(ABORT, 'ledger é append-only'); END",
+        "ALTER TABLE users ADD COLUMN balance_cents INTEGER NOT NULL DEFAULT 0",
+        "UPDATE users SET balance_cents = CAST(ROUND(balance * 100) AS INTEGER), "
+        "balance = ROUND(balance * 100) / 100.0",
+        "INSERT INTO ledger (user_id, amount_cents, kind) "
+        "SELECT id, balance_cents, 'opening' FROM users WHERE balance_cents != 0",
+        # Acumulado por usuário até last_entry_id (reconciliação incremental)
+        "CREATE TABLE IF NOT EXISTS ledger_totals ("
+        " user_id INTEGER PRIMARY KEY,"
+        " total_cents INTEGER NOT NULL"
+        ")",
+        "CREATE TABLE IF NOT EXISTS ledger_checkpoint ("
+        " id INTEGER PRIMARY KEY CHECK (id = 1),"
+        " last_entry_id INTEGER NOT NULL,"
+        " checked_at REAL"
+        ")",
+        "INSERT OR IGNORE INTO ledger_checkpoint (id, last_entry_id) VALUES (1, 0)",
+    ],
+    # v11: rollups diários de vendas (relatórios sem varrer purchases). Sem FK:
+    # a receita de produtos/revendedores excluídos continua nos relatórios.
+    [
+        "CREATE TABLE IF NOT EXISTS sales_daily ("
+        " day TEXT NOT NULL,"
+        " product_id INTEGER NOT NULL,"
+        " plan_id INTEGER NOT NULL,"
+        " reseller_id INTEGER NOT NULL,"
+        " purchases INTEGER NOT NULL,"
+        " revenue_cents INTEGER NOT NULL,"
+        " PRIMARY KEY (day, product_id, plan_id, reseller_id)"
+        ") WITHOUT ROWID",
+        SALES_ROLLUP_BACKFILL_SQL,
+    ],
+    # v12: exclusão lógica (deleted_at) + fila da limpeza em lotes dos dependentes
+    [
+        "ALTER TABLE users ADD COLUMN deleted_at TEXT",
+        "ALTER TABLE products ADD COLUMN deleted_at TEXT",
+        "ALTER TABLE plans ADD COLUMN deleted_at TEXT",
+        # O nome do plano só precisa ser único entre os planos não excluídos
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_plans_product_name_live ON plans (product_id, name) "
+        "WHERE deleted_at IS NULL",
+        "DROP INDEX IF EXISTS idx_plans_product_name",
+        # Sem ele cada lote da limpeza de um plano varreria purchases inteira
+        "CREATE INDEX IF NOT EXISTS idx_purchases_plan ON purchases (plan_id)",
+        "CREATE TABLE IF NOT EXISTS purge_jobs ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " kind TEXT NOT NULL,"
+        " target_id INTEGER NOT NULL,"
+        " label TEXT NOT NULL,"
+        " total_rows INTEGER,"
+        " deleted_rows INTEGER NOT NULL DEFAULT 0,"
+        " created_at REAL NOT NULL,"
+        " finished_at REAL"
+        ")",
+        "CREATE INDEX IF NOT EXISTS idx_purge_jobs_pending ON purge_jobs (id) WHERE finished_at IS NULL",
+    ],
+    # v13: métricas somadas de todos os workers (ver Metrics.flush)
+    [
+        "CREATE TABLE IF NOT EXISTS metrics ("
+        " metric TEXT NOT NULL,"
+        " labels TEXT NOT NULL,"
+        " le TEXT NOT NULL,"
+        " value REAL NOT NULL,"
+        " PRIMARY KEY (metric, labels, le)"
+        ") WITHOUT ROWID",
+    ],
+    # v14: consultas lentas agregadas de todos os workers (ver SlowQueryLog.flush)
+    [
+        "CREATE TABLE IF NOT EXISTS slow_queries ("
+        " statement TEXT PRIMARY KEY,"
+        " calls INTEGER NOT NULL,"
+        " total_ms REAL NOT NULL,"
+        " max_ms REAL NOT NULL,"
+        " last_ms REAL NOT NULL,"
+        " params INTEGER,"
+        " route TEXT,"
+        " plan TEXT,"
+        " first_seen REAL NOT NULL,"
+        " last_seen REAL NOT NULL"
+        ")",
+    ],
+    # v15: amostragens de profiling pedidas no painel (cada worker consulta e participa)
+    [
+        "CREATE TABLE IF NOT EXISTS profiler_runs ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " requested_by TEXT,"
+        " started_at REAL NOT NULL,"
+        " until REAL NOT NULL,"
+        " interval_ms INTEGER NOT NULL"
+        ")",
+    ],
+    # v16: limpeza periódica dos baldes parados (ver RateLimiter.purge_idle)
+    [
+        "CREATE INDEX IF NOT EXISTS idx_rate_limits_updated ON rate_limits (updated_at)",
+    ],
+    # v17: revendedores já excluídos liberam o username (ver soft_delete)
+    [
+        "UPDATE users SET username = '#excluido-' || id || '-' || username "
+        "WHERE deleted_at IS NOT NULL AND username NOT LIKE '#excluido-%'",
+    ],
+    # v18: tarefas periódicas feitas por um worker só (posse do job de exclusão / concessões)
+    [
+        "ALTER TABLE purge_jobs ADD COLUMN claimed_by TEXT",
+        "ALTER TABLE purge_jobs ADD COLUMN claimed_at REAL",
+        "CREATE TABLE IF NOT EXISTS job_leases ("
+        " name TEXT PRIMARY KEY,"
+        " holder TEXT NOT NULL,"
+        " until REAL NOT NULL"
+        ") WITHOUT ROWID",
+    ],
+]
+
+def migrate_db(conn):
+    """Aplica, em ordem e cada uma na sua transação, as migrações ainda não aplicadas"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN")
+        for sql in statements:
+            conn.execute(sql)
+        conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+        print(f"🔧 Migração v{number} aplicada.")
+
+# Consultas quentes que NUNCA podem voltar a varrer a tabela inteira
+HOT_QUERIES = {
+    'historico_revendedor': (
+        "SELECT p.*, pl.name as plan_name, pr.name as product_name "
+        "FROM purchases p "
+        "JOIN plans pl ON pl.id = p.plan_id "
+        "JOIN products pr ON pr.id = pl.product_id "
+        "WHERE p.reseller_id = ? AND pl.deleted_at IS NULL AND pr.deleted_at IS NULL "
+        "ORDER BY p.created_at DESC, p.id DESC LIMIT ?",
+        (1, 51)
+    ),
+    'historico_revendedor_pagina': (
+        "SELECT p.*, pl.name as plan_name, pr.name as product_name "
+        "FROM purchases p "
+        "JOIN plans pl ON pl.id = p.plan_id "
+        "JOIN products pr ON pr.id = pl.product_id "
+        "WHERE p.reseller_id = ? AND pl.deleted_at IS NULL AND pr.deleted_at IS NULL "
+        "AND (p.created_at, p.id) < (?, ?) "
+        "ORDER BY p.created_at DESC, p.id DESC LIMIT ?",
+        (1, '2024-01-01 00:00:00', 1, 51)
+    ),
+    'plano_por_nome': (
+        "SELECT * FROM plans WHERE product_id = ? AND name = ? AND deleted_at IS NULL",
+        (1, 'Mensal')
+    ),
+    'lista_revendedores': (
+        "SELECT id, username, balance FROM users WHERE role = 'reseller' AND deleted_at IS NULL "
+        "AND username >= ? AND username < ? AND username > ? ORDER BY username LIMIT ?",
+        ('rev', 'rev\U0010ffff', 'revendedor1', 51)
+    ),
+    'lista_produtos': (
+        "SELECT * FROM products WHERE deleted_at IS NULL AND name >= ? AND name < ? "
+        "AND (name, id) > (?, ?) ORDER BY name, id LIMIT ?",
+        ('Che', 'Che\U0010ffff', 'Cheat', 1, 51)
+    ),
+    'limpeza_plano': (
+        "SELECT id FROM purchases WHERE plan_id = ? LIMIT ?",
+        (1, 500)
+    ),
+    'vendas_produto_dia': (
+        "SELECT day, product_id, SUM(purchases), SUM(revenue_cents) FROM sales_daily "
+        "WHERE day >= ? AND day <= ? GROUP BY day, product_id",
+        ('2024-01-01', '2024-01-31')
+    ),
+}
+
+class QueryPlanRegression(Exception):
+    """Uma consulta quente passou a fazer full scan (ou ordenação em memória)"""
+
+def check_query_plans(conn):
+    """Roda EXPLAIN QUERY PLAN nas consultas quentes e falha se alguma regrediu"""
+    problems = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row['detail']
+            if detail.startswith('SCAN ') or 'TEMP B-TREE' in detail:
+                problems.append(f"{name}: {detail}")
+    if problems:
+        raise QueryPlanRegression("; ".join(problems))
+    print(f"✅ Planos de consulta verificados ({len(HOT_QUERIES)} consultas quentes usam índice).")
 
 def init_db():
     """
@@ -23,12 +1176,9 @@ def init_db():
     para permitir exclusões corretas.
     """
     print("🚀 Verificando o banco de dados (v4.1 - Final Corrigido)...")
-    conn = get_db()
+    conn = db_pool.acquire()
     c = conn.cursor()
     
-    # Habilitar chaves estrangeiras é essencial para 'ON DELETE CASCADE'
-    c.execute("PRAGMA foreign_keys = ON")
-    
     # Tabela 1: users
     c.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -80,6 +1230,9 @@ def init_db():
     )
     ''')
     print("✅ Tabela 'purchases' verificada (com cascade).")
+
+    # Antes dos dados de exemplo: o saldo inicial já entra pelo razão (v10)
+    migrate_db(conn)
     
     # --- Inserir dados de exemplo SOMENTE SE NÃO EXISTIREM ---
     
@@ -87,7 +1240,7 @@ def init_db():
     c.execute("SELECT * FROM users WHERE username = 'trader'") # <-- SEU LOGIN
     admin_exists = c.fetchone()
     if not admin_exists:
-        admin_pass = generate_password_hash('traderbr') # <-- SUA SENHA
+        admin_pass = generate_password_hash('traderbr', PASSWORD_HASH_METHOD) # <-- SUA SENHA
         c.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
                   ('trader', admin_pass, 'admin')) # <-- SEU LOGIN E ROLE 'admin'
         print("👤 Usuário 'trader' (senha: 'traderbr') criado.")
@@ -96,9 +1249,10 @@ def init_db():
     c.execute("SELECT * FROM users WHERE username = 'revendedor1'")
     reseller_exists = c.fetchone()
     if not reseller_exists:
-        reseller_pass = generate_password_hash('revenda123')
-        c.execute("INSERT INTO users (username, password, role, balance) VALUES (?, ?, ?, ?)",
-                  ('revendedor1', reseller_pass, 'reseller', 150.0))
+        reseller_pass = generate_password_hash('revenda123', PASSWORD_HASH_METHOD)
+        c.execute("INSERT INTO users (username, password, role) VALUES (?, ?, ?)",
+                  ('revendedor1', reseller_pass, 'reseller'))
+        post_ledger_entry(conn, c.lastrowid, 15000, 'credit')
         print("👤 Usuário 'revendedor1' (senha: 'revenda123', saldo: 150.0) criado.")
 
     # Verificar se o produto existe
@@ -123,237 +1277,1696 @@ def init_db():
         print("💰 Planos (Semanal, Mensal, Permanente) criados com links de exemplo.")
 
     conn.commit()
-    conn.close()
+
+    check_query_plans(conn)
+
+    db_pool.release(conn)
     print("\n🎉 Banco de dados verificado com sucesso!")
 
+# --- Cache do Catálogo (planos + produtos) ---
 
-# --- 2. HTML Templates (MODO DARK + PARTÍCULAS + MODAIS) ---
+class CatalogCache:
+    """
+    Cópia em memória dos planos (com o nome do produto), válida enquanto a
+    geração 'catalog' em cache_generations não mudar. As rotas do admin
+    incrementam a geração na mesma transação da escrita, então todos os
+    workers percebem a mudança na leitura seguinte (1 SELECT por chave primária).
+    """
 
-# --- ESTILOS GLOBAIS E PARTÍCULAS (COM ESTILOS DE MODAL) ---
-GLOBAL_STYLES_AND_PARTICLES = '''
-<style>
-    /* --- Fontes e Cores Base (Dark Mode) --- */
-    :root {
-        --bg-dark: #0a0a1a;
-        --bg-card: #1a1a2e;
-        --border-color: #3a3a5e;
-        --text-light: #e0e0e0;
-        --text-white: #ffffff;
-        --text-dim: #888899;
-        --primary: #007bff;
-        --primary-hover: #0056b3;
-        --success: #28a745;
-        --success-hover: #1e7e34;
-        --danger: #dc3545;
-        --danger-hover: #a71d2a;
-        --warning: #ffc107;
-        --warning-hover: #d39e00;
-    }
-    
-    * { margin: 0; padding: 0; box-sizing: border-box; }
-
-    body {
-        font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
-        background: var(--bg-dark);
-        color: var(--text-light);
-        margin: 0;
-        padding: 20px;
-    }
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (geração, planos ativos ordenados, {plan_id: plano})
+        self._snapshot = (None, [], {})
 
-    /* --- Partículas de Fundo --- */
-    .particles {
-        position: fixed; top: 0; left: 0;
-        width: 100%; height: 100%;
-        pointer-events: none; z-index: -1;
-    }
-    .particle {
-        position: absolute; width: 2px; height: 2px;
-        background: var(--primary); border-radius: 50%;
-        animation: float 6s infinite linear; opacity: 0;
-    }
+    def _load(self, conn):
+        generation = conn.execute(
+            "SELECT generation FROM cache_generations WHERE name = 'catalog'"
+        ).fetchone()[0]
+        # Geração mais antiga vem de um snapshot de leitura atrasado: o cache já é mais novo
+        if self._snapshot[0] is not None and generation <= self._snapshot[0]:
+            return self._snapshot
+        with self._lock:
+            # Outra thread pode ter carregado uma geração mais nova enquanto esta esperava o lock
+            if self._snapshot[0] is None or generation > self._snapshot[0]:
+                rows = conn.execute(
+                    "SELECT p.name as product_name, p.is_active, pl.* FROM plans pl "
+                    "JOIN products p ON p.id = pl.product_id "
+                    "WHERE pl.deleted_at IS NULL AND p.deleted_at IS NULL ORDER BY p.name, pl.cost"
+                ).fetchall()
+                self._snapshot = (generation,
+                                  [r for r in rows if r['is_active'] == 1],
+                                  {r['id']: r for r in rows})
+            return self._snapshot
 
-    @keyframes float {
-        0% { transform: translateY(100vh) translateX(0); opacity: 0; }
-        10% { opacity: 1; }
-        90% { opacity: 1; }
-        100% { transform: translateY(-100px) translateX(100px); opacity: 0; }
-    }
-    
-    /* --- Componentes --- */
-    .container { max-width: 1200px; margin: auto; z-index: 1; position: relative; }
-    .card {
-        background: var(--bg-card); padding: 25px;
-        border-radius: 12px; border: 1px solid var(--border-color);
-        box-shadow: 0 8px 25px rgba(0, 123, 255, 0.1);
-        margin-bottom: 20px;
-    }
-    .grid { display: grid; grid-template-columns: 1fr 1fr; gap: 20px; }
-    h1, h2 { color: var(--text-white); }
-    h2 {
-        border-bottom: 2px solid var(--primary);
-        padding-bottom: 10px; margin-bottom: 20px; font-weight: 600;
-    }
-    table { width: 100%; border-collapse: collapse; margin-top: 15px; }
-    th, td {
-        padding: 12px 15px; border: 1px solid var(--border-color);
-        text-align: left; vertical-align: middle;
-    }
-    th {
-        background: rgba(0, 123, 255, 0.1); color: var(--text-white); font-weight: 600;
-    }
+    def active_plans(self, conn):
+        """Planos de produtos ativos, na ordem da vitrine do revendedor"""
+        return self._load(conn)[1]
 
-    /* --- Formulários --- */
-    form { display: block; margin-top: 15px; }
-    form label {
-        font-weight: 600; margin-top: 10px; display: block; color: var(--text-light);
-    }
-    input[type="text"], input[type="password"], input[type="number"], select {
-        padding: 10px; border: 1px solid var(--border-color);
-        border-radius: 8px; width: 100%;
-        box-sizing: border-box; margin-top: 5px;
-        background: #2a2a4e; color: var(--text-white); font-size: 1rem;
-    }
-    input::placeholder { color: var(--text-dim); }
-    button, .btn {
-        padding: 10px 20px; cursor: pointer; border: none;
-        border-radius: 8px; font-size: 1rem; font-weight: 600;
-        transition: all 0.3s ease; text-decoration: none;
-        display: inline-block; text-align: center;
-    }
-    button:hover, .btn:hover {
-        transform: translateY(-2px); box-shadow: 0 4px 15px rgba(0,0,0,0.2);
-    }
-    .btn-primary { background: var(--primary); color: white; }
-    .btn-primary:hover { background: var(--primary-hover); }
-    .btn-success { background: var(--success); color: white; }
-    .btn-success:hover { background: var(--success-hover); }
-    .btn-danger { background: var(--danger); color: white; }
-    .btn-danger:hover { background: var(--danger-hover); }
-    .btn-warning { background: var(--warning); color: #111; }
-    .btn-warning:hover { background: var(--warning-hover); }
-    .btn-disabled { background: #555; color: #999; cursor: not-allowed; }
-    .btn-disabled:hover { transform: none; box-shadow: none; }
-    
-    /* Ações em linha (para botões editar/excluir) */
-    .inline-actions { display: flex; gap: 10px; flex-wrap: wrap; }
-    .inline-actions form { margin: 0; }
-    .inline-actions .btn { padding: 8px 12px; font-size: 0.9rem; }
-    
-    /* --- Feedback --- */
-    .feedback {
-        padding: 15px; border-radius: 8px;
-        margin-bottom: 20px; font-weight: 600;
-    }
-    .feedback.success {
-        background: rgba(40, 167, 69, 0.2);
-        color: var(--success); border: 1px solid var(--success);
-    }
-    .feedback.error {
-        background: rgba(220, 53, 69, 0.2);
-        color: var(--danger); border: 1px solid var(--danger);
-    }
-    
-    /* --- Específicos --- */
-    .header {
-        display: flex; justify-content: space-between;
-        align-items: center; margin-bottom: 20px;
-    }
-    .balance { font-size: 2.5rem; color: var(--success); font-weight: 700; }
-    code, .code {
-        background: #2a2a4e; color: #ffb800; padding: 3px 6px;
-        border-radius: 4px; font-family: 'Courier New', Courier, monospace;
-        font-weight: bold;
-    }
-    .file-status { 
-        font-size: 0.9em; color: var(--text-dim); 
-        word-break: break-all;
-    }
+    def get_plan(self, conn, plan_id):
+        return self._load(conn)[2].get(plan_id)
 
-    /* --- ESTILOS DO MODAL --- */
-    .modal {
-        display: none; position: fixed; z-index: 1000;
-        left: 0; top: 0; width: 100%; height: 100%;
-        overflow: auto; background-color: rgba(0,0,0,0.7);
-        justify-content: center; align-items: center;
-    }
-    .modal-content {
-        background: var(--bg-card); margin: auto; padding: 30px;
-        border: 1px solid var(--border-color); border-radius: 12px;
-        width: 90%; max-width: 500px;
-    }
-    .modal-header {
-        display: flex; justify-content: space-between; align-items: center;
-        margin-bottom: 20px;
-    }
-    .modal-header h2 { margin: 0; padding: 0; border: none; }
-    .close-btn {
-        color: var(--text-dim); font-size: 28px; font-weight: bold;
-        cursor: pointer;
-    }
-    .close-btn:hover { color: var(--text-white); }
-    
-    @media (max-width: 900px) {
-        .grid { grid-template-columns: 1fr; }
-    }
-</style>
+    def generation(self, conn):
+        """Geração atual do catálogo (usada como ETag da API)"""
+        return self._load(conn)[0]
 
-<div class="particles" id="particles"></div>
+catalog_cache = CatalogCache()
 
-<script>
-    document.addEventListener('DOMContentLoaded', function() {
-        const particles = document.getElementById('particles');
-        if (particles) {
-            for (let i = 0; i < 50; i++) {
-                const particle = document.createElement('div');
-                particle.className = 'particle';
-                particle.style.left = Math.random() * 100 + 'vw';
-                particle.style.animationDelay = Math.random() * 6 + 's';
-                particle.style.animationDuration = (3 + Math.random() * 4) + 's';
-                particles.appendChild(particle);
-            }
-        }
-    });
-</script>
+def bump_catalog_generation(conn):
+    """Invalida o cache do catálogo em todos os workers (chamar antes do commit)"""
+    conn.execute("UPDATE cache_generations SET generation = generation + 1 WHERE name = 'catalog'")
+
+# --- Versões de Sessão (revogação de logins) ---
+
+class SessionVersions:
+    """
+    Mapa em memória user_id -> session_version. A sessão guarda a versão do
+    login; se ela não bater com o mapa (ou o usuário sumiu), a sessão foi
+    revogada. O mapa é recarregado quando a geração 'users' muda, conferida
+    no máximo a cada SESSION_VERSION_CHECK_INTERVAL segundos.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._generation = None
+        self._checked_at = 0.0
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        conn = get_db()
+        generation = conn.execute(
+            "SELECT generation FROM cache_generations WHERE name = 'users'"
+        ).fetchone()[0]
+        with self._lock:
+            if generation != self._generation:
+                self._versions = dict(conn.execute("SELECT id, session_version FROM users").fetchall())
+                self._generation = generation
+            self._checked_at = now
+
+    def current(self, user_id):
+        """Versão de sessão atual do usuário, ou None se ele não existe mais"""
+        self._maybe_refresh()
+        version = self._versions.get(user_id)
+        if version is None:
+            # Usuário criado depois do último recarregamento: busca só ele
+            row = get_db().execute("SELECT session_version FROM users WHERE id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            version = self._versions[user_id] = row[0]
+        return version
+
+    def forget(self, user_id):
+        """Descarta a versão local (usar após o commit de uma revogação)"""
+        self._versions.pop(user_id, None)
+
+session_versions = SessionVersions(SESSION_VERSION_CHECK_INTERVAL)
+
+def revoke_sessions(conn, user_id):
+    """Invalida os logins abertos do usuário em todos os workers (chamar antes do commit)"""
+    conn.execute("UPDATE users SET session_version = session_version + 1 WHERE id = ?", (user_id,))
+    conn.execute("UPDATE cache_generations SET generation = generation + 1 WHERE name = 'users'")
+
+# --- Tarefas Periódicas (threads de manutenção) ---
+
+_periodic_jobs = {}  # nome -> pid do processo onde a thread está rodando
+_periodic_jobs_lock = threading.Lock()
+
+def ensure_periodic_job(name, interval, fn):
+    """Roda fn a cada 'interval' segundos numa thread daemon, uma por processo"""
+    # Threads não sobrevivem ao fork do gunicorn: por isso a checagem do pid.
+    # O lock evita que duas requisições simultâneas (--threads) iniciem a mesma tarefa.
+    with _periodic_jobs_lock:
+        if _periodic_jobs.get(name) == os.getpid():
+            return
+        _periodic_jobs[name] = os.getpid()
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                fn()
+            except Exception as e:
+                print(f"⚠️ Tarefa periódica '{name}' falhou: {e}")
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+
+def worker_id():
+    """Identifica este processo entre os workers (máquina:pid)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_lease(name, seconds):
+    """
+    Concessão da tarefa 'name' por 'seconds' segundos, num único UPSERT condicional:
+    True se este worker já a tinha (renova) ou se a do anterior venceu.
+    """
+    now = time.time()
+    conn = db_pool.acquire()
+    try:
+        claimed = conn.execute(
+            "INSERT INTO job_leases (name, holder, until) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, until = excluded.until "
+            "WHERE holder = excluded.holder OR until <= ?",
+            (name, worker_id(), now + seconds, now)
+        ).rowcount == 1
+        conn.commit()
+    finally:
+        db_pool.release(conn)
+    return claimed
+
+# --- Sessões no Servidor (flask-session) ---
+
+class SQLiteSessionStore:
+    """Sessões na tabela 'sessions' do próprio banco (vale para todos os workers)"""
+
+    def get(self, sid):
+        # Conexão própria: não pode commitar junto com a transação da rota
+        conn = db_pool.acquire()
+        try:
+            row = conn.execute("SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?",
+                               (sid, time.time())).fetchone()
+        finally:
+            db_pool.release(conn)
+        return (row['data'], row['expires_at']) if row else None
+
+    def set(self, sid, data, expires_at):
+        conn = db_pool.acquire()
+        try:
+            conn.execute(
+                "INSERT INTO sessions (sid, data, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (sid, data, expires_at)
+            )
+            conn.commit()
+        finally:
+            db_pool.release(conn)
+
+    def delete(self, sid):
+        conn = db_pool.acquire()
+        try:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+            conn.commit()
+        finally:
+            db_pool.release(conn)
+
+    def purge_expired(self):
+        conn = db_pool.acquire()
+        try:
+            removed = conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+            conn.commit()
+        finally:
+            db_pool.release(conn)
+        return removed
+
+class MemorySessionStore:
+    """Sessões em memória com descarte LRU (um processo só; para desenvolvimento)"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            record = self._data.get(sid)
+            if record is None:
+                return None
+            if record[1] <= time.time():
+                del self._data[sid]
+                return None
+            self._data.move_to_end(sid)
+            return record
+
+    def set(self, sid, data, expires_at):
+        with self._lock:
+            self._data[sid] = (data, expires_at)
+            self._data.move_to_end(sid)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (_, expires_at) in self._data.items() if expires_at <= now]
+            for sid in expired:
+                del self._data[sid]
+        return len(expired)
+
+class StoreSessionInterface(ServerSideSessionInterface):
+    """
+    Interface de sessão do flask-session sobre um store plugável. O cookie
+    leva só o id (assinado); os dados ficam no store. Sessões não alteradas
+    só são regravadas quando passam da metade do tempo de vida. Assets e
+    /metrics não carregam nem gravam sessão.
+    """
+
+    SESSIONLESS_PREFIXES = ('/assets/', '/static/', '/metrics')
+
+    session_class = ServerSideSession
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, cleanup_interval):
+        super().__init__(None, key_prefix='', use_signer=True, permanent=True)
+        self.store = store
+        self.cleanup_interval = cleanup_interval
+
+    def open_session(self, app, request):
+        ensure_periodic_job('session-cleanup', self.cleanup_interval, self.store.purge_expired)
+        if request.path.startswith(self.SESSIONLESS_PREFIXES):
+            return self.make_null_session(app)
+        return super().open_session(app, request)
+
+    def regenerate(self, session):
+        """Troca o id da sessão (no login): o id antigo some do store e não vale mais"""
+        self.store.delete(session.sid)
+        session.sid = self._generate_sid(self.sid_length)
+        session.modified = True
+
+    def fetch_session(self, sid):
+        record = self.store.get(sid)
+        if record is None:
+            # Id desconhecido ou expirado: gera outro (não reaproveita id vindo do cliente)
+            return self.session_class(sid=self._generate_sid(self.sid_length), permanent=self.permanent)
+        data, expires_at = record
+        session = self.session_class(self.serializer.loads(data), sid=sid)
+        session.expires_at = expires_at
+        return session
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.config["SESSION_COOKIE_NAME"], domain=domain, path=path)
+            return
+
+        now = time.time()
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        stored_expires_at = getattr(session, 'expires_at', None)
+        if not session.modified and stored_expires_at and stored_expires_at - now > lifetime / 2:
+            return
+
+        expires_at = now + lifetime
+        self.store.set(session.sid, self.serializer.dumps(dict(session)), expires_at)
+        self.set_cookie_to_response(app, session, response,
+                                    datetime.fromtimestamp(expires_at, timezone.utc))
+
+app.permanent_session_lifetime = timedelta(hours=SESSION_LIFETIME_HOURS)
+if SESSION_BACKEND == 'sqlite':
+    app.session_interface = StoreSessionInterface(SQLiteSessionStore(), SESSION_CLEANUP_INTERVAL)
+elif SESSION_BACKEND == 'memory':
+    app.session_interface = StoreSessionInterface(MemorySessionStore(SESSION_MEMORY_MAX_ENTRIES),
+                                                  SESSION_CLEANUP_INTERVAL)
+
+# --- Hash de Senhas (pool de processos limitado) ---
+
+class HasherBusy(Exception):
+    """Fila de hashing cheia: a requisição é recusada na hora em vez de esperar"""
+
+class PasswordHasher:
+    """
+    Calcula/verifica hashes de senha num ProcessPoolExecutor, fora das threads
+    do gunicorn. No máximo max_pending operações ficam em andamento; acima
+    disso levanta HasherBusy imediatamente.
+    """
+
+    def __init__(self, method, workers, max_pending):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rejected = 0
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._current_prefix = None
+        self._lock = threading.Lock()
+
+    def _ensure_pool(self):
+        # Criado sob demanda em cada processo, depois do fork do gunicorn (o pool não sobrevive
+        # ao fork). Os filhos saem do forkserver/spawn, nunca de um fork deste processo: aqui já
+        # rodam threads (pool, métricas, limpeza) e um lock preso no fork travaria o filho.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._executor = (ProcessPoolExecutor(max_workers=self.workers,
+                                                      mp_context=multiprocessing.get_context(method))
+                                  if self.workers > 0 else None)
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+                self._pid = os.getpid()
+
+    def _run(self, fn, *args):
+        self._ensure_pool()
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy("Servidor ocupado, tente novamente em instantes.")
+        if self._executor is None:
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=HASH_TIMEOUT)
+        except TimeoutError:
+            # Pool travado/saturado: 503 como a fila cheia (a vaga volta quando o processo terminar)
+            future.cancel()
+            raise HasherBusy("Servidor ocupado, tente novamente em instantes.")
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, stored_hash, password):
+        return self._run(check_password_hash, stored_hash, password)
+
+    def hash_many(self, passwords):
+        """Hashes de um lote, espalhados por todos os processos; o lote ocupa uma única vaga da fila"""
+        self._ensure_pool()
+        if not passwords:
+            return []
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy("Servidor ocupado, tente novamente em instantes.")
+        try:
+            methods = [self.method] * len(passwords)
+            if self._executor is None:
+                return list(map(generate_password_hash, passwords, methods))
+            # Pedaços grandes o bastante para não pagar IPC por senha, pequenos o bastante para balancear
+            chunksize = max(1, len(passwords) // (self.workers * 4))
+            timeout = HASH_TIMEOUT * math.ceil(len(passwords) / self.workers)
+            return list(self._executor.map(generate_password_hash, passwords, methods,
+                                           chunksize=chunksize, timeout=timeout))
+        except TimeoutError:
+            raise HasherBusy("Servidor ocupado, tente novamente em instantes.")
+        finally:
+            self._slots.release()
+
+    def needs_rehash(self, stored_hash):
+        """True se o hash gravado usa método/custo diferente do configurado"""
+        if self._current_prefix is None:
+            # O werkzeug normaliza o método (ex.: 'pbkdf2' -> 'pbkdf2:sha256:600000')
+            self._current_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return stored_hash.split('$', 1)[0] != self._current_prefix
+
+password_hasher = PasswordHasher(PASSWORD_HASH_METHOD, HASH_POOL_WORKERS, HASH_QUEUE_MAX)
+
+# --- Rate Limit (token bucket) ---
+
+def parse_rate(rate):
+    """'5/60' -> (capacidade 5, recarga de 5/60 fichas por segundo)"""
+    capacity, seconds = rate.split('/')
+    return int(capacity), int(capacity) / float(seconds)
+
+class SQLiteBucketStore:
+    """
+    Baldes na tabela rate_limits; cada consumo é um único UPSERT condicional.
+    O tempo decorrido nunca é negativo e updated_at nunca anda para trás:
+    threads/workers gravam com relógios lidos em momentos diferentes.
+    """
+
+    def take(self, key, capacity, refill, now):
+        conn = db_pool.acquire()
+        try:
+            allowed = conn.execute(
+                "INSERT INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                " tokens = MIN(?, tokens + MAX(0, excluded.updated_at - updated_at) * ?) - 1,"
+                " updated_at = MAX(updated_at, excluded.updated_at) "
+                "WHERE MIN(?, tokens + MAX(0, excluded.updated_at - updated_at) * ?) >= 1",
+                (key, capacity - 1, now, capacity, refill, capacity, refill)
+            ).rowcount == 1
+            conn.commit()
+            if allowed:
+                return True, 0.0
+            row = conn.execute("SELECT tokens, updated_at FROM rate_limits WHERE key = ?", (key,)).fetchone()
+        finally:
+            db_pool.release(conn)
+        tokens = min(capacity, row['tokens'] + max(0.0, now - row['updated_at']) * refill)
+        return False, (1 - tokens) / refill
+
+    def purge_idle(self, before):
+        conn = db_pool.acquire()
+        try:
+            removed = conn.execute("DELETE FROM rate_limits WHERE updated_at < ?", (before,)).rowcount
+            conn.commit()
+        finally:
+            db_pool.release(conn)
+        return removed
+
+class MemoryBucketStore:
+    """Baldes em memória (um processo só)"""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, refill, now):
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0.0, now - updated_at) * refill)
+            now = max(now, updated_at)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return True, 0.0
+            self._buckets[key] = (tokens, now)
+            return False, (1 - tokens) / refill
+
+    def purge_idle(self, before):
+        with self._lock:
+            idle = [key for key, (_, updated_at) in self._buckets.items() if updated_at < before]
+            for key in idle:
+                del self._buckets[key]
+        return len(idle)
+
+class RateLimiter:
+    def __init__(self, store, rates):
+        self.store = store
+        # Parado por mais que a maior janela, qualquer balde já estaria cheio: apagar não muda nada
+        self.idle_after = max(capacity / refill for capacity, refill in map(parse_rate, rates))
+
+    def take(self, scope, key, capacity, refill):
+        """Consome uma ficha do balde scope:key; retorna (permitido, segundos até a próxima ficha)"""
+        allowed, retry_after = self.store.take(f"{scope}:{key}", capacity, refill, time.time())
+        metrics.inc('rate_limit_requests_total',
+                    metric_labels(scope=scope, result='allowed' if allowed else 'throttled'))
+        return allowed, retry_after
+
+    def purge_idle(self):
+        """Tarefa periódica: remove os baldes que já teriam recarregado por completo"""
+        return self.store.purge_idle(time.time() - self.idle_after)
+
+rate_limiter = RateLimiter(SQLiteBucketStore() if RATE_LIMIT_BACKEND == 'sqlite' else MemoryBucketStore(),
+                           (LOGIN_IP_RATE_LIMIT, LOGIN_USER_RATE_LIMIT, PURCHASE_IP_RATE_LIMIT,
+                            PURCHASE_USER_RATE_LIMIT))
+
+# --- Idempotência (replays de compras e créditos) ---
+
+class IdempotencyConflict(Exception):
+    """Chave de idempotência inválida ou já usada numa operação diferente"""
+
+def find_idempotent_response(conn, user_id, key, fingerprint):
+    """Resposta gravada para (usuário, chave) dentro do TTL, ou None"""
+    if len(key) > 255:
+        raise IdempotencyConflict("Chave de idempotência muito longa.")
+    row = conn.execute(
+        "SELECT fingerprint, response FROM idempotency_keys WHERE user_id = ? AND key = ? AND created_at >= ?",
+        (user_id, key, time.time() - IDEMPOTENCY_TTL_HOURS * 3600)
+    ).fetchone()
+    if row is None:
+        return None
+    if row['fingerprint'] != fingerprint:
+        raise IdempotencyConflict("Chave de idempotência já usada em outra requisição.")
+    return json.loads(row['response'])
+
+def save_idempotent_response(conn, user_id, key, fingerprint, response):
+    """Grava a resposta na mesma transação da operação (chamar antes do commit)"""
+    # REPLACE: pode existir uma linha vencida (fora do TTL) com a mesma chave
+    conn.execute(
+        "INSERT OR REPLACE INTO idempotency_keys (user_id, key, fingerprint, response, created_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (user_id, key, fingerprint, json.dumps(response), time.time())
+    )
+
+def compact_idempotency_keys():
+    """Remove chaves vencidas e mantém no máximo IDEMPOTENCY_MAX_ROWS (as mais novas)"""
+    conn = db_pool.acquire()
+    try:
+        removed = conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?",
+                               (time.time() - IDEMPOTENCY_TTL_HOURS * 3600,)).rowcount
+        cutoff = conn.execute("SELECT created_at FROM idempotency_keys ORDER BY created_at DESC LIMIT 1 OFFSET ?",
+                              (IDEMPOTENCY_MAX_ROWS,)).fetchone()
+        if cutoff:
+            removed += conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?",
+                                    (cutoff['created_at'],)).rowcount
+        conn.commit()
+    finally:
+        db_pool.release(conn)
+    return removed
+
+# --- Razão de Saldos (ledger em centavos) ---
+
+def to_cents(value):
+    """Reais (float ou texto) -> centavos inteiros, meio centavo arredondado para cima"""
+    return int((Decimal(str(value)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+# balance é sempre derivado de balance_cents no mesmo UPDATE: nada de soma acumulada em float
+LEDGER_BALANCE_SQL = ("UPDATE users SET balance_cents = balance_cents + ?1, balance = (balance_cents + ?1) / 100.0 "
+                      "WHERE id = ?2 AND balance_cents + ?1 >= 0")
+LEDGER_INSERT_SQL = "INSERT INTO ledger (user_id, amount_cents, kind, purchase_id) VALUES (?, ?, ?, ?)"
+
+def post_ledger_entry(conn, user_id, amount_cents, kind, purchase_id=None):
+    """
+    Lança um crédito (+) ou débito (-) no razão e atualiza o saldo materializado
+    (chamar dentro da transação, antes do commit). Débito sem saldo não é lançado.
+    Retorna False se o usuário não existe ou o saldo não cobre o débito.
+    """
+    if not conn.execute(LEDGER_BALANCE_SQL, (amount_cents, user_id)).rowcount:
+        return False
+    conn.execute(LEDGER_INSERT_SQL, (user_id, amount_cents, kind, purchase_id))
+    return True
+
+def reconcile_ledger():
+    """
+    Confere o saldo materializado de cada usuário contra o razão. Só os
+    lançamentos novos desde o checkpoint são somados (ledger_totals guarda o
+    acumulado), então o custo é O(lançamentos novos + usuários), nunca o
+    histórico inteiro. Retorna {'entries': n, 'mismatches': [linhas]}.
+    """
+    conn = db_pool.acquire()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        last_id = conn.execute("SELECT last_entry_id FROM ledger_checkpoint WHERE id = 1").fetchone()[0]
+        new_last = conn.execute("SELECT COALESCE(MAX(id), ?) FROM ledger", (last_id,)).fetchone()[0]
+        entries = conn.execute("SELECT COUNT(*) FROM ledger WHERE id > ? AND id <= ?",
+                               (last_id, new_last)).fetchone()[0]
+        conn.execute(
+            "INSERT INTO ledger_totals (user_id, total_cents) "
+            "SELECT user_id, SUM(amount_cents) FROM ledger WHERE id > ? AND id <= ? GROUP BY user_id "
+            "ON CONFLICT (user_id) DO UPDATE SET total_cents = total_cents + excluded.total_cents",
+            (last_id, new_last)
+        )
+        mismatches = conn.execute(
+            "SELECT u.id, u.username, u.balance_cents, COALESCE(t.total_cents, 0) AS ledger_cents "
+            "FROM users u LEFT JOIN ledger_totals t ON t.user_id = u.id "
+            "WHERE u.balance_cents != COALESCE(t.total_cents, 0)"
+        ).fetchall()
+        conn.execute("UPDATE ledger_checkpoint SET last_entry_id = ?, checked_at = ? WHERE id = 1",
+                     (new_last, time.time()))
+        conn.commit()
+    finally:
+        db_pool.release(conn)
+
+    for row in mismatches:
+        print(f"⚠️ Saldo divergente: '{row['username']}' (id {row['id']}) tem {row['balance_cents']} centavos, "
+              f"o razão soma {row['ledger_cents']}.")
+    return {'entries': entries, 'mismatches': [dict(row) for row in mismatches]}
+
+# --- Relatórios de Vendas (rollups diários) ---
+
+def record_sale(conn, purchase_id, product_id, plan_id, reseller_id, cost_cents):
+    """Soma a compra no rollup do dia (mesma transação da compra)"""
+    conn.execute(
+        "INSERT INTO sales_daily (day, product_id, plan_id, reseller_id, purchases, revenue_cents) "
+        "VALUES ((SELECT date(created_at) FROM purchases WHERE id = ?), ?, ?, ?, 1, ?) "
+        "ON CONFLICT (day, product_id, plan_id, reseller_id) DO UPDATE SET "
+        "purchases = purchases + 1, revenue_cents = revenue_cents + excluded.revenue_cents",
+        (purchase_id, product_id, plan_id, reseller_id, cost_cents)
+    )
+
+# Linhas de sales_daily cujo revendedor, plano e produto não foram excluídos
+SALES_ROLLUP_LIVE_FILTER = (
+    "reseller_id IN (SELECT id FROM users WHERE deleted_at IS NULL) AND plan_id IN ("
+    "SELECT pl.id FROM plans pl JOIN products pr ON pr.id = pl.product_id "
+    "WHERE pl.deleted_at IS NULL AND pr.deleted_at IS NULL)"
+)
+
+def backfill_sales_rollups():
+    """
+    Recalcula sales_daily a partir de purchases, numa única transação. Só as linhas de
+    revendedores/planos/produtos ativos são refeitas: as compras dos excluídos somem na
+    limpeza em lotes, e a receita deles fica congelada nos rollups (não é apagada).
+    """
+    conn = db_pool.acquire()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(f"DELETE FROM sales_daily WHERE {SALES_ROLLUP_LIVE_FILTER}")
+        rows = conn.execute(f"{SALES_ROLLUP_INSERT_SQL}SELECT * FROM ({SALES_ROLLUP_SELECT_SQL}) "
+                            f"WHERE {SALES_ROLLUP_LIVE_FILTER}").rowcount
+        kept = conn.execute(f"SELECT COUNT(*) FROM sales_daily WHERE NOT ({SALES_ROLLUP_LIVE_FILTER})").fetchone()[0]
+        conn.commit()
+    finally:
+        db_pool.release(conn)
+    print(f"📊 Rollups de vendas recalculados: {rows} linhas (dia × produto × plano × revendedor); "
+          f"{kept} linhas de excluídos mantidas.")
+    return rows
+
+def report_range(args):
+    """Período do relatório a partir de ?start=&end= (AAAA-MM-DD); padrão: últimos 30 dias"""
+    today = datetime.now(timezone.utc).date()
+    end = datetime.strptime(args['end'], '%Y-%m-%d').date() if args.get('end') else today
+    start = datetime.strptime(args['start'], '%Y-%m-%d').date() if args.get('start') else end - timedelta(days=29)
+    if start > end:
+        raise ValueError("A data inicial é depois da final.")
+    return start.isoformat(), end.isoformat()
+
+def sales_report(conn, start, end, top=10):
+    """
+    Receita por produto por dia, totais e rankings (revendedores/produtos) no
+    período. Só lê sales_daily: o custo depende de quantas combinações
+    dia × produto × plano × revendedor existem no período, não do volume de compras.
+    """
+    def money(rows):
+        return [{**dict(row), 'revenue': row['revenue_cents'] / 100} for row in rows]
+
+    daily = conn.execute(
+        "SELECT s.day, s.product_id, pr.name AS product_name, s.purchases, s.revenue_cents FROM ("
+        " SELECT day, product_id, SUM(purchases) AS purchases, SUM(revenue_cents) AS revenue_cents"
+        " FROM sales_daily WHERE day >= ? AND day <= ? GROUP BY day, product_id"
+        ") s LEFT JOIN products pr ON pr.id = s.product_id "
+        "ORDER BY s.day DESC, s.revenue_cents DESC",
+        (start, end)
+    ).fetchall()
+    top_resellers = conn.execute(
+        # Excluído (username já renomeado) ou já apagado: NULL, exibido como '(excluído)'
+        "SELECT s.reseller_id, CASE WHEN u.deleted_at IS NULL THEN u.username END AS username, "
+        "s.purchases, s.revenue_cents FROM ("
+        " SELECT reseller_id, SUM(purchases) AS purchases, SUM(revenue_cents) AS revenue_cents"
+        " FROM sales_daily WHERE day >= ? AND day <= ? GROUP BY reseller_id"
+        " ORDER BY revenue_cents DESC LIMIT ?"
+        ") s LEFT JOIN users u ON u.id = s.reseller_id ORDER BY s.revenue_cents DESC",
+        (start, end, top)
+    ).fetchall()
+    top_products = conn.execute(
+        "SELECT s.product_id, pr.name AS product_name, s.purchases, s.revenue_cents FROM ("
+        " SELECT product_id, SUM(purchases) AS purchases, SUM(revenue_cents) AS revenue_cents"
+        " FROM sales_daily WHERE day >= ? AND day <= ? GROUP BY product_id"
+        " ORDER BY revenue_cents DESC LIMIT ?"
+        ") s LEFT JOIN products pr ON pr.id = s.product_id ORDER BY s.revenue_cents DESC",
+        (start, end, top)
+    ).fetchall()
+
+    purchases = sum(row['purchases'] for row in daily)
+    revenue_cents = sum(row['revenue_cents'] for row in daily)
+    return {
+        'start': start, 'end': end,
+        'totals': {'purchases': purchases, 'revenue_cents': revenue_cents, 'revenue': revenue_cents / 100},
+        'daily': money(daily),
+        'top_resellers': money(top_resellers),
+        'top_products': money(top_products),
+    }
+
+# --- Motor de Compras (débito atômico) ---
+
+class PurchaseError(Exception):
+    """Erro de negócio na compra (mensagem exibida ao revendedor)"""
+
+def _is_busy_error(e):
+    msg = str(e).lower()
+    return 'locked' in msg or 'busy' in msg
+
+def _apply_purchase(conn, reseller_id, plan_id, idempotency_key=None):
+    """
+    Corpo da compra, dentro de uma transação já aberta (quem chama faz o commit).
+    O débito é um UPDATE condicional, então compras simultâneas nunca deixam o
+    saldo negativo nem perdem atualizações. Retorna (compra, replay).
+    """
+    fingerprint = f"purchase:{plan_id}"
+    if idempotency_key:
+        previous = find_idempotent_response(conn, reseller_id, idempotency_key, fingerprint)
+        if previous is not None:
+            return previous, True
+
+    # Lido do cache; a geração é conferida já com o lock de escrita
+    plan = catalog_cache.get_plan(conn, plan_id)
+    if not plan:
+        raise PurchaseError("Plano não encontrado.")
+
+    if not plan['download_link']:
+        raise PurchaseError("Produto indisponível (sem link). Contate o admin.")
+
+    cost_cents = to_cents(plan['cost'])
+    plan_cost = cost_cents / 100
+
+    # Débito condicional no saldo materializado (a compra entra no razão logo abaixo)
+    debited = conn.execute(LEDGER_BALANCE_SQL, (-cost_cents, reseller_id)).rowcount
+    if not debited:
+        raise PurchaseError("Saldo insuficiente para comprar este produto.")
+
+    purchase_id_ref = f"ID-{str(uuid.uuid4()).upper()[:8]}"
+
+    purchase_id = conn.execute(
+        "INSERT INTO purchases (reseller_id, plan_id, cost_paid, purchase_id_ref) VALUES (?, ?, ?, ?)",
+        (reseller_id, plan_id, plan_cost, purchase_id_ref)
+    ).lastrowid
+    conn.execute(LEDGER_INSERT_SQL, (reseller_id, -cost_cents, 'purchase', purchase_id))
+    record_sale(conn, purchase_id, plan['product_id'], plan_id, reseller_id, cost_cents)
+
+    result = {'purchase_id': purchase_id, 'purchase_id_ref': purchase_id_ref,
+              'plan_id': plan_id, 'cost_paid': plan_cost}
+    if idempotency_key:
+        save_idempotent_response(conn, reseller_id, idempotency_key, fingerprint, result)
+    return result, False
+
+def _retry_busy(conn, attempt, error):
+    """Rollback + backoff exponencial com jitter; relança se não for lock ou acabaram as tentativas"""
+    conn.rollback()
+    if not _is_busy_error(error) or attempt == PURCHASE_MAX_RETRIES:
+        raise error
+    time.sleep(PURCHASE_RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+class GroupCommitWriter:
+    """
+    Thread escritora (uma por processo) que junta as compras enfileiradas numa
+    única transação 'BEGIN IMMEDIATE' + um commit para o lote todo. Cada compra
+    roda no seu SAVEPOINT, então o erro de uma não desfaz as outras; o Future de
+    cada requisição só é resolvido depois do commit.
+    """
+
+    def __init__(self, window_ms, max_batch):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Threads não sobrevivem ao fork do gunicorn: uma escritora por pid
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, args=(self._queue,), name='purchase-writer',
+                                 daemon=True).start()
+
+    def submit(self, reseller_id, plan_id, idempotency_key=None):
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((future, reseller_id, plan_id, idempotency_key))
+        return future
+
+    def _collect(self, pending):
+        """
+        Primeira compra da fila + as que já estão esperando (ou chegarem dentro da janela).
+        Compras canceladas (a requisição desistiu por timeout) são descartadas; as demais
+        passam a 'running' e não podem mais ser canceladas.
+        """
+        batch = []
+        while not batch:
+            item = pending.get()
+            if item[0].set_running_or_notify_cancel():
+                batch.append(item)
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                item = pending.get(timeout=max(0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if item[0].set_running_or_notify_cancel():
+                batch.append(item)
+        return batch
+
+    @staticmethod
+    def _resolve(future, ok, value):
+        # Um Future já resolvido não pode derrubar a thread escritora
+        try:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        except InvalidStateError:
+            pass
+
+    def _commit_batch(self, conn, batch):
+        for attempt in range(PURCHASE_MAX_RETRIES + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                outcomes = []
+                for _, reseller_id, plan_id, idempotency_key in batch:
+                    conn.execute("SAVEPOINT purchase")
+                    try:
+                        outcomes.append((True, _apply_purchase(conn, reseller_id, plan_id, idempotency_key)))
+                    except sqlite3.OperationalError:
+                        raise
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO purchase")
+                        outcomes.append((False, e))
+                    conn.execute("RELEASE purchase")
+                conn.commit()
+                return outcomes
+            except sqlite3.OperationalError as e:
+                _retry_busy(conn, attempt, e)
+
+    def _run(self, pending):
+        conn = db_pool.acquire()  # conexão dedicada da escritora, nunca devolvida
+        while True:
+            batch = self._collect(pending)
+            try:
+                outcomes = self._commit_batch(conn, batch)
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                for future, *_ in batch:
+                    self._resolve(future, False, e)
+                continue
+            for (future, *_), (ok, value) in zip(batch, outcomes):
+                self._resolve(future, ok, value)
+            metrics.observe('purchase_batch_size', '', len(batch), BATCH_BUCKETS)
+
+purchase_writer = GroupCommitWriter(PURCHASE_GROUP_COMMIT_WINDOW_MS, PURCHASE_GROUP_COMMIT_MAX_BATCH)
+
+def purchase_plan(conn, reseller_id, plan_id, idempotency_key=None):
+    """
+    Debita o custo do plano e registra a compra numa transação 'BEGIN IMMEDIATE'
+    (ou, com PURCHASE_GROUP_COMMIT, no próximo lote da thread escritora).
+    Com idempotency_key, repetir a chamada devolve a mesma compra sem debitar de novo.
+    Retorna (compra, replay) onde compra = {purchase_id, purchase_id_ref, plan_id, cost_paid}.
+    """
+    if PURCHASE_GROUP_COMMIT:
+        future = purchase_writer.submit(reseller_id, plan_id, idempotency_key)
+        try:
+            result = future.result(timeout=PURCHASE_GROUP_COMMIT_TIMEOUT)
+            note_write()
+            return result
+        except TimeoutError:
+            # Ainda na fila: cancelada, a escritora descarta. Já no lote: pode ser gravada, o revendedor confere
+            if future.cancel():
+                raise PurchaseError("A compra não foi processada a tempo e foi cancelada. Tente de novo.")
+            raise PurchaseError("A compra não foi confirmada a tempo. Confira o histórico antes de tentar de novo.")
+
+    for attempt in range(PURCHASE_MAX_RETRIES + 1):
+        try:
+            # Pega o lock de escrita logo no início (evita "database is locked" no meio)
+            conn.execute("BEGIN IMMEDIATE")
+            result = _apply_purchase(conn, reseller_id, plan_id, idempotency_key)
+            conn.commit()
+            note_write()
+            return result
+        except sqlite3.OperationalError as e:
+            _retry_busy(conn, attempt, e)
+        except Exception:
+            conn.rollback()
+            raise
+
+# --- Créditos (admin) ---
+
+def add_credits_to(conn, admin_id, reseller_id, amount, idempotency_key=None):
+    """
+    Soma créditos ao saldo do revendedor. Com idempotency_key, reenviar o mesmo
+    formulário devolve o resultado anterior sem creditar de novo.
+    Retorna (resultado, replay) onde resultado = {reseller_id, username, amount}.
+    """
+    amount_cents = to_cents(amount)
+    if amount_cents <= 0:
+        raise ValueError("O valor deve ser positivo.")
+    fingerprint = f"credits:{reseller_id}:{amount_cents}"
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if idempotency_key:
+            previous = find_idempotent_response(conn, admin_id, idempotency_key, fingerprint)
+            if previous is not None:
+                conn.rollback()
+                return previous, True
+
+        reseller = conn.execute("SELECT username FROM users WHERE id = ? AND role = 'reseller' "
+                                "AND deleted_at IS NULL", (reseller_id,)).fetchone()
+        if reseller is None:
+            raise ValueError("Revendedor não encontrado.")
+        post_ledger_entry(conn, reseller_id, amount_cents, 'credit')
+
+        result = {'reseller_id': reseller_id, 'username': reseller['username'], 'amount': amount_cents / 100}
+        if idempotency_key:
+            save_idempotent_response(conn, admin_id, idempotency_key, fingerprint, result)
+
+        conn.commit()
+        note_write()
+        return result, False
+    except Exception:
+        conn.rollback()
+        raise
+
+# --- Operações em Lote (créditos e revendedores) ---
+
+def read_bulk_rows():
+    """
+    Linhas do lote enviado: JSON (lista de objetos ou {"rows": [...]}) ou CSV
+    com cabeçalho (corpo da requisição, arquivo 'file' ou campo 'data').
+    """
+    if request.is_json:
+        rows = request.get_json(silent=True)
+        if isinstance(rows, dict):
+            rows = rows.get('rows')
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ValueError("JSON deve ser uma lista de objetos.")
+    else:
+        upload = request.files.get('file')
+        if upload and upload.filename:
+            text = upload.read().decode('utf-8-sig')
+        elif 'data' in request.form:
+            text = request.form['data']
+        else:
+            text = request.get_data(as_text=True)
+        rows = list(csv.DictReader(io.StringIO(text.strip())))
+    if not rows:
+        raise ValueError("Lote vazio.")
+    if len(rows) > BULK_MAX_ROWS:
+        raise ValueError(f"Lote com {len(rows)} linhas; o máximo é {BULK_MAX_ROWS}.")
+    return rows
+
+def _bulk_cents(value, allow_zero=False):
+    """Valor da linha em centavos, ou None se inválido"""
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(amount):
+        return None
+    cents = to_cents(amount)
+    if cents < 0 or (cents == 0 and not allow_zero):
+        return None
+    return cents
+
+def bulk_add_credits(conn, admin_id, rows, idempotency_key=None):
+    """
+    Créditos em lote (colunas username, amount) numa única transação com
+    executemany. Linhas inválidas entram no relatório como erro e não impedem
+    as demais. Retorna (relatório por linha, replay).
+    """
+    report, valid = [], []
+    for i, row in enumerate(rows, 1):
+        username = str(row.get('username') or '').strip()
+        cents = _bulk_cents(row.get('amount'))
+        entry = {'row': i, 'username': username, 'amount': None if cents is None else cents / 100, 'status': 'ok'}
+        if not username:
+            entry.update(status='error', error='username obrigatório.')
+        elif cents is None:
+            entry.update(status='error', error='amount deve ser um número positivo.')
+        else:
+            valid.append(entry)
+        report.append(entry)
+
+    fingerprint = "bulk-credits:" + hashlib.sha256(
+        json.dumps([(e['username'], e['amount']) for e in report]).encode()).hexdigest()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if idempotency_key:
+            previous = find_idempotent_response(conn, admin_id, idempotency_key, fingerprint)
+            if previous is not None:
+                conn.rollback()
+                return previous, True
+
+        # Um único SELECT resolve todos os nomes (json_each evita o limite de parâmetros)
+        ids = dict(conn.execute(
+            "SELECT username, id FROM users WHERE role = 'reseller' AND deleted_at IS NULL "
+            "AND username IN (SELECT value FROM json_each(?))",
+            (json.dumps([e['username'] for e in valid]),)
+        ).fetchall())
+        credits = []
+        for entry in valid:
+            if entry['username'] in ids:
+                credits.append((ids[entry['username']], to_cents(entry['amount'])))
+            else:
+                entry.update(status='error', error='Revendedor não encontrado.')
+        conn.executemany(LEDGER_BALANCE_SQL, [(cents, user_id) for user_id, cents in credits])
+        conn.executemany(LEDGER_INSERT_SQL, [(user_id, cents, 'credit', None) for user_id, cents in credits])
+
+        if idempotency_key:
+            save_idempotent_response(conn, admin_id, idempotency_key, fingerprint, report)
+        conn.commit()
+        note_write()
+        return report, False
+    except Exception:
+        conn.rollback()
+        raise
+
+def bulk_create_resellers(conn, rows):
+    """
+    Cria revendedores em lote (colunas username, password e, opcional, balance).
+    As senhas são hasheadas em paralelo antes de abrir a transação, para o lock
+    de escrita durar só os INSERTs. Retorna o relatório por linha.
+    """
+    if len(rows) > BULK_RESELLERS_MAX_ROWS:
+        raise ValueError(f"Lote com {len(rows)} revendedores; o máximo é {BULK_RESELLERS_MAX_ROWS}.")
+    report, pending, seen = [], [], set()
+    for i, row in enumerate(rows, 1):
+        username = str(row.get('username') or '').strip()
+        password = str(row.get('password') or '')
+        balance = _bulk_cents(row.get('balance') or 0, allow_zero=True)
+        entry = {'row': i, 'username': username, 'status': 'ok'}
+        if not username or not password:
+            entry.update(status='error', error='username e password são obrigatórios.')
+        elif balance is None:
+            entry.update(status='error', error='balance deve ser um número não negativo.')
+        elif username in seen:
+            entry.update(status='error', error='Usuário repetido no lote.')
+        else:
+            seen.add(username)
+            pending.append((entry, password, balance))
+        report.append(entry)
+
+    hashes = password_hasher.hash_many([password for _, password, _ in pending])
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        existing = {row['username'] for row in conn.execute(
+            "SELECT username FROM users WHERE username IN (SELECT value FROM json_each(?))",
+            (json.dumps(sorted(seen)),)
+        )}
+        params = []
+        for (entry, _, balance), hashed in zip(pending, hashes):
+            if entry['username'] in existing:
+                entry.update(status='error', error='Usuário já existe.')
+            else:
+                params.append((entry['username'], hashed, balance))
+        conn.executemany("INSERT INTO users (username, password, role) VALUES (?, ?, 'reseller')",
+                         [(username, hashed) for username, hashed, _ in params])
+
+        created = dict(conn.execute(
+            "SELECT username, id FROM users WHERE username IN (SELECT value FROM json_each(?))",
+            (json.dumps([p[0] for p in params]),)
+        ).fetchall())
+        # Saldo inicial entra pelo razão, como qualquer crédito
+        opening = [(created[username], cents) for username, _, cents in params if cents]
+        conn.executemany(LEDGER_BALANCE_SQL, [(cents, user_id) for user_id, cents in opening])
+        conn.executemany(LEDGER_INSERT_SQL, [(user_id, cents, 'credit', None) for user_id, cents in opening])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    note_write()
+
+    for entry, _, _ in pending:
+        if entry['status'] == 'ok':
+            entry['id'] = created[entry['username']]
+    return report
+
+def bulk_summary(report, started):
+    """Totais do lote + vazão (linhas/s), para o relatório e o benchmark"""
+    elapsed = time.perf_counter() - started
+    ok = sum(1 for entry in report if entry['status'] == 'ok')
+    return {'total': len(report), 'ok': ok, 'errors': len(report) - ok,
+            'elapsed_ms': round(elapsed * 1000, 1),
+            'rows_per_sec': round(len(report) / elapsed, 1) if elapsed > 0 else None,
+            'rows': report}
+
+@app.before_request
+def start_background_jobs():
+    ensure_periodic_job('idempotency-compaction', IDEMPOTENCY_COMPACT_INTERVAL, compact_idempotency_keys)
+    ensure_periodic_job('ledger-reconcile', LEDGER_RECONCILE_INTERVAL, reconcile_ledger)
+    ensure_periodic_job('purge-deleted', PURGE_INTERVAL, purge_deleted)
+    ensure_periodic_job('rate-limit-cleanup', RATE_LIMIT_CLEANUP_INTERVAL, rate_limiter.purge_idle)
+    if METRICS_ENABLED:
+        ensure_periodic_job('metrics-flush', METRICS_FLUSH_INTERVAL, metrics.flush)
+    if SLOW_QUERY_MS > 0:
+        ensure_periodic_job('slow-query-flush', METRICS_FLUSH_INTERVAL, slow_queries.flush)
+    if PROFILING_ENABLED:
+        ensure_periodic_job('profiler-watch', PROFILE_POLL_INTERVAL, watch_profiler_runs)
+    if read_router.mode == 'snapshot':
+        ensure_periodic_job('read-snapshot', DB_READ_SNAPSHOT_INTERVAL, read_router.refresh_snapshot)
+
+
+# --- Histórico de Compras (paginação keyset) ---
+
+def encode_cursor(*values):
+    """Cursor opaco com a posição (chave de ordenação) da última linha da página"""
+    raw = json.dumps(values).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+def fetch_purchase_page(conn, reseller_id, cursor=None, limit=PURCHASE_PAGE_SIZE):
+    """
+    Uma página do histórico do revendedor, do mais recente para o mais antigo.
+    O custo é o mesmo em qualquer página: o índice vai direto ao cursor.
+    Retorna (linhas, próximo_cursor ou None).
+    """
+    sql = ("SELECT p.*, pl.name as plan_name, pr.name as product_name "
+           "FROM purchases p "
+           "JOIN plans pl ON pl.id = p.plan_id "
+           "JOIN products pr ON pr.id = pl.product_id "
+           "WHERE p.reseller_id = ? AND pl.deleted_at IS NULL AND pr.deleted_at IS NULL ")
+    params = [reseller_id]
+    if cursor:
+        created_at, purchase_id = decode_cursor(cursor)
+        sql += "AND (p.created_at, p.id) < (?, ?) "
+        params.extend([str(created_at), int(purchase_id)])
+    sql += "ORDER BY p.created_at DESC, p.id DESC LIMIT ?"
+    # Busca uma linha a mais só para saber se existe próxima página
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['created_at'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def purchase_to_json(p):
+    return {
+        'id': p['id'],
+        'purchase_id_ref': p['purchase_id_ref'],
+        'product_name': p['product_name'],
+        'plan_name': p['plan_name'],
+        'cost_paid': p['cost_paid'],
+        'created_at': p['created_at'],
+        'download_url': url_for('get_download_link', purchase_id=p['id']),
+    }
+
+def purchase_page_json(reseller_id):
+    """Página do histórico a partir de ?cursor=&limit= (resposta JSON)"""
+    try:
+        limit = min(max(int(request.args.get('limit', PURCHASE_PAGE_SIZE)), 1), PURCHASE_PAGE_SIZE_MAX)
+        purchases, next_cursor = fetch_purchase_page(get_read_db(), reseller_id, request.args.get('cursor'), limit)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Cursor ou limite inválido.'}), 400
+    return jsonify({'items': [purchase_to_json(p) for p in purchases], 'next_cursor': next_cursor})
+
+# --- Exclusões (lógica na hora, física em lotes no segundo plano) ---
+
+# tipo -> (tabela, coluna do nome, [(tabela dependente, chave, filtro pelo id do alvo)])
+# Os dependentes são apagados em lotes; a linha do alvo só sai no fim, quando o
+# ON DELETE CASCADE já não tem quase nada para apagar.
+PURGE_TARGETS = {
+    'reseller': ('users', 'username', [
+        ('purchases', 'id', "reseller_id = ?"),
+        ('idempotency_keys', 'key', "user_id = ?"),
+    ]),
+    'product': ('products', 'name', [
+        ('purchases', 'id', "plan_id IN (SELECT id FROM plans WHERE product_id = ?)"),
+    ]),
+    'plan': ('plans', 'name', [
+        ('purchases', 'id', "plan_id = ?"),
+    ]),
+}
+
+def soft_delete(conn, kind, target_id):
+    """
+    Esconde o registro na hora (deleted_at) e agenda a limpeza dos dependentes.
+    Chamar dentro da transação da rota, antes do commit. Retorna o nome, ou None se não existe.
+    """
+    table, label_column, _ = PURGE_TARGETS[kind]
+    row = conn.execute(f"SELECT {label_column} FROM {table} WHERE id = ? AND deleted_at IS NULL",
+                       (target_id,)).fetchone()
+    if row is None:
+        return None
+    conn.execute(f"UPDATE {table} SET deleted_at = CURRENT_TIMESTAMP WHERE id = ?", (target_id,))
+    if kind == 'reseller':
+        # username é UNIQUE: renomeia para o nome poder ser cadastrado de novo (o original fica no job)
+        conn.execute("UPDATE users SET username = '#excluido-' || id || '-' || username WHERE id = ?",
+                     (target_id,))
+    conn.execute("INSERT INTO purge_jobs (kind, target_id, label, created_at) VALUES (?, ?, ?, ?)",
+                 (kind, target_id, row[0], time.time()))
+    return row[0]
+
+def _claim_purge_job(conn, me):
+    """
+    Pega o próximo job pendente sem dono (ou com dono parado há PURGE_CLAIM_TIMEOUT);
+    o UPDATE condicional garante que dois workers não fiquem com o mesmo job.
+    """
+    now = time.time()
+    free = "finished_at IS NULL AND (claimed_by IS NULL OR claimed_by = ? OR claimed_at < ?)"
+    while True:
+        job = conn.execute(f"SELECT id FROM purge_jobs WHERE {free} ORDER BY id LIMIT 1",
+                           (me, now - PURGE_CLAIM_TIMEOUT)).fetchone()
+        if job is None:
+            return None
+        claimed = conn.execute(f"UPDATE purge_jobs SET claimed_by = ?, claimed_at = ? WHERE id = ? AND {free}",
+                               (me, now, job['id'], me, now - PURGE_CLAIM_TIMEOUT)).rowcount
+        conn.commit()
+        if claimed:
+            return conn.execute("SELECT * FROM purge_jobs WHERE id = ?", (job['id'],)).fetchone()
+
+def _purge_batch(conn, job, me):
+    """
+    Apaga um lote de dependentes (ou, sem dependentes, o próprio alvo) numa transação curta.
+    Retorna True quando o job termina, False se ainda há lotes e None se outro worker o assumiu.
+    """
+    table, _, dependents = PURGE_TARGETS[job['kind']]
+    target_id = job['target_id']
+
+    if job['total_rows'] is None:
+        # Contagem fora do lock de escrita: só serve para o progresso
+        total = sum(conn.execute(f"SELECT COUNT(*) FROM {dep} WHERE {where}", (target_id,)).fetchone()[0]
+                    for dep, _, where in dependents)
+        conn.execute("UPDATE purge_jobs SET total_rows = ? WHERE id = ?", (total, job['id']))
+        conn.commit()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        owner = conn.execute("SELECT claimed_by FROM purge_jobs WHERE id = ?", (job['id'],)).fetchone()
+        if owner is None or owner['claimed_by'] != me:
+            conn.rollback()
+            return None
+        deleted = 0
+        for dep, key, where in dependents:
+            deleted = conn.execute(
+                f"DELETE FROM {dep} WHERE {where} AND {key} IN "
+                f"(SELECT {key} FROM {dep} WHERE {where} LIMIT ?)",
+                (target_id, target_id, PURGE_BATCH_ROWS)
+            ).rowcount
+            if deleted:
+                break
+        finished = not deleted
+        if finished:
+            conn.execute(f"DELETE FROM {table} WHERE id = ?", (target_id,))
+        conn.execute("UPDATE purge_jobs SET deleted_rows = deleted_rows + ?, finished_at = ?, claimed_at = ? "
+                     "WHERE id = ?", (deleted, time.time() if finished else None, time.time(), job['id']))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return finished
+
+def purge_deleted():
+    """
+    Processa a fila de exclusões: lotes de PURGE_BATCH_ROWS com commit e uma
+    pausa entre eles, para as compras conseguirem o lock de escrita no meio.
+    Cada job é feito por um worker só (ver _claim_purge_job). Retorna quantos jobs terminaram.
+    """
+    me = worker_id()
+    conn = db_pool.acquire()
+    done = 0
+    try:
+        while True:
+            job = _claim_purge_job(conn, me)
+            if job is None:
+                return done
+            started = time.perf_counter()
+            finished = _purge_batch(conn, job, me)
+            while finished is False:
+                time.sleep(PURGE_PAUSE_MS / 1000)
+                job = conn.execute("SELECT * FROM purge_jobs WHERE id = ?", (job['id'],)).fetchone()
+                finished = _purge_batch(conn, job, me)
+            if finished is None:
+                continue
+            job = conn.execute("SELECT * FROM purge_jobs WHERE id = ?", (job['id'],)).fetchone()
+            print(f"🧹 Exclusão concluída: {job['kind']} '{job['label']}' "
+                  f"({job['deleted_rows']} linhas dependentes em {time.perf_counter() - started:.1f}s).")
+            done += 1
+    finally:
+        db_pool.release(conn)
+
+def purge_jobs_report(conn, recent=20):
+    """Jobs pendentes e os últimos concluídos, com o progresso em %"""
+    rows = conn.execute(
+        "SELECT * FROM purge_jobs WHERE finished_at IS NULL "
+        "UNION ALL SELECT * FROM (SELECT * FROM purge_jobs WHERE finished_at IS NOT NULL ORDER BY id DESC LIMIT ?)",
+        (recent,)
+    ).fetchall()
+    report = []
+    for row in rows:
+        job = dict(row)
+        if job['finished_at']:
+            job['progress'] = 100.0
+        elif job['total_rows']:
+            job['progress'] = round(100.0 * job['deleted_rows'] / job['total_rows'], 1)
+        else:
+            job['progress'] = 0.0
+        report.append(job)
+    return report
+
+# --- Exportações (CSV / NDJSON em streaming) ---
+
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+def purchases_export_query(args):
+    """SQL + parâmetros da exportação de compras (?start=&end=&reseller_id=&product_id=)"""
+    sql = ("SELECT p.id, p.purchase_id_ref, p.created_at, p.reseller_id, u.username AS reseller, "
+           "pl.product_id, pr.name AS product_name, p.plan_id, pl.name AS plan_name, p.cost_paid "
+           "FROM purchases p "
+           "JOIN plans pl ON pl.id = p.plan_id "
+           "JOIN products pr ON pr.id = pl.product_id "
+           "JOIN users u ON u.id = p.reseller_id "
+           "WHERE pl.deleted_at IS NULL AND pr.deleted_at IS NULL AND u.deleted_at IS NULL ")
+    params = []
+    if args.get('start'):
+        sql += "AND p.created_at >= ? "
+        params.append(datetime.strptime(args['start'], '%Y-%m-%d').date().isoformat())
+    if args.get('end'):
+        sql += "AND p.created_at < ? "
+        params.append((datetime.strptime(args['end'], '%Y-%m-%d').date() + timedelta(days=1)).isoformat())
+    if args.get('reseller_id'):
+        sql += "AND p.reseller_id = ? "
+        params.append(int(args['reseller_id']))
+    if args.get('product_id'):
+        sql += "AND pl.product_id = ? "
+        params.append(int(args['product_id']))
+    # Ordem do rowid: sem ordenação em memória, as linhas saem do jeito que estão no disco
+    return sql + "ORDER BY p.id", params
+
+RESELLERS_EXPORT_SQL = (
+    "SELECT u.id, u.username, u.balance, u.balance_cents, u.created_at, "
+    "COALESCE(s.purchases, 0) AS purchases, COALESCE(s.spent_cents, 0) AS spent_cents "
+    "FROM users u LEFT JOIN ("
+    " SELECT reseller_id, SUM(purchases) AS purchases, SUM(revenue_cents) AS spent_cents"
+    " FROM sales_daily GROUP BY reseller_id"
+    ") s ON s.reseller_id = u.id "
+    "WHERE u.role = 'reseller' AND u.deleted_at IS NULL ORDER BY u.id"
+)
+
+def stream_export(name, fmt, sql, params):
+    """
+    Resposta em streaming (chunked) com as linhas da consulta em CSV ou NDJSON,
+    comprimida com gzip durante o envio se o cliente aceitar. O cursor é lido
+    em lotes de EXPORT_BATCH_ROWS, então o tamanho da exportação não pesa na memória.
+    """
+    use_gzip = 'gzip' in request.accept_encodings
+
+    def generate():
+        # Conexão própria (réplica, se houver): a do request é devolvida antes do fim do streaming
+        routed = read_router.acquire()
+        pool, conn = routed if routed else (db_pool, db_pool.acquire())
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if use_gzip else None
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        try:
+            # Transação de leitura: a exportação inteira vê o mesmo snapshot
+            conn.execute("BEGIN")
+            cursor = conn.execute(sql, params)
+            columns = [col[0] for col in cursor.description]
+            if fmt == 'csv':
+                writer.writerow(columns)
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_ROWS)
+                if rows:
+                    for row in rows:
+                        if fmt == 'csv':
+                            writer.writerow(row)
+                        else:
+                            buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+                chunk = buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+                if compressor:
+                    chunk = compressor.compress(chunk) + (b'' if rows else compressor.flush())
+                if chunk:
+                    yield chunk
+                if not rows:
+                    break
+        finally:
+            conn.rollback()
+            pool.release(conn)
+
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')
+    response = Response(generate(), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}-{stamp}.{fmt}"'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+# --- Listagens do Admin (busca por prefixo + paginação keyset) ---
+
+def prefix_range(prefix):
+    """Intervalo [prefixo, prefixo + maior caractere) -> busca por prefixo usando o índice"""
+    return prefix, prefix + '\U0010ffff'
+
+def fetch_resellers_page(conn, prefix='', cursor=None, limit=ADMIN_PAGE_SIZE):
+    """Revendedores em ordem de username; retorna (linhas, próximo_cursor ou None)"""
+    sql = "SELECT id, username, balance FROM users WHERE role = 'reseller' AND deleted_at IS NULL "
+    params = []
+    if prefix:
+        sql += "AND username >= ? AND username < ? "
+        params.extend(prefix_range(prefix))
+    if cursor:
+        (after,) = decode_cursor(cursor)
+        sql += "AND username > ? "
+        params.append(str(after))
+    sql += "ORDER BY username LIMIT ?"
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['username']) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def fetch_products_page(conn, prefix='', cursor=None, limit=ADMIN_PAGE_SIZE):
+    """Produtos em ordem de nome; retorna (linhas, próximo_cursor ou None)"""
+    sql = "SELECT * FROM products WHERE deleted_at IS NULL "
+    params = []
+    if prefix:
+        sql += "AND name >= ? AND name < ? "
+        params.extend(prefix_range(prefix))
+    if cursor:
+        name, product_id = decode_cursor(cursor)
+        sql += "AND (name, id) > (?, ?) "
+        params.extend([str(name), int(product_id)])
+    sql += "ORDER BY name, id LIMIT ?"
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = encode_cursor(rows[limit - 1]['name'], rows[limit - 1]['id']) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def fetch_plans_for_products(conn, product_ids):
+    """Planos apenas dos produtos da página atual"""
+    if not product_ids:
+        return []
+    placeholders = ", ".join("?" * len(product_ids))
+    return conn.execute(
+        "SELECT p.name as product_name, pl.* FROM plans pl "
+        "JOIN products p ON p.id = pl.product_id "
+        f"WHERE pl.product_id IN ({placeholders}) AND pl.deleted_at IS NULL ORDER BY p.name, pl.cost",
+        list(product_ids)
+    ).fetchall()
+
+# --- 2. HTML Templates (MODO DARK + PARTÍCULAS + MODAIS) ---
+
+# --- ESTILOS GLOBAIS E PARTÍCULAS (COM ESTILOS DE MODAL) ---
+# O CSS e o script ficam em static/ e são servidos com URL versionada (ver asset_url)
+GLOBAL_STYLES_AND_PARTICLES = '''
+<link rel="stylesheet" href="{{ asset_url('css/global.css') }}">
+
+<div class="particles" id="particles"></div>
+
+<script src="{{ asset_url('js/particles.js') }}" defer></script>
+'''
+
+# Template da Página de Login
+LOGIN_HTML = '''
+<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Painel de Revenda - Login</title>
+    {% include 'partials/global_styles.html' %}
+    <style>
+        body {
+            display: flex; justify-content: center;
+            align-items: center; height: 100vh;
+        }
+        .login-box {
+            background: var(--bg-card); padding: 40px;
+            border-radius: 12px; border: 1px solid var(--border-color);
+            box-shadow: 0 8px 25px rgba(0, 123, 255, 0.1);
+            width: 100%; max-width: 400px;
+            text-align: center; z-index: 1; position: relative;
+        }
+        .login-box h1 {
+            color: var(--primary); margin-bottom: 30px; font-size: 2.5rem;
+        }
+        .login-box button { width: 100%; margin-top: 15px; }
+    </style>
+</head>
+<body>
+    <div class="login-box">
+        <h1>Painel Revenda</h1>
+        {% if error %}
+            <div class="feedback error">{{ error }}</div>
+        {% endif %}
+        <form method="POST">
+            <input type="text" name="username" placeholder="Usuário" required>
+            <input type="password" name="password" placeholder="Senha" required style="margin-top: 15px;">
+            <button type="submit" class="btn btn-primary">Entrar</button>
+        </form>
+    </div>
+</body>
+</html>
+'''
+
+# Template dos Relatórios de Vendas (ADMIN)
+ADMIN_ANALYTICS_HTML = '''
+<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+    <meta charset="UTF-8">
+    <title>Relatórios de Vendas</title>
+    {% include 'partials/global_styles.html' %}
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>Relatórios de Vendas</h1>
+            <a href="{{ url_for('admin_panel') }}" class="btn btn-primary">&larr; Painel</a>
+        </div>
+
+        {% if error %}
+            <div class="feedback error">{{ error }}</div>
+        {% endif %}
+
+        <div class="card">
+            <form method="GET" action="{{ url_for('admin_analytics') }}" style="display: flex; gap: 10px; align-items: flex-end;">
+                <div style="flex: 1;"><label>De:</label><input type="date" name="start" value="{{ report.start }}"></div>
+                <div style="flex: 1;"><label>Até:</label><input type="date" name="end" value="{{ report.end }}"></div>
+                <button type="submit" class="btn btn-primary">Filtrar</button>
+                <a href="{{ url_for('admin_analytics', start=month_start) }}" class="btn btn-primary">Este mês</a>
+            </form>
+            <p style="margin-top: 20px;">
+                <strong>{{ report.totals.purchases }}</strong> vendas ·
+                <span style="color: var(--success); font-weight: bold;">R$ {{ "%.2f"|format(report.totals.revenue) }}</span>
+                de {{ report.start }} a {{ report.end }}
+                · <a href="{{ url_for('api_analytics', start=report.start, end=report.end) }}">JSON</a>
+            </p>
+        </div>
+
+        <div class="grid">
+            <div class="card">
+                <h2>Top Revendedores</h2>
+                <table>
+                    <tr><th>Revendedor</th><th>Vendas</th><th>Receita (R$)</th></tr>
+                    {% for r in report.top_resellers %}
+                    <tr><td>{{ r.username or '(excluído)' }}</td><td>{{ r.purchases }}</td><td>R$ {{ "%.2f"|format(r.revenue) }}</td></tr>
+                    {% else %}
+                    <tr><td colspan="3">Nenhuma venda no período.</td></tr>
+                    {% endfor %}
+                </table>
+            </div>
+            <div class="card">
+                <h2>Top Produtos</h2>
+                <table>
+                    <tr><th>Produto</th><th>Vendas</th><th>Receita (R$)</th></tr>
+                    {% for p in report.top_products %}
+                    <tr><td>{{ p.product_name or '(excluído)' }}</td><td>{{ p.purchases }}</td><td>R$ {{ "%.2f"|format(p.revenue) }}</td></tr>
+                    {% else %}
+                    <tr><td colspan="3">Nenhuma venda no período.</td></tr>
+                    {% endfor %}
+                </table>
+            </div>
+        </div>
+
+        <div class="card">
+            <h2>Receita por Produto por Dia</h2>
+            <table>
+                <tr><th>Dia</th><th>Produto</th><th>Vendas</th><th>Receita (R$)</th></tr>
+                {% for d in report.daily %}
+                <tr><td>{{ d.day }}</td><td>{{ d.product_name or '(excluído)' }}</td><td>{{ d.purchases }}</td><td>R$ {{ "%.2f"|format(d.revenue) }}</td></tr>
+                {% else %}
+                <tr><td colspan="4">Nenhuma venda no período.</td></tr>
+                {% endfor %}
+            </table>
+        </div>
+    </div>
+</body>
+</html>
+'''
+
+# Template das Consultas Lentas (ADMIN)
+ADMIN_SLOW_QUERIES_HTML = '''
+<!DOCTYPE html>
+<html lang="pt-BR">
+<head>
+    <meta charset="UTF-8">
+    <title>Consultas Lentas</title>
+    {% include 'partials/global_styles.html' %}
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>Consultas Lentas</h1>
+            <a href="{{ url_for('admin_panel') }}" class="btn btn-primary">&larr; Painel</a>
+        </div>
+
+        <div class="card">
+            <p>
+                Instruções acima de <strong>{{ threshold_ms }} ms</strong>
+                {% if threshold_ms <= 0 %}(desligado: defina SLOW_QUERY_MS){% endif %}
+                · log em <code>{{ log_path }}</code>
+                · <a href="{{ url_for('api_slow_queries', order=order) }}">JSON</a>
+            </p>
+            <div class="inline-actions" style="margin-top: 10px;">
+                {% for key, label in [('total', 'Tempo total'), ('max', 'Pior caso'), ('calls', 'Ocorrências'), ('recent', 'Mais recentes')] %}
+                <a href="{{ url_for('admin_slow_queries', order=key) }}" class="btn {{ 'btn-success' if key == order else 'btn-primary' }}">{{ label }}</a>
+                {% endfor %}
+            </div>
+        </div>
+
+        <div class="card">
+            <table>
+                <tr><th>Instrução</th><th>Ocorrências</th><th>Total (ms)</th><th>Média (ms)</th><th>Pior (ms)</th><th>Última rota</th><th>Última vez (UTC)</th></tr>
+                {% for q in queries %}
+                <tr>
+                    <td>
+                        <code>{{ q.statement }}</code>
+                        {% if q.plan %}
+                        <details><summary>Plano</summary><pre>{{ q.plan }}</pre></details>
+                        {% endif %}
+                    </td>
+                    <td>{{ q.calls }}</td>
+                    <td>{{ q.total_ms }}</td>
+                    <td>{{ q.avg_ms }}</td>
+                    <td>{{ q.max_ms }}</td>
+                    <td>{{ q.route }}{% if q.params is not none %} ({{ q.params }} parâmetros){% endif %}</td>
+                    <td>{{ q.last_seen }}</td>
+                </tr>
+                {% else %}
+                <tr><td colspan="7">Nenhuma consulta lenta registrada.</td></tr>
+                {% endfor %}
+            </table>
+        </div>
+    </div>
+</body>
+</html>
 '''
 
-# Template da Página de Login
-LOGIN_HTML = '''
+# Template do Profiling (ADMIN)
+ADMIN_PROFILING_HTML = '''
 <!DOCTYPE html>
 <html lang="pt-BR">
 <head>
     <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Painel de Revenda - Login</title>
-    {{ GLOBAL_STYLES_AND_PARTICLES | safe }}
-    <style>
-        body {
-            display: flex; justify-content: center;
-            align-items: center; height: 100vh;
-        }
-        .login-box {
-            background: var(--bg-card); padding: 40px;
-            border-radius: 12px; border: 1px solid var(--border-color);
-            box-shadow: 0 8px 25px rgba(0, 123, 255, 0.1);
-            width: 100%; max-width: 400px;
-            text-align: center; z-index: 1; position: relative;
-        }
-        .login-box h1 {
-            color: var(--primary); margin-bottom: 30px; font-size: 2.5rem;
-        }
-        .login-box button { width: 100%; margin-top: 15px; }
-    </style>
+    <title>Profiling</title>
+    {% include 'partials/global_styles.html' %}
 </head>
 <body>
-    <div class="login-box">
-        <h1>Painel Revenda</h1>
-        {% if error %}
-            <div class="feedback error">{{ error }}</div>
+    <div class="container">
+        <div class="header">
+            <h1>Profiling</h1>
+            <a href="{{ url_for('admin_panel') }}" class="btn btn-primary">&larr; Painel</a>
+        </div>
+
+        {% with messages = get_flashed_messages(with_categories=true) %}
+            {% for category, message in messages %}
+                <div class="feedback {{ category }}">{{ message }}</div>
+            {% endfor %}
+        {% endwith %}
+
+        {% if not enabled %}
+            <div class="feedback error">Profiling desligado. Suba os workers com PROFILING_ENABLED=1.</div>
         {% endif %}
-        <form method="POST">
-            <input type="text" name="username" placeholder="Usuário" required>
-            <input type="password" name="password" placeholder="Senha" required style="margin-top: 15px;">
-            <button type="submit" class="btn btn-primary">Entrar</button>
-        </form>
+
+        <div class="grid">
+            <div class="card">
+                <h2>Amostragem de Pilhas</h2>
+                <p>Liga a amostragem (a cada {{ interval_ms }} ms) em todos os workers por alguns segundos.
+                   Cada worker grava um arquivo <code>.collapsed</code> (flamegraph.pl / speedscope).</p>
+                <form method="POST" action="{{ url_for('admin_profiling_sample') }}" style="display: flex; gap: 10px; align-items: flex-end;">
+                    <div style="flex: 1;"><label>Segundos (máx. {{ max_seconds }}):</label>
+                        <input type="number" name="seconds" value="30" min="1" max="{{ max_seconds }}" required></div>
+                    <button type="submit" class="btn btn-warning" {% if not enabled %}disabled{% endif %}>Amostrar</button>
+                </form>
+            </div>
+            <div class="card">
+                <h2>Perfil de uma Requisição</h2>
+                <p>Logado como admin, repita a requisição com o header <code>X-Profile: 1</code>
+                   ou com <code>?_profile=1</code> na URL. O cProfile vai para um arquivo <code>.prof</code>
+                   (snakeviz / flameprof), indicado no header <code>X-Profile-File</code> da resposta.</p>
+            </div>
+        </div>
+
+        <div class="card">
+            <h2>Arquivos em <code>{{ profile_dir }}</code></h2>
+            <table>
+                <tr><th>Arquivo</th><th>Tamanho (KB)</th><th>Gerado em (UTC)</th></tr>
+                {% for f in files %}
+                <tr><td><a href="{{ url_for('admin_profile_file', name=f.name) }}">{{ f.name }}</a></td><td>{{ f.size_kb }}</td><td>{{ f.modified }}</td></tr>
+                {% else %}
+                <tr><td colspan="3">Nenhum perfil gravado.</td></tr>
+                {% endfor %}
+            </table>
+        </div>
     </div>
 </body>
 </html>
@@ -366,13 +2979,18 @@ ADMIN_PANEL_HTML = '''
 <head>
     <meta charset="UTF-8">
     <title>Painel Admin</title>
-    {{ GLOBAL_STYLES_AND_PARTICLES | safe }}
+    {% include 'partials/global_styles.html' %}
 </head>
 <body>
     <div class="container">
         <div class="header">
             <h1>Painel Admin <span style="color: var(--text-dim); font-size: 1.2rem;">({{ session.username }})</span></h1>
-            <a href="/logout" class="btn btn-danger">Sair</a>
+            <div class="inline-actions">
+                <a href="{{ url_for('admin_analytics') }}" class="btn btn-primary">Relatórios</a>
+                <a href="{{ url_for('admin_slow_queries') }}" class="btn btn-primary">Consultas Lentas</a>
+                <a href="{{ url_for('admin_profiling') }}" class="btn btn-primary">Profiling</a>
+                <a href="/logout" class="btn btn-danger">Sair</a>
+            </div>
         </div>
         
         {% with messages = get_flashed_messages(with_categories=true) %}
@@ -383,6 +3001,23 @@ ADMIN_PANEL_HTML = '''
             {% endif %}
         {% endwith %}
 
+        {% if purges %}
+        <div class="card">
+            <h2>Exclusões em Andamento</h2>
+            <table>
+                <tr><th>Tipo</th><th>Nome</th><th>Linhas apagadas</th><th>Progresso</th></tr>
+                {% for job in purges %}
+                <tr>
+                    <td>{{ {'reseller': 'Revendedor', 'product': 'Produto', 'plan': 'Plano'}[job.kind] }}</td>
+                    <td>{{ job.label }}</td>
+                    <td>{{ job.deleted_rows }}{% if job.total_rows is not none %} de {{ job.total_rows }}{% endif %}</td>
+                    <td>{{ job.progress }}%</td>
+                </tr>
+                {% endfor %}
+            </table>
+        </div>
+        {% endif %}
+
         <div class="grid">
             <div class="card">
                 <h2>Gerenciar Revendedores</h2>
@@ -398,19 +3033,38 @@ ADMIN_PANEL_HTML = '''
 
                 <h3 style="margin-top: 30px;">Adicionar Créditos (Saldo)</h3>
                 <form method="POST" action="/admin/add_credits">
+                    <input type="hidden" name="idempotency_key" value="{{ form_token }}">
                     <label>Revendedor:</label>
-                    <select name="reseller_id" required>
-                        <option value="">-- Selecione um Revendedor --</option>
-                        {% for r in resellers %}
-                        <option value="{{ r.id }}">{{ r.username }}</option>
-                        {% endfor %}
-                    </select>
+                    <input type="text" list="resellerOptions" placeholder="Digite o nome do revendedor" autocomplete="off"
+                           data-autocomplete="{{ url_for('admin_autocomplete', kind='resellers') }}" data-target="creditsResellerId" required>
+                    <datalist id="resellerOptions"></datalist>
+                    <input type="hidden" name="reseller_id" id="creditsResellerId">
                     <label>Valor:</label>
                     <input type="number" name="amount" placeholder="Valor (ex: 150.00)" step="0.01" required>
                     <button type="submit" class="btn btn-success" style="margin-top: 15px;">Adicionar Saldo</button>
                 </form>
 
+                <h3 style="margin-top: 30px;">Operações em Lote (CSV)</h3>
+                <form method="POST" action="/admin/bulk" enctype="multipart/form-data">
+                    <input type="hidden" name="idempotency_key" value="{{ form_token }}-bulk">
+                    <label>Operação:</label>
+                    <select name="kind">
+                        <option value="credits">Créditos (username,amount)</option>
+                        <option value="resellers">Novos revendedores (username,password,balance)</option>
+                    </select>
+                    <label>Arquivo CSV:</label>
+                    <input type="file" name="file" accept=".csv,text/csv">
+                    <label>Ou cole as linhas (com cabeçalho):</label>
+                    <textarea name="data" rows="4" placeholder="username,amount"></textarea>
+                    <button type="submit" class="btn btn-success" style="margin-top: 15px;">Aplicar Lote</button>
+                </form>
+
                 <h3 style="margin-top: 30px;">Lista de Revendedores</h3>
+                <form method="GET" action="/admin" style="display: flex; gap: 10px;">
+                    <input type="text" name="q" value="{{ q }}" placeholder="Buscar por início do nome">
+                    {% if pq %}<input type="hidden" name="pq" value="{{ pq }}">{% endif %}
+                    <button type="submit" class="btn btn-primary" style="margin-top: 5px; width: 150px;">Buscar</button>
+                </form>
                 <table>
                     <tr><th>Usuário</th><th>Saldo (R$)</th><th>Ações</th></tr>
                     {% for r in resellers %}
@@ -435,6 +3089,14 @@ ADMIN_PANEL_HTML = '''
                     <tr><td colspan="3">Nenhum revendedor encontrado.</td></tr>
                     {% endfor %}
                 </table>
+                <div class="inline-actions" style="margin-top: 10px;">
+                    {% if reseller_cursor %}
+                    <a href="{{ url_for('admin_panel', q=q or None, pq=pq or None, pafter=product_cursor) }}" class="btn btn-primary">Início</a>
+                    {% endif %}
+                    {% if next_reseller_cursor %}
+                    <a href="{{ url_for('admin_panel', q=q or None, pq=pq or None, after=next_reseller_cursor, pafter=product_cursor) }}" class="btn btn-primary">Próximos &rarr;</a>
+                    {% endif %}
+                </div>
             </div>
 
             <div class="card">
@@ -443,12 +3105,10 @@ ADMIN_PANEL_HTML = '''
                 <h3>Adicionar/Editar Plano (com Link)</h3>
                 <form method="POST" action="/admin/create_plan">
                     <label>Produto:</label>
-                    <select name="product_id" required>
-                        <option value="">-- Selecione o Produto --</option>
-                        {% for p in products %}
-                        <option value="{{ p.id }}">{{ p.name }}</option>
-                        {% endfor %}
-                    </select>
+                    <input type="text" list="productOptions" placeholder="Digite o nome do produto" autocomplete="off"
+                           data-autocomplete="{{ url_for('admin_autocomplete', kind='products') }}" data-target="planProductId" required>
+                    <datalist id="productOptions"></datalist>
+                    <input type="hidden" name="product_id" id="planProductId">
                     <label>Nome do Plano:</label>
                     <input type="text" name="name" placeholder="Nome (ex: Mensal)" required>
                     <label>Custo (R$):</label>
@@ -466,6 +3126,11 @@ ADMIN_PANEL_HTML = '''
                     <input type="text" name="name" placeholder="Nome do Novo Produto" required>
                     <button type="submit" class="btn btn-success" style="margin-top: 5px; width: 150px;">Criar Produto</button>
                 </form>
+                <form method="GET" action="/admin" style="display: flex; gap: 10px;">
+                    <input type="text" name="pq" value="{{ pq }}" placeholder="Buscar produto por início do nome">
+                    {% if q %}<input type="hidden" name="q" value="{{ q }}">{% endif %}
+                    <button type="submit" class="btn btn-primary" style="margin-top: 5px; width: 150px;">Buscar</button>
+                </form>
                 <table style="margin-top: 10px;">
                     <tr><th>Nome do Produto</th><th>Ações</th></tr>
                     {% for p in products %}
@@ -489,9 +3154,17 @@ ADMIN_PANEL_HTML = '''
                     <tr><td colspan="2">Nenhum produto criado.</td></tr>
                     {% endfor %}
                 </table>
+                <div class="inline-actions" style="margin-top: 10px;">
+                    {% if product_cursor %}
+                    <a href="{{ url_for('admin_panel', q=q or None, pq=pq or None, after=reseller_cursor) }}" class="btn btn-primary">Início</a>
+                    {% endif %}
+                    {% if next_product_cursor %}
+                    <a href="{{ url_for('admin_panel', q=q or None, pq=pq or None, after=reseller_cursor, pafter=next_product_cursor) }}" class="btn btn-primary">Próximos &rarr;</a>
+                    {% endif %}
+                </div>
 
 
-                <h3 style="margin-top: 30px;">Planos Atuais</h3>
+                <h3 style="margin-top: 30px;">Planos Atuais <span style="color: var(--text-dim); font-size: 0.9rem;">(dos produtos listados acima)</span></h3>
                 <table>
                     <tr><th>Produto</th><th>Plano</th><th>Custo (R$)</th><th>Link</th><th>Ações</th></tr>
                     {% for p in plans %}
@@ -520,6 +3193,38 @@ ADMIN_PANEL_HTML = '''
                 </table>
             </div>
         </div>
+
+        <div class="card">
+            <h2>Exportar Dados</h2>
+            <form method="GET" action="{{ url_for('export_purchases', fmt='csv') }}" id="exportForm">
+                <div class="grid">
+                    <div>
+                        <label>De:</label>
+                        <input type="date" name="start">
+                        <label>Revendedor (opcional):</label>
+                        <input type="text" list="exportResellerOptions" placeholder="Todos" autocomplete="off" data-optional
+                               data-autocomplete="{{ url_for('admin_autocomplete', kind='resellers') }}" data-target="exportResellerId">
+                        <datalist id="exportResellerOptions"></datalist>
+                        <input type="hidden" name="reseller_id" id="exportResellerId">
+                    </div>
+                    <div>
+                        <label>Até:</label>
+                        <input type="date" name="end">
+                        <label>Produto (opcional):</label>
+                        <input type="text" list="exportProductOptions" placeholder="Todos" autocomplete="off" data-optional
+                               data-autocomplete="{{ url_for('admin_autocomplete', kind='products') }}" data-target="exportProductId">
+                        <datalist id="exportProductOptions"></datalist>
+                        <input type="hidden" name="product_id" id="exportProductId">
+                    </div>
+                </div>
+                <div class="inline-actions" style="margin-top: 15px;">
+                    <button type="submit" class="btn btn-success">Compras (CSV)</button>
+                    <button type="submit" class="btn btn-success" formaction="{{ url_for('export_purchases', fmt='ndjson') }}">Compras (NDJSON)</button>
+                    <a href="{{ url_for('export_resellers', fmt='csv') }}" class="btn btn-primary">Revendedores (CSV)</a>
+                    <a href="{{ url_for('export_resellers', fmt='ndjson') }}" class="btn btn-primary">Revendedores (NDJSON)</a>
+                </div>
+            </form>
+        </div>
     </div>
     
     <div id="editResellerModal" class="modal">
@@ -577,6 +3282,46 @@ ADMIN_PANEL_HTML = '''
                 event.target.style.display = 'none';
             }
         }
+
+        // Autocomplete (revendedor / produto): preenche o campo hidden com o id escolhido
+        document.querySelectorAll('input[data-autocomplete]').forEach(function(input) {
+            const list = document.getElementById(input.getAttribute('list'));
+            const target = document.getElementById(input.dataset.target);
+            let timer = null;
+
+            function selectMatch() {
+                const match = Array.from(list.options).find(function(o) { return o.value === input.value; });
+                target.value = match ? match.dataset.id : '';
+            }
+
+            input.addEventListener('input', function() {
+                selectMatch();
+                if (target.value) { return; }
+                clearTimeout(timer);
+                timer = setTimeout(function() {
+                    fetch(input.dataset.autocomplete + '?q=' + encodeURIComponent(input.value))
+                        .then(function(resp) { return resp.json(); })
+                        .then(function(items) {
+                            list.innerHTML = '';
+                            items.forEach(function(item) {
+                                const option = document.createElement('option');
+                                option.value = item.label;
+                                option.dataset.id = item.id;
+                                list.appendChild(option);
+                            });
+                            selectMatch();
+                        });
+                }, 150);
+            });
+
+            input.form.addEventListener('submit', function(event) {
+                // Filtros opcionais (data-optional) podem ficar em branco
+                if (!target.value && !('optional' in input.dataset && !input.value)) {
+                    event.preventDefault();
+                    alert('Selecione um item da lista de sugestões.');
+                }
+            });
+        });
     </script>
 </body>
 </html>
@@ -589,7 +3334,7 @@ RESELLER_PANEL_HTML = '''
 <head>
     <meta charset="UTF-8">
     <title>Painel do Revendedor</title>
-    {{ GLOBAL_STYLES_AND_PARTICLES | safe }}
+    {% include 'partials/global_styles.html' %}
     <style>
         h2 { border-bottom-color: var(--success); color: var(--success); }
     </style>
@@ -628,6 +3373,7 @@ RESELLER_PANEL_HTML = '''
                     <td>
                         <form method="POST" action="/reseller/purchase" style="margin:0;" onsubmit="return confirm('Tem certeza que deseja comprar este produto? O custo de R$ {{ "%.2f"|format(p.cost) }} será descontado do seu saldo.');">
                             <input type="hidden" name="plan_id" value="{{ p.id }}">
+                            <input type="hidden" name="idempotency_key" value="{{ form_token }}-{{ p.id }}">
                             
                             {% set disabled = not p.download_link or p.cost > reseller.balance %}
                             {% set title = "" %}
@@ -651,7 +3397,7 @@ RESELLER_PANEL_HTML = '''
         <div class="card">
             <h2>Meu Histórico de Compras</h2>
             <p style="color: var(--text-dim);">Use o <strong class="code">ID da Compra</strong> para me pedir a chave KeyAuth (via Discord/WhatsApp).</p>
-            <table>
+            <table id="purchaseTable">
                 <tr><th>ID da Compra</th><th>Produto</th><th>Plano</th><th>Custo Pago</th><th>Data</th><th>Download</th></tr>
                 {% for p in purchases %}
                 <tr>
@@ -670,39 +3416,230 @@ RESELLER_PANEL_HTML = '''
                 <tr><td colspan="6">Nenhuma compra realizada ainda.</td></tr>
                 {% endfor %}
             </table>
+            {% if next_cursor %}
+            <button id="loadMoreBtn" class="btn btn-primary" style="margin-top: 15px;"
+                    data-cursor="{{ next_cursor }}" onclick="loadMorePurchases()">
+                Carregar mais
+            </button>
+            {% endif %}
         </div>
     </div>
+
+    <script>
+        function loadMorePurchases() {
+            const btn = document.getElementById('loadMoreBtn');
+            btn.disabled = true;
+            fetch('{{ url_for("reseller_purchases") }}?cursor=' + encodeURIComponent(btn.dataset.cursor))
+                .then(function(resp) { return resp.json(); })
+                .then(function(page) {
+                    const tbody = document.getElementById('purchaseTable').tBodies[0];
+                    page.items.forEach(function(p) {
+                        const row = document.createElement('tr');
+                        const cells = [p.purchase_id_ref, p.product_name, p.plan_name,
+                                       'R$ ' + p.cost_paid.toFixed(2), p.created_at.split(' ')[0]];
+                        cells.forEach(function(text, i) {
+                            const td = document.createElement('td');
+                            if (i === 0) {
+                                const strong = document.createElement('strong');
+                                strong.className = 'code';
+                                strong.textContent = text;
+                                td.appendChild(strong);
+                            } else {
+                                td.textContent = text;
+                            }
+                            row.appendChild(td);
+                        });
+                        const linkCell = document.createElement('td');
+                        const link = document.createElement('a');
+                        link.href = p.download_url;
+                        link.className = 'btn btn-success';
+                        link.target = '_blank';
+                        link.textContent = 'Link de Download';
+                        linkCell.appendChild(link);
+                        row.appendChild(linkCell);
+                        tbody.appendChild(row);
+                    });
+                    if (page.next_cursor) {
+                        btn.dataset.cursor = page.next_cursor;
+                        btn.disabled = false;
+                    } else {
+                        btn.remove();
+                    }
+                })
+                .catch(function() { btn.disabled = false; });
+        }
+    </script>
 </body>
 </html>
 '''
 
+# --- Assets Estáticos (URL com hash + variantes pré-comprimidas) ---
+
+STATIC_ASSETS = ['css/global.css', 'js/particles.js']
+ASSET_MIMETYPES = {'.css': 'text/css', '.js': 'text/javascript'}  # o Werkzeug acrescenta '; charset=utf-8'
+
+ASSET_URLS = {}    # 'css/global.css' -> 'css/global.<hash>.css'
+ASSET_FILES = {}   # 'css/global.<hash>.css' -> {'mimetype', 'etag', 'identity', 'gzip', 'br'}
+
+def build_assets():
+    """Lê os assets, calcula o hash do conteúdo e gera as versões .gz/.br em memória"""
+    for name in STATIC_ASSETS:
+        with open(os.path.join(app.static_folder, name), 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        base, ext = os.path.splitext(name)
+        fingerprinted = f"{base}.{digest}{ext}"
+
+        variants = {'identity': data, 'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(data, quality=11)
+
+        ASSET_URLS[name] = fingerprinted
+        ASSET_FILES[fingerprinted] = {'mimetype': ASSET_MIMETYPES[ext], 'etag': digest, **variants}
+
+def asset_url(name):
+    """URL versionada de um asset (usada nos templates)"""
+    return url_for('serve_asset', filename=ASSET_URLS[name])
+
+@app.route("/assets/<path:filename>")
+def serve_asset(filename):
+    asset = ASSET_FILES.get(filename)
+    if asset is None:
+        return "Not Found", 404
+
+    if request.if_none_match.contains(asset['etag']):
+        response = app.response_class(status=304)
+    else:
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in asset and candidate in request.accept_encodings:
+                encoding = candidate
+                break
+        response = app.response_class(asset[encoding], mimetype=asset['mimetype'])
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(asset['etag'])
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+build_assets()
+
+# --- Registro de Templates (compilados uma única vez) ---
+
+TEMPLATES = {
+    'partials/global_styles.html': GLOBAL_STYLES_AND_PARTICLES,
+    'login.html': LOGIN_HTML,
+    'admin_panel.html': ADMIN_PANEL_HTML,
+    'admin_analytics.html': ADMIN_ANALYTICS_HTML,
+    'admin_slow_queries.html': ADMIN_SLOW_QUERIES_HTML,
+    'admin_profiling.html': ADMIN_PROFILING_HTML,
+    'reseller_panel.html': RESELLER_PANEL_HTML,
+}
+
+# Precisa ser configurado antes do primeiro acesso a app.jinja_env
+app.jinja_loader = DictLoader(TEMPLATES)
+app.jinja_options = {**app.jinja_options,
+                     'bytecode_cache': FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)}
+app.jinja_env.globals['asset_url'] = asset_url
+
+def warm_templates():
+    """Compila todos os templates no startup (ficam no cache do jinja_env)"""
+    start = time.perf_counter()
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    print(f"⚡ {len(TEMPLATES)} templates pré-compilados em {elapsed_ms:.1f} ms.")
+
+warm_templates()
+
 # --- 3. Rotas da Aplicação (COMPLETAS E CORRIGIDAS) ---
 
+def current_user():
+    """
+    Snapshot do usuário logado (id, username, role) tirado da sessão, validado
+    contra session_versions e cacheado em g. Retorna None se não há login ou
+    se a sessão foi revogada.
+    """
+    if 'current_user' not in g:
+        g.current_user = None
+        user_id = session.get('user_id')
+        if user_id is not None and session_versions.current(user_id) == session.get('session_version', 0):
+            g.current_user = {'id': user_id, 'username': session['username'], 'role': session['role']}
+    return g.current_user
+
 # Função helper para checar sessão
 def require_role(role_name):
-    from functools import wraps
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if 'user_id' not in session or session.get('role') != role_name:
+            user = current_user()
+            if user is None or user['role'] != role_name:
                 return redirect(url_for('login'))
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
+def authenticate(username, password):
+    """Confere usuário e senha; retorna a linha do usuário ou None (pode levantar HasherBusy)"""
+    conn = get_db()
+    user = conn.execute("SELECT * FROM users WHERE username = ? AND deleted_at IS NULL", (username,)).fetchone()
+    if not user or not password_hasher.verify(user["password"], password):
+        return None
+    if password_hasher.needs_rehash(user["password"]):
+        # Hash antigo (método/custo desatualizado): regrava com a senha já validada
+        try:
+            conn.execute("UPDATE users SET password = ? WHERE id = ?",
+                         (password_hasher.hash(password), user['id']))
+            conn.commit()
+        except HasherBusy:
+            pass # Tenta de novo no próximo login
+    return user
+
+def start_session(user):
+    # Id novo a cada login (contra fixação de sessão); no backend 'cookie' não há id no servidor
+    regenerate = getattr(app.session_interface, 'regenerate', None)
+    if regenerate is not None:
+        regenerate(session)
+    session['user_id'] = user['id']
+    session['username'] = user['username']
+    session['role'] = user['role']
+    session['session_version'] = user['session_version']
+
+# Função helper de rate limit: key_func retorna a chave do balde (ou None para não limitar)
+def rate_limit(scope, rate, key_func):
+    capacity, refill = parse_rate(rate)
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = key_func()
+            if key is not None:
+                allowed, retry_after = rate_limiter.take(scope, key, capacity, refill)
+                if not allowed:
+                    seconds = max(1, math.ceil(retry_after))
+                    return (f"Muitas tentativas. Tente novamente em {seconds} s.", 429,
+                            {'Retry-After': str(seconds)})
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+def _login_attempt_key(value_func):
+    # Só tentativas de login (POST) contam; abrir a página não consome fichas
+    return lambda: value_func() if request.method == "POST" else None
+
 # --- Rotas de Login / Logout / Dashboard ---
 
 @app.route("/", methods=["GET", "POST"])
+@rate_limit('login_ip', LOGIN_IP_RATE_LIMIT, _login_attempt_key(lambda: request.remote_addr))
+@rate_limit('login_user', LOGIN_USER_RATE_LIMIT, _login_attempt_key(lambda: request.form.get('username')))
 def login():
     if session.get('user_id'):
-        # Se já está logado, verifica se o usuário ainda existe
-        conn = get_db()
-        user = conn.execute("SELECT * FROM users WHERE id = ?", (session['user_id'],)).fetchone()
-        conn.close()
-        if user:
+        # Se já está logado, verifica se o usuário ainda existe (e a sessão não foi revogada)
+        if current_user():
             return redirect(url_for('dashboard'))
         else:
-            # Usuário não existe (foi deletado), limpa a sessão
+            # Usuário não existe (foi deletado) ou foi alterado, limpa a sessão
             session.clear()
             
     error = None
@@ -710,19 +3647,18 @@ def login():
         username = request.form["username"]
         password = request.form["password"]
         
-        conn = get_db()
-        user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-        conn.close()
+        try:
+            user = authenticate(username, password)
+        except HasherBusy as e:
+            return render_template('login.html', error=str(e)), 503
         
-        if user and check_password_hash(user["password"], password):
-            session['user_id'] = user['id']
-            session['username'] = user['username']
-            session['role'] = user['role']
+        if user:
+            start_session(user)
             return redirect(url_for('dashboard'))
         else:
             error = "Usuário ou senha inválidos."
             
-    return render_template_string(LOGIN_HTML, GLOBAL_STYLES_AND_PARTICLES=GLOBAL_STYLES_AND_PARTICLES, error=error)
+    return render_template('login.html', error=error)
 
 @app.route("/logout")
 def logout():
@@ -735,18 +3671,16 @@ def dashboard():
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
-    conn = get_db()
-    user = conn.execute("SELECT * FROM users WHERE id = ?", (session['user_id'],)).fetchone()
-    conn.close()
+    user = current_user()
     
     if not user:
-        # Usuário foi deletado, limpa sessão e vai para login
+        # Usuário foi deletado (ou sessão revogada), limpa sessão e vai para login
         session.clear()
         return redirect(url_for('login'))
 
-    if session['role'] == 'admin':
+    if user['role'] == 'admin':
         return redirect(url_for('admin_panel'))
-    elif session['role'] == 'reseller':
+    elif user['role'] == 'reseller':
         return redirect(url_for('reseller_panel'))
     else:
         # Se a role for desconhecida (como 'trader'), desloga
@@ -759,16 +3693,113 @@ def dashboard():
 @app.route("/admin")
 @require_role('admin')
 def admin_panel():
-    conn = get_db()
-    resellers = conn.execute("SELECT * FROM users WHERE role = 'reseller' ORDER BY username").fetchall()
-    products = conn.execute("SELECT * FROM products ORDER BY name").fetchall()
-    plans = conn.execute(
-        "SELECT p.name as product_name, pl.* FROM plans pl "
-        "JOIN products p ON p.id = pl.product_id ORDER BY p.name, pl.cost"
-    ).fetchall()
-    conn.close()
+    conn = get_read_db()
+    q = request.args.get('q', '').strip()
+    pq = request.args.get('pq', '').strip()
+    reseller_cursor = request.args.get('after') or None
+    product_cursor = request.args.get('pafter') or None
+
+    try:
+        resellers, next_reseller_cursor = fetch_resellers_page(conn, q, reseller_cursor)
+        products, next_product_cursor = fetch_products_page(conn, pq, product_cursor)
+    except (ValueError, TypeError):
+        flash('Paginação inválida, voltando ao início.', 'error')
+        return redirect(url_for('admin_panel'))
+    plans = fetch_plans_for_products(conn, [p['id'] for p in products])
+    purges = purge_jobs_report(conn, recent=0)
     
-    return render_template_string(ADMIN_PANEL_HTML, GLOBAL_STYLES_AND_PARTICLES=GLOBAL_STYLES_AND_PARTICLES, resellers=resellers, products=products, plans=plans)
+    return render_template('admin_panel.html', resellers=resellers, products=products, plans=plans,
+                           form_token=uuid.uuid4().hex, purges=purges,
+                           q=q, pq=pq, reseller_cursor=reseller_cursor, product_cursor=product_cursor,
+                           next_reseller_cursor=next_reseller_cursor, next_product_cursor=next_product_cursor)
+
+@app.route("/admin/analytics")
+@require_role('admin')
+def admin_analytics():
+    error = None
+    try:
+        start, end = report_range(request.args)
+    except ValueError as e:
+        error = f'Período inválido: {e}'
+        start, end = report_range({})
+    report = sales_report(get_read_db(), start, end)
+    month_start = datetime.now(timezone.utc).date().replace(day=1).isoformat()
+    return render_template('admin_analytics.html', report=report, error=error, month_start=month_start)
+
+@app.route("/admin/slow-queries")
+@require_role('admin')
+def admin_slow_queries():
+    order = request.args.get('order', 'total')
+    if order not in SLOW_QUERY_ORDERS:
+        order = 'total'
+    # As ocorrências deste worker entram na hora; as dos outros, no próximo flush deles
+    slow_queries.flush()
+    return render_template('admin_slow_queries.html', queries=slow_query_report(get_db(), order),
+                           order=order, threshold_ms=SLOW_QUERY_MS, log_path=SLOW_QUERY_LOG)
+
+@app.route("/admin/profiling")
+@require_role('admin')
+def admin_profiling():
+    return render_template('admin_profiling.html', files=profile_files(), enabled=PROFILING_ENABLED,
+                           profile_dir=PROFILE_DIR, interval_ms=PROFILE_SAMPLE_INTERVAL_MS,
+                           max_seconds=PROFILE_MAX_SECONDS)
+
+@app.route("/admin/profiling/sample", methods=["POST"])
+@require_role('admin')
+def admin_profiling_sample():
+    if not PROFILING_ENABLED:
+        flash('Profiling desligado (PROFILING_ENABLED=1).', 'error')
+        return redirect(url_for('admin_profiling'))
+    try:
+        seconds = int(request.form['seconds'])
+        if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError
+    except (KeyError, ValueError):
+        flash(f'Informe de 1 a {PROFILE_MAX_SECONDS} segundos.', 'error')
+        return redirect(url_for('admin_profiling'))
+    run_id = request_sampling(get_db(), seconds, session['username'])
+    flash(f'Amostragem #{run_id} ligada por {seconds} s. Os outros workers entram em até '
+          f'{PROFILE_POLL_INTERVAL} s; recarregue a página depois para ver os arquivos.', 'success')
+    return redirect(url_for('admin_profiling'))
+
+@app.route("/admin/profiling/files/<name>")
+@require_role('admin')
+def admin_profile_file(name):
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True)
+
+@app.route("/admin/export/purchases.<fmt>")
+@require_role('admin')
+def export_purchases(fmt):
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'Formato inválido (use csv ou ndjson).'}), 404
+    try:
+        sql, params = purchases_export_query(request.args)
+    except ValueError:
+        return jsonify({'error': 'Filtro inválido (datas AAAA-MM-DD, ids numéricos).'}), 400
+    return stream_export('compras', fmt, sql, params)
+
+@app.route("/admin/export/resellers.<fmt>")
+@require_role('admin')
+def export_resellers(fmt):
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'Formato inválido (use csv ou ndjson).'}), 404
+    return stream_export('revendedores', fmt, RESELLERS_EXPORT_SQL, [])
+
+@app.route("/admin/autocomplete/<kind>")
+@require_role('admin')
+def admin_autocomplete(kind):
+    """Sugestões por prefixo (substitui os <select> gigantes do painel)"""
+    prefix = request.args.get('q', '').strip()
+    conn = get_read_db()
+    if kind == 'resellers':
+        rows, _ = fetch_resellers_page(conn, prefix, limit=AUTOCOMPLETE_LIMIT)
+        items = [{'id': r['id'], 'label': r['username']} for r in rows]
+    elif kind == 'products':
+        rows, _ = fetch_products_page(conn, prefix, limit=AUTOCOMPLETE_LIMIT)
+        items = [{'id': p['id'], 'label': f"{p['name']} (#{p['id']})"} for p in rows]
+    else:
+        return jsonify({'error': 'Tipo inválido.'}), 404
+    return jsonify(items)
 
 @app.route("/admin/create_reseller", methods=["POST"])
 @require_role('admin')
@@ -781,15 +3812,16 @@ def create_reseller():
         return redirect(url_for('admin_panel'))
         
     try:
-        hashed_pass = generate_password_hash(password)
+        hashed_pass = password_hasher.hash(password)
         conn = get_db()
         conn.execute("INSERT INTO users (username, password, role) VALUES (?, ?, 'reseller')",
                      (username, hashed_pass))
         conn.commit()
-        conn.close()
         flash(f'Revendedor "{username}" criado com sucesso!', 'success')
     except sqlite3.IntegrityError:
         flash(f'Erro: Usuário "{username}" já existe.', 'error')
+    except HasherBusy as e:
+        flash(str(e), 'error')
     
     return redirect(url_for('admin_panel'))
 
@@ -803,25 +3835,37 @@ def update_reseller():
         password = request.form.get('password') # .get() pois pode ser opcional
 
         conn = get_db()
+        # Excluído (aguardando a limpeza) não pode ser editado nem voltar a ser usado
+        if conn.execute("SELECT 1 FROM users WHERE id = ? AND deleted_at IS NULL", (reseller_id,)).fetchone() is None:
+            flash('Erro: Usuário não encontrado.', 'error')
+            return redirect(url_for('admin_panel'))
         if password:
             # Se uma nova senha foi fornecida, atualiza
-            hashed_pass = generate_password_hash(password)
-            conn.execute("UPDATE users SET username = ?, password = ? WHERE id = ?",
-                         (username, hashed_pass, reseller_id))
-            flash(f'Usuário "{username}" e senha atualizados!', 'success')
+            hashed_pass = password_hasher.hash(password)
+            updated = conn.execute("UPDATE users SET username = ?, password = ? WHERE id = ? AND deleted_at IS NULL",
+                                   (username, hashed_pass, reseller_id)).rowcount
         else:
             # Se não, atualiza só o nome de usuário
-            conn.execute("UPDATE users SET username = ? WHERE id = ?",
-                         (username, reseller_id))
+            updated = conn.execute("UPDATE users SET username = ? WHERE id = ? AND deleted_at IS NULL",
+                                   (username, reseller_id)).rowcount
+        if not updated:
+            # Excluído entre a checagem e o UPDATE
+            conn.rollback()
+            flash('Erro: Usuário não encontrado.', 'error')
+            return redirect(url_for('admin_panel'))
+        if password:
+            flash(f'Usuário "{username}" e senha atualizados!', 'success')
+        else:
             flash(f'Usuário "{username}" atualizado (senha mantida)!', 'success')
         
+        # Credenciais mudaram: derruba os logins abertos desse revendedor
+        revoke_sessions(conn, reseller_id)
         conn.commit()
+        session_versions.forget(int(reseller_id))
     except sqlite3.IntegrityError:
         flash(f'Erro: Nome de usuário "{username}" já existe.', 'error')
     except Exception as e:
         flash(f'Erro ao atualizar: {e}', 'error')
-    finally:
-        conn.close()
         
     return redirect(url_for('admin_panel'))
 
@@ -832,20 +3876,18 @@ def delete_reseller():
     try:
         reseller_id = request.form['reseller_id']
         conn = get_db()
-        conn.execute("PRAGMA foreign_keys = ON")
         
-        user = conn.execute("SELECT username FROM users WHERE id = ?", (reseller_id,)).fetchone()
+        # Some da lista e perde o login na hora; o histórico é apagado em lotes depois
+        username = soft_delete(conn, 'reseller', reseller_id)
         
-        if not user:
+        if not username:
              flash(f'Erro: Usuário não encontrado.', 'error')
-             conn.close()
              return redirect(url_for('admin_panel'))
 
-        username = user["username"]
-        conn.execute("DELETE FROM users WHERE id = ?", (reseller_id,))
+        revoke_sessions(conn, reseller_id)
         conn.commit()
-        conn.close()
-        flash(f'Revendedor "{username}" e todo o seu histórico foram excluídos!', 'success')
+        session_versions.forget(int(reseller_id))
+        flash(f'Revendedor "{username}" excluído! O histórico dele está sendo apagado em segundo plano.', 'success')
     except Exception as e:
         flash(f'Erro ao excluir: {e}', 'error')
         
@@ -864,19 +3906,51 @@ def add_credits():
             return redirect(url_for('admin_panel'))
             
         conn = get_db()
-        conn.execute("UPDATE users SET balance = balance + ? WHERE id = ? AND role = 'reseller'",
-                     (amount, reseller_id))
-        conn.commit()
-        
-        reseller = conn.execute("SELECT username FROM users WHERE id = ?", (reseller_id,)).fetchone()
-        conn.close()
+        result, replayed = add_credits_to(conn, session['user_id'], reseller_id, amount,
+                                          request.form.get('idempotency_key'))
         
-        flash(f'R$ {amount:.2f} adicionados com sucesso a "{reseller["username"]}".', 'success')
+        if replayed:
+            flash(f'Esses créditos já tinham sido adicionados a "{result["username"]}". Nada foi creditado de novo.', 'success')
+        else:
+            flash(f'R$ {amount:.2f} adicionados com sucesso a "{result["username"]}".', 'success')
     except Exception as e:
         flash(f'Erro ao adicionar créditos: {e}', 'error')
         
     return redirect(url_for('admin_panel'))
 
+# Créditos / revendedores em lote pelo painel (o relatório completo sai na API)
+@app.route("/admin/bulk", methods=["POST"])
+@require_role('admin')
+def admin_bulk():
+    kind = request.form.get('kind')
+    started = time.perf_counter()
+    try:
+        rows = read_bulk_rows()
+        conn = get_db()
+        if kind == 'credits':
+            report, replayed = bulk_add_credits(conn, session['user_id'], rows,
+                                                request.form.get('idempotency_key'))
+            if replayed:
+                flash('Este lote já tinha sido aplicado. Nada foi creditado de novo.', 'success')
+                return redirect(url_for('admin_panel'))
+        elif kind == 'resellers':
+            report = bulk_create_resellers(conn, rows)
+        else:
+            raise ValueError("Operação inválida.")
+    except (ValueError, HasherBusy, IdempotencyConflict, sqlite3.OperationalError) as e:
+        flash(f'Erro no lote: {e}', 'error')
+        return redirect(url_for('admin_panel'))
+
+    summary = bulk_summary(report, started)
+    flash(f"Lote aplicado: {summary['ok']} de {summary['total']} linhas "
+          f"({summary['rows_per_sec']} linhas/s).", 'success')
+    failed = [e for e in report if e['status'] == 'error']
+    if failed:
+        details = "; ".join(f"linha {e['row']}: {e['error']}" for e in failed[:5])
+        more = f" (+{len(failed) - 5})" if len(failed) > 5 else ""
+        flash(f"{len(failed)} linhas com erro — {details}{more}", 'error')
+    return redirect(url_for('admin_panel'))
+
 @app.route("/admin/create_product", methods=["POST"])
 @require_role('admin')
 def create_product():
@@ -885,8 +3959,8 @@ def create_product():
         try:
             conn = get_db()
             conn.execute("INSERT INTO products (name) VALUES (?)", (name,))
+            bump_catalog_generation(conn)
             conn.commit()
-            conn.close()
             flash(f'Produto "{name}" criado com sucesso!', 'success')
         except Exception as e:
             flash(f'Erro ao criar produto: {e}', 'error')
@@ -902,8 +3976,8 @@ def update_product():
         
         conn = get_db()
         conn.execute("UPDATE products SET name = ? WHERE id = ?", (name, product_id))
+        bump_catalog_generation(conn)
         conn.commit()
-        conn.close()
         flash(f'Produto atualizado para "{name}"!', 'success')
     except Exception as e:
         flash(f'Erro ao atualizar produto: {e}', 'error')
@@ -917,15 +3991,16 @@ def delete_product():
     try:
         product_id = request.form['product_id']
         conn = get_db()
-        conn.execute("PRAGMA foreign_keys = ON")
         
-        product = conn.execute("SELECT name FROM products WHERE id = ?", (product_id,)).fetchone()
-        product_name = product['name']
+        product_name = soft_delete(conn, 'product', product_id)
+        if not product_name:
+            flash('Erro: Produto não encontrado.', 'error')
+            return redirect(url_for('admin_panel'))
 
-        conn.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        bump_catalog_generation(conn)
         conn.commit()
-        conn.close()
-        flash(f'Produto "{product_name}" (e todos os seus planos) foi excluído!', 'success')
+        flash(f'Produto "{product_name}" (e todos os seus planos) foi excluído! '
+              'As compras antigas estão sendo apagadas em segundo plano.', 'success')
     except Exception as e:
         flash(f'Erro ao excluir produto: {e}', 'error')
         
@@ -950,7 +4025,7 @@ def create_plan():
         conn = get_db()
         
         existing_plan = conn.execute(
-            "SELECT * FROM plans WHERE product_id = ? AND name = ?", 
+            "SELECT * FROM plans WHERE product_id = ? AND name = ? AND deleted_at IS NULL", 
             (product_id, name)
         ).fetchone()
         
@@ -967,8 +4042,8 @@ def create_plan():
             )
             flash(f'Plano "{name}" (R$ {cost:.2f}) criado com sucesso!', 'success')
             
+        bump_catalog_generation(conn)
         conn.commit()
-        conn.close()
         
     except Exception as e:
         flash(f'Erro ao criar/atualizar plano: {e}', 'error')
@@ -982,15 +4057,15 @@ def delete_plan():
     try:
         plan_id = request.form['plan_id']
         conn = get_db()
-        conn.execute("PRAGMA foreign_keys = ON")
         
-        plan = conn.execute("SELECT name FROM plans WHERE id = ?", (plan_id,)).fetchone()
-        plan_name = plan['name']
+        plan_name = soft_delete(conn, 'plan', plan_id)
+        if not plan_name:
+            flash('Erro: Plano não encontrado.', 'error')
+            return redirect(url_for('admin_panel'))
 
-        conn.execute("DELETE FROM plans WHERE id = ?", (plan_id,))
+        bump_catalog_generation(conn)
         conn.commit()
-        conn.close()
-        flash(f'Plano "{plan_name}" (e todas as suas compras) foi excluído!', 'success')
+        flash(f'Plano "{plan_name}" excluído! As compras dele estão sendo apagadas em segundo plano.', 'success')
     except Exception as e:
         flash(f'Erro ao excluir plano: {e}', 'error')
         
@@ -1002,10 +4077,11 @@ def delete_plan():
 @app.route("/reseller")
 @require_role('reseller')
 def reseller_panel():
-    conn = get_db()
+    conn = get_read_db()
     reseller_id = session['user_id']
     
-    reseller = conn.execute("SELECT * FROM users WHERE id = ?", (reseller_id,)).fetchone()
+    # O login já foi validado pelo snapshot da sessão; aqui só precisamos do saldo atual
+    reseller = conn.execute("SELECT id, username, balance FROM users WHERE id = ?", (reseller_id,)).fetchone()
     
     # Verificação de segurança: se o reseller for None, desloga o usuário
     if not reseller:
@@ -1013,29 +4089,28 @@ def reseller_panel():
         flash("Sua sessão expirou ou o usuário foi removido.", "error")
         return redirect(url_for('login'))
 
-    # Lista de planos para comprar
-    plans = conn.execute(
-        "SELECT p.name as product_name, pl.* FROM plans pl "
-        "JOIN products p ON p.id = pl.product_id "
-        "WHERE p.is_active = 1 ORDER BY p.name, pl.cost"
-    ).fetchall()
+    # Lista de planos para comprar (do cache do catálogo)
+    plans = catalog_cache.active_plans(conn)
     
-    # Histórico de compras
-    purchases = conn.execute(
-        "SELECT p.*, pl.name as plan_name, pr.name as product_name "
-        "FROM purchases p "
-        "JOIN plans pl ON pl.id = p.plan_id "
-        "JOIN products pr ON pr.id = pl.product_id " 
-        "WHERE p.reseller_id = ? ORDER BY p.created_at DESC",
-        (reseller_id,)
-    ).fetchall()
+    # Histórico de compras (só a primeira página; o resto vem por "Carregar mais")
+    purchases, next_cursor = fetch_purchase_page(conn, reseller_id)
     
-    conn.close()
+    # Token novo a cada renderização: reenviar o mesmo formulário não compra duas vezes
+    form_token = uuid.uuid4().hex
     
-    return render_template_string(RESELLER_PANEL_HTML, GLOBAL_STYLES_AND_PARTICLES=GLOBAL_STYLES_AND_PARTICLES, reseller=reseller, plans=plans, purchases=purchases)
+    return render_template('reseller_panel.html', reseller=reseller, plans=plans, purchases=purchases,
+                           next_cursor=next_cursor, form_token=form_token)
+
+@app.route("/reseller/purchases")
+@require_role('reseller')
+def reseller_purchases():
+    """Próxima página do histórico em JSON (botão "Carregar mais")"""
+    return purchase_page_json(session['user_id'])
 
 @app.route("/reseller/purchase", methods=["POST"])
 @require_role('reseller')
+@rate_limit('purchase_ip', PURCHASE_IP_RATE_LIMIT, lambda: request.remote_addr)
+@rate_limit('purchase_user', PURCHASE_USER_RATE_LIMIT, lambda: session.get('user_id'))
 def purchase_product():
     plan_id = int(request.form['plan_id'])
     reseller_id = session['user_id']
@@ -1043,42 +4118,17 @@ def purchase_product():
     conn = get_db()
     
     try:
-        plan = conn.execute("SELECT * FROM plans WHERE id = ?", (plan_id,)).fetchone()
-        if not plan:
-            raise Exception("Plano não encontrado.")
-        
-        if not plan['download_link']:
-             raise Exception("Produto indisponível (sem link). Contate o admin.")
-            
-        plan_cost = plan['cost']
-        
-        reseller = conn.execute("SELECT balance FROM users WHERE id = ?", (reseller_id,)).fetchone()
-        current_balance = reseller['balance']
-        
-        if current_balance < plan_cost:
-            raise Exception("Saldo insuficiente para comprar este produto.")
-            
-        new_balance = current_balance - plan_cost
-        conn.execute("UPDATE users SET balance = ? WHERE id = ?", (new_balance, reseller_id))
-        
-        purchase_id_ref = f"ID-{str(uuid.uuid4()).upper()[:8]}"
-        
-        conn.execute(
-            "INSERT INTO purchases (reseller_id, plan_id, cost_paid, purchase_id_ref) VALUES (?, ?, ?, ?)",
-            (reseller_id, plan_id, plan_cost, purchase_id_ref)
-        )
+        purchase, replayed = purchase_plan(conn, reseller_id, plan_id, request.form.get('idempotency_key'))
+        purchase_id_ref = purchase['purchase_id_ref']
         
-        conn.commit()
-        
-        flash(f'Compra realizada com sucesso! ID: {purchase_id_ref}. O link de download está liberado no seu histórico.', 'success')
+        if replayed:
+            flash(f'Esta compra já tinha sido registrada (ID: {purchase_id_ref}). Nada foi cobrado de novo.', 'success')
+        else:
+            flash(f'Compra realizada com sucesso! ID: {purchase_id_ref}. O link de download está liberado no seu histórico.', 'success')
         
     except Exception as e:
-        conn.rollback()
         flash(f'Erro ao comprar: {e}', 'error')
         
-    finally:
-        conn.close()
-        
     return redirect(url_for('reseller_panel'))
 
 # Rota para o DOWNLOAD (CORRIGIDA)
@@ -1097,11 +4147,10 @@ def get_download_link(purchase_id):
         flash("Acesso negado. Esta compra não é sua.", 'error')
         return redirect(url_for('reseller_panel'))
         
-    plan = conn.execute("SELECT * FROM plans WHERE id = ?", (purchase['plan_id'],)).fetchone()
-    conn.close()
+    plan = catalog_cache.get_plan(conn, purchase['plan_id'])
     
     # CORREÇÃO DO ERRO 'AttributeError':
-    download_link = plan['download_link'] # Acesso por chave
+    download_link = plan['download_link'] if plan else None # Acesso por chave
     
     if not download_link:
         flash("Erro: O link deste plano não foi encontrado. Contate o admin.", 'error')
@@ -1110,11 +4159,213 @@ def get_download_link(purchase_id):
     # Redireciona o usuário para o link externo
     return redirect(download_link)
 
+# --- Métricas (scrape do Prometheus) ---
+
+@app.route("/metrics")
+def prometheus_metrics():
+    if not METRICS_TOKEN:
+        return jsonify({'error': 'Não encontrado.'}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+        return jsonify({'error': 'Não autenticado.'}), 401
+    # Os números deste worker entram na hora; os dos outros, no próximo flush deles
+    metrics.flush()
+    return Response(Metrics.render(get_db()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- API JSON v1 (integrações dos revendedores) ---
+
+def api_require_role(role_name):
+    """Como require_role, mas responde 401 em JSON em vez de redirecionar"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            user = current_user()
+            if user is None or user['role'] != role_name:
+                return jsonify({'error': 'Não autenticado.'}), 401
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+def _api_json():
+    """Corpo JSON da requisição; {} se ausente, inválido ou se não for um objeto"""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+def _api_json_error():
+    """Resposta 400 se o corpo não for um objeto JSON (ex.: lista, número, texto), senão None"""
+    if not isinstance(request.get_json(silent=True), dict):
+        return jsonify({'error': 'Corpo deve ser um objeto JSON.'}), 400
+    return None
+
+@app.route("/api/v1/login", methods=["POST"])
+@rate_limit('login_ip', LOGIN_IP_RATE_LIMIT, lambda: request.remote_addr)
+@rate_limit('login_user', LOGIN_USER_RATE_LIMIT, lambda: _api_json().get('username'))
+def api_login():
+    error = _api_json_error()
+    if error:
+        return error
+    data = _api_json()
+    try:
+        user = authenticate(str(data.get('username', '')), str(data.get('password', '')))
+    except HasherBusy as e:
+        return jsonify({'error': str(e)}), 503
+    if not user:
+        return jsonify({'error': 'Usuário ou senha inválidos.'}), 401
+    start_session(user)
+    return jsonify({'id': user['id'], 'username': user['username'], 'role': user['role']})
+
+@app.route("/api/v1/catalog")
+@api_require_role('reseller')
+def api_catalog():
+    conn = get_db()
+    etag = f"catalog-{catalog_cache.generation(conn)}"
+    # Catálogo não mudou desde a última leitura do cliente: 304 sem corpo
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify([{
+            'id': p['id'],
+            'product': p['product_name'],
+            'name': p['name'],
+            'cost': p['cost'],
+            'duration_days': p['duration_days'],
+            'available': bool(p['download_link']),
+        } for p in catalog_cache.active_plans(conn)])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route("/api/v1/balance")
+@api_require_role('reseller')
+def api_balance():
+    row = get_db().execute("SELECT balance, balance_cents FROM users WHERE id = ?", (session['user_id'],)).fetchone()
+    return jsonify({'balance': row['balance'], 'balance_cents': row['balance_cents']})
+
+@app.route("/api/v1/purchases", methods=["POST"])
+@api_require_role('reseller')
+@rate_limit('purchase_ip', PURCHASE_IP_RATE_LIMIT, lambda: request.remote_addr)
+@rate_limit('purchase_user', PURCHASE_USER_RATE_LIMIT, lambda: session.get('user_id'))
+def api_purchase():
+    """Compra numa única ida e volta; mande 'Idempotency-Key' para poder repetir com segurança"""
+    error = _api_json_error()
+    if error:
+        return error
+    try:
+        plan_id = int(_api_json()['plan_id'])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'plan_id inválido.'}), 400
+
+    conn = get_db()
+    reseller_id = session['user_id']
+    try:
+        purchase, replayed = purchase_plan(conn, reseller_id, plan_id,
+                                           request.headers.get('Idempotency-Key'))
+    except (PurchaseError, IdempotencyConflict) as e:
+        return jsonify({'error': str(e)}), 422
+    except sqlite3.OperationalError:
+        return jsonify({'error': 'Banco ocupado, tente novamente.'}), 503
+
+    balance = conn.execute("SELECT balance FROM users WHERE id = ?", (reseller_id,)).fetchone()['balance']
+    response = jsonify({**purchase, 'balance': balance,
+                        'download_url': url_for('get_download_link', purchase_id=purchase['purchase_id'])})
+    response.status_code = 200 if replayed else 201
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+@app.route("/api/v1/purchases")
+@api_require_role('reseller')
+def api_purchase_history():
+    return purchase_page_json(session['user_id'])
+
+@app.route("/api/v1/admin/analytics")
+@api_require_role('admin')
+def api_analytics():
+    """Vendas do período (?start=&end=, AAAA-MM-DD; ?top= para o tamanho dos rankings)"""
+    try:
+        start, end = report_range(request.args)
+        top = min(max(int(request.args.get('top', 10)), 1), 100)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(sales_report(get_read_db(), start, end, top))
+
+@app.route("/api/v1/admin/slow-queries")
+@api_require_role('admin')
+def api_slow_queries():
+    """Piores instruções (?order=total|max|calls|recent, ?limit= até 500)"""
+    order = request.args.get('order', 'total')
+    if order not in SLOW_QUERY_ORDERS:
+        return jsonify({'error': f"order deve ser um de: {', '.join(SLOW_QUERY_ORDERS)}"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+    except ValueError:
+        return jsonify({'error': 'limit inválido.'}), 400
+    slow_queries.flush()
+    return jsonify({'threshold_ms': SLOW_QUERY_MS, 'items': slow_query_report(get_db(), order, limit)})
+
+@app.route("/api/v1/admin/purges")
+@api_require_role('admin')
+def api_purges():
+    """Progresso das exclusões em segundo plano (pendentes + últimas concluídas)"""
+    return jsonify({'items': purge_jobs_report(get_db())})
+
+@app.route("/api/v1/admin/credits/bulk", methods=["POST"])
+@api_require_role('admin')
+def api_bulk_credits():
+    """Créditos em lote (JSON ou CSV); 'Idempotency-Key' permite reenviar o mesmo lote"""
+    started = time.perf_counter()
+    try:
+        report, replayed = bulk_add_credits(get_db(), session['user_id'], read_bulk_rows(),
+                                            request.headers.get('Idempotency-Key'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except IdempotencyConflict as e:
+        return jsonify({'error': str(e)}), 422
+    except sqlite3.OperationalError:
+        return jsonify({'error': 'Banco ocupado, tente novamente.'}), 503
+
+    response = jsonify(bulk_summary(report, started))
+    if replayed:
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+@app.route("/api/v1/admin/resellers/bulk", methods=["POST"])
+@api_require_role('admin')
+def api_bulk_resellers():
+    """Criação de revendedores em lote (JSON ou CSV)"""
+    started = time.perf_counter()
+    try:
+        report = bulk_create_resellers(get_db(), read_bulk_rows())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except (HasherBusy, sqlite3.OperationalError) as e:
+        return jsonify({'error': str(e)}), 503
+
+    summary = bulk_summary(report, started)
+    return jsonify(summary), 201 if summary['ok'] else 200
+
 # --- 4. Iniciar a Aplicação (CORRIGIDO) ---
+
+# Comandos de manutenção: python site.py <comando>
+# backfill-rollups refaz só os rollups de revendedores/planos/produtos ativos; a receita
+# dos excluídos (cujas compras a limpeza já apagou) fica como está.
+COMMANDS = {
+    'backfill-rollups': backfill_sales_rollups,
+}
+
 if __name__ == '__main__':
     # Inicializa o banco de dados (de forma segura)
     init_db() 
     
+    if len(sys.argv) > 1:
+        command = COMMANDS.get(sys.argv[1])
+        if command is None:
+            print(f"Comando desconhecido: {sys.argv[1]}. Disponíveis:")
+            for name, fn in COMMANDS.items():
+                print(f"  {name}: {' '.join(fn.__doc__.split())}")
+            sys.exit(1)
+        command()
+        sys.exit(0)
+    
     print(f"\nServidor Flask (v4.1 - FINAL) rodando em http://127.0.0.1:5000")
     print("Logins de Teste:")
     print("  Admin:      trader / traderbr") # <-- ATUALIZADO
@@ -0,0 +1,13 @@
+document.addEventListener('DOMContentLoaded', function() {
+    const particles = document.getElementById('particles');
+    if (particles) {
+        for (let i = 0; i < 50; i++) {
+            const particle = document.createElement('div');
+            particle.className = 'particle';
+            particle.style.left = Math.random() * 100 + 'vw';
+            particle.style.animationDelay = Math.random() * 6 + 's';
+            particle.style.animationDuration = (3 + Math.random() * 4) + 's';
+            particles.appendChild(particle);
+        }
+    }
+});
@@ -0,0 +1,132 @@
+"""
+Teste de estresse do motor de compras: centenas de compradores simultâneos
+chamando purchase_plan no mesmo punhado de revendedores, num banco próprio
+(nunca o reseller_panel.db do repositório).
+
+Ao final confere que não houve divergência de saldo: cada saldo é o crédito
+inicial menos as compras gravadas, nenhum saldo ficou negativo, chaves de
+idempotência repetidas não cobraram duas vezes e o reconcile_ledger não acha
+diferenças entre saldos e razão. Sai com código 1 se algo não bater.
+
+    python stress.py --buyers 400 --resellers 4
+    PURCHASE_GROUP_COMMIT=1 python stress.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import bench
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Estresse de compras simultâneas (sem divergência de saldo).")
+    parser.add_argument('--buyers', type=int, default=400, help="threads compradoras simultâneas")
+    parser.add_argument('--resellers', type=int, default=4, help="revendedores disputados pelas threads")
+    parser.add_argument('--credit', type=int, default=300,
+                        help="crédito inicial de cada revendedor (R$); menor que a demanda para exercitar saldo insuficiente")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='panel-stress-')
+    os.environ.update({**bench.BENCH_ENV, 'DATABASE': os.path.join(workdir, 'reseller_panel.db'),
+                       'DB_POOL_SIZE': str(args.buyers), 'HASH_POOL_WORKERS': '0'})
+    os.environ.setdefault('SLOW_QUERY_LOG', os.path.join(workdir, 'slow_queries.log'))
+    panel = bench.load_panel()
+    with bench.contextlib.redirect_stdout(sys.stderr):
+        panel.init_db()
+
+    credit_cents = args.credit * 100
+    conn = panel.db_pool.acquire()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT INTO users (username, password, role) VALUES (?, '-', 'reseller')",
+                         [(f'stress_r{i:03d}',) for i in range(args.resellers)])
+        reseller_ids = [row[0] for row in conn.execute(
+            "SELECT id FROM users WHERE username LIKE 'stress\\_r%' ESCAPE '\\' ORDER BY id")]
+        for reseller_id in reseller_ids:
+            panel.post_ledger_entry(conn, reseller_id, credit_cents, 'credit')
+        plan = conn.execute("SELECT id, cost FROM plans WHERE deleted_at IS NULL ORDER BY id LIMIT 1").fetchone()
+        conn.commit()
+    finally:
+        panel.db_pool.release(conn)
+
+    # Pares de threads dividem a mesma chave de idempotência: no máximo uma compra por par
+    outcomes = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.buyers)
+
+    def buyer(i):
+        reseller_id = reseller_ids[i % len(reseller_ids)]
+        key = f'stress-{reseller_id}-{i // (2 * len(reseller_ids))}'
+        conn = panel.db_pool.acquire()
+        try:
+            barrier.wait()
+            started = time.perf_counter()
+            try:
+                result, replayed = panel.purchase_plan(conn, reseller_id, plan['id'], key)
+                outcome = ('replay' if replayed else 'ok', reseller_id, key, result['purchase_id'])
+            except panel.PurchaseError:
+                outcome = ('refused', reseller_id, key, None)
+            except Exception as e:
+                outcome = ('error', reseller_id, key, repr(e))
+            elapsed = time.perf_counter() - started
+        finally:
+            panel.db_pool.release(conn)
+        with lock:
+            outcomes.append(outcome + (elapsed,))
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(args.buyers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    problems = [f"erro inesperado: {o[3]}" for o in outcomes if o[0] == 'error']
+    charged = {}
+    for kind, reseller_id, key, purchase_id, _ in outcomes:
+        if kind in ('ok', 'replay'):
+            charged.setdefault((reseller_id, key), set()).add(purchase_id)
+    problems += [f"chave {key} devolveu compras diferentes: {sorted(ids)}"
+                 for (_, key), ids in charged.items() if len(ids) > 1]
+
+    conn = panel.db_pool.acquire()
+    try:
+        cost_cents = panel.to_cents(plan['cost'])
+        for reseller_id in reseller_ids:
+            balance_cents, balance = conn.execute("SELECT balance_cents, balance FROM users WHERE id = ?",
+                                                  (reseller_id,)).fetchone()
+            purchases = conn.execute("SELECT COUNT(*) FROM purchases WHERE reseller_id = ?",
+                                     (reseller_id,)).fetchone()[0]
+            expected = credit_cents - purchases * cost_cents
+            keys = sum(1 for (rid, _) in charged if rid == reseller_id)
+            if balance_cents != expected or round(balance * 100) != expected:
+                problems.append(f"revendedor {reseller_id}: saldo {balance_cents} centavos, esperado {expected}")
+            if balance_cents < 0:
+                problems.append(f"revendedor {reseller_id}: saldo negativo ({balance_cents})")
+            if purchases != keys:
+                problems.append(f"revendedor {reseller_id}: {purchases} compras gravadas para {keys} chaves cobradas")
+    finally:
+        panel.db_pool.release(conn)
+
+    with bench.contextlib.redirect_stdout(sys.stderr):
+        reconcile = panel.reconcile_ledger()
+    problems += [f"razão divergente: {row}" for row in reconcile['mismatches']]
+
+    latencies = sorted(o[4] * 1000 for o in outcomes)
+    counts = {kind: sum(1 for o in outcomes if o[0] == kind) for kind in ('ok', 'replay', 'refused', 'error')}
+    print(f"🛒 {args.buyers} compradores em {args.resellers} revendedores: {counts}  "
+          f"p50 {bench.percentile(latencies, 50):.1f} ms  p99 {bench.percentile(latencies, 99):.1f} ms")
+    bench.shutil.rmtree(workdir, ignore_errors=True)
+    if problems:
+        print("❌ Divergências:")
+        for line in problems:
+            print(f"   {line}")
+        return 1
+    print("✅ Sem divergência de saldo (saldos, idempotência e razão conferem).")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())